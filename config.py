@@ -7,6 +7,12 @@ PASSWORD = ''
 SWF_VERSION = '0677'
 # Log chat messages and events.
 CHAT_LOGGING = True
+# Seconds between writes of the buffered chat log lines to disk.
+CHAT_LOG_FLUSH_INTERVAL = 2
+# The maximum amount of buffered chat log lines, new lines are dropped when the buffer is full.
+CHAT_LOG_BUFFER_SIZE = 5000
+# Gzip compress the chat log of a day when the date changes.
+CHAT_LOG_COMPRESS = False
 # Show additional info/errors in console.
 DEBUG_MODE = False
 # Log debug info to file.
@@ -21,10 +27,26 @@ ENABLE_AUTO_JOB = True
 USE_24HOUR = True
 # Reset the run time after a reconnect.
 RESET_INIT_TIME = False
+# Send the connect command along with the end of the handshake. (faster room joins)
+PIPELINED_CONNECT = False
 # Reconnect delay in seconds.
 RECONNECT_DELAY = 10
 # Auto job interval in seconds.
 AUTO_JOB_INTERVAL = 360
+# Worker threads for network bound lookups. (web API lookups, privacy page changes)
+API_WORKERS = 4
+# The maximum amount of queued lookups, new lookups are dropped when the queue is full.
+API_QUEUE_SIZE = 50
+# Worker threads for quick moderation actions. (join checks, message checks, kicks and bans)
+MOD_WORKERS = 2
+# The maximum amount of queued moderation actions, when the queue is full they run right away.
+MOD_QUEUE_SIZE = 100
+# Messages sent to the server per second, kept under the flood limit of the server.
+SEND_RATE = 3
+# Messages that may be sent at once after a quiet period.
+SEND_BURST = 8
+# The maximum amount of queued outgoing messages, new messages are dropped when the queue is full.
+SEND_QUEUE_SIZE = 300
 # The name of pinylib's debug log file.
 DEBUG_FILE_NAME = 'pinylib_debug.log'
 # The path to the config folder.
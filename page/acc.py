@@ -11,8 +11,8 @@ class Account:
         :type account: str
         :param password: Tinychat account password.
         :type password: str
-        :param proxy: A proxy in the format IP:PORT
-        :type proxy: str
+        :param proxy: A proxy in the format IP:PORT, or a proxy pool.
+        :type proxy: str | util.proxy_pool.ProxyPool
         """
         self.account = account
         self.password = password
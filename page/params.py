@@ -29,8 +29,8 @@ class Params(object):
         :type room_pass: str
         :param swf_version: The current tinychat SWF version.
         :type swf_version: str
-        :param proxy: Proxy and port in the format IP:PORT
-        :type proxy: str
+        :param proxy: A proxy in the format IP:PORT, or a proxy pool.
+        :type proxy: str | util.proxy_pool.ProxyPool
         """
         self.room_name = room_name
         self.room_pass = room_pass
@@ -10,8 +10,8 @@ class Privacy:
     def __init__(self, proxy):
         """ Create a instance of the Privacy class.
 
-        :param proxy: A proxy in the format IP:PORT
-        :type proxy: str | None
+        :param proxy: A proxy in the format IP:PORT, or a proxy pool.
+        :type proxy: str | util.proxy_pool.ProxyPool | None
         """
         self._proxy = proxy
         self._privacy_url = 'https://tinychat.com/settings/privacy'
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import atexit
 import logging
 import threading
 import time
@@ -7,9 +8,9 @@ from colorama import init, Fore, Style
 import config
 import user
 import apis.tinychat
-from rtmplib import rtmp
+from rtmplib import rtmp, pool, send_queue
 from page import acc, params
-from util import string_util, file_handler
+from util import string_util, scheduler, worker_pool, log_writer
 
 __version__ = '7.0.0'
 
@@ -41,10 +42,81 @@ def write_to_log(msg, room_name):
     :param room_name: the room name.
     :type room_name: str
     """
-    d = time.strftime('%Y-%m-%d')
-    file_name = d + '.log'
     path = config.CONFIG_PATH + room_name + '/logs/'
-    file_handler.file_writer(path, file_name, msg.encode(encoding='UTF-8', errors='ignore'))
+    get_log_writer().write(path, msg.encode(encoding='UTF-8', errors='ignore'))
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def get_log_writer():
+    """ Get the writer of the chat logs of all the rooms of the process.
+
+    The lines are written to disk by the thread of the writer, so logging never waits on the disk.
+
+    :return: The log writer, created from the config on first use.
+    :rtype: log_writer.LogWriter
+    """
+    global _log_writer
+    with _log_writer_lock:
+        if _log_writer is None:
+            _log_writer = log_writer.LogWriter('pinylib-log-writer', flush_interval=config.CHAT_LOG_FLUSH_INTERVAL,
+                                               max_buffer=config.CHAT_LOG_BUFFER_SIZE,
+                                               compress=config.CHAT_LOG_COMPRESS)
+            # write the buffered lines before the process exits.
+            atexit.register(_log_writer.close)
+        return _log_writer
+
+
+_worker_pools = {}
+_worker_pools_lock = threading.Lock()
+
+
+def get_worker_pool(name):
+    """ Get a worker pool shared by all the rooms of the process.
+
+    :param name: The name of the pool, 'api' for network bound lookups, 'mod' for moderation actions.
+    :type name: str
+    :return: The worker pool, created from the config on first use.
+    :rtype: worker_pool.WorkerPool
+    """
+    with _worker_pools_lock:
+        pool_ = _worker_pools.get(name)
+        if pool_ is None:
+            if name == 'api':
+                pool_ = worker_pool.WorkerPool('api', workers=config.API_WORKERS,
+                                               max_queue=config.API_QUEUE_SIZE, drop_policy=worker_pool.DROP_NEW)
+            elif name == 'mod':
+                pool_ = worker_pool.WorkerPool('mod', workers=config.MOD_WORKERS,
+                                               max_queue=config.MOD_QUEUE_SIZE, drop_policy=worker_pool.CALLER_RUNS)
+            else:
+                raise ValueError('unknown worker pool: %s' % name)
+            _worker_pools[name] = pool_
+        return pool_
+
+
+_scheduler = scheduler.Scheduler('pinylib-scheduler')
+
+
+def get_scheduler():
+    """ Get the scheduler running the timed calls of all the rooms of the process.
+
+    :rtype: scheduler.Scheduler
+    """
+    return _scheduler
+
+
+def _unpack(handler, *indexes):
+    """ Wrap a handler to be called with the arguments of a command at the given indexes.
+
+    :param handler: The handler, taking the arguments in the order of indexes.
+    :param indexes: The indexes of the arguments in the decoded command.
+    :return: A handler taking the decoded command.
+    """
+    def dispatch(amf0_cmd):
+        return handler(*[amf0_cmd[i] for i in indexes])
+    return dispatch
 
 
 class TinychatRTMPClient(object):
@@ -52,7 +124,7 @@ class TinychatRTMPClient(object):
     Tinychat client responsible for managing the connection and the different
     events that may occur in the chat room.
     """
-    def __init__(self, roomname, nick='', account='', password='', room_pass=None, proxy=None):
+    def __init__(self, roomname, nick='', account='', password='', room_pass=None, proxy=None, connection_pool=None):
         """ Create a instance of the TinychatRTMPClient class.
 
         :param roomname: The room name to connect to.(required)
@@ -66,8 +138,12 @@ class TinychatRTMPClient(object):
         :param room_pass: The password for the room.(optional)
         :type room_pass: str | None
         :param proxy: A proxy in the format IP:PORT for the connection to the remote server,
-        but also for doing the various web requests related to establishing a connection.(optional)
-        :type proxy: str | None
+        but also for doing the various web requests related to establishing a connection.
+        A proxy pool rotates between the proxies of the pool, preferring the fastest.(optional)
+        :type proxy: str | util.proxy_pool.ProxyPool | None
+        :param connection_pool: Run the connections on the event loop of a shared pool
+        instead of a thread per connection.(optional)
+        :type connection_pool: rtmplib.pool.ConnectionPool | None
         """
         self.roomname = roomname
         self.nickname = nick
@@ -83,12 +159,22 @@ class TinychatRTMPClient(object):
         self.users = user.Users()
         self.active_user = None
         self.param = None
+        self.connection_pool = connection_pool
+        # network bound lookups, and moderation actions, run on these instead of a thread per task.
+        self.api_workers = get_worker_pool('api')
+        self.mod_workers = get_worker_pool('mod')
+        # runs the timed calls, instead of a thread per timer.
+        self.scheduler = get_scheduler()
+        self._auto_job_timer = None
+        # the outgoing messages of the room connection, sent by priority at the rate the server allows.
+        self._send_queue = None
         self._proxy = proxy
         self._client_id = None
         self._bauth_key = None
         self._is_reconnected = False
         self._reconnect_delay = config.RECONNECT_DELAY
         self._init_time = time.time()
+        self._build_command_handlers()
 
     def console_write(self, color, message):
         """ Writes message to console.
@@ -141,32 +227,69 @@ class TinychatRTMPClient(object):
             account.login()
         return account.is_logged_in()
 
+    def _create_connection(self):
+        """ Create a RTMP client with the current RTMP parameters, not yet connected.
+
+        :return: The client.
+        :rtype: rtmp.RtmpClient
+        """
+        kwargs = {
+            'page_url': self.param.embed_url,
+            'swf_url': self.param.swf_url,
+            'proxy': self._proxy,
+            'is_win': True,
+            'pipeline': config.PIPELINED_CONNECT
+        }
+        if self.connection_pool is None:
+            return rtmp.RtmpClient(self.param.ip, self.param.port, self.param.tc_url, self.param.app, **kwargs)
+        kwargs['on_message'] = self._pool_message
+        kwargs['on_close'] = self._pool_close
+        kwargs['on_connect'] = self._pool_connect
+        return self.connection_pool.client(self.param.ip, self.param.port,
+                                           self.param.tc_url, self.param.app, **kwargs)
+
+    def _open_connection(self, connection, connect_params):
+        """ Connect a client made by _create_connection.
+
+        With a connection pool the client connects on the event loop of the pool,
+        else this blocks until the connect command has been sent.
+
+        :param connection: The client.
+        :type connection: rtmp.RtmpClient
+        :param connect_params: The application specific connect parameters.
+        :type connect_params: dict
+        """
+        if self.connection_pool is None:
+            connection.connect(connect_params)
+        else:
+            self.connection_pool.connect(connection, connect_params)
+
     def connect(self):
         """ Make a connection with the remote RTMP server. """
         if not self.is_connected:
             log.info('connecting to: %s' % self.roomname)
             try:
                 self.param.recaptcha()
-                self.connection = rtmp.RtmpClient(
-                    ip=self.param.ip,
-                    port=self.param.port,
-                    tc_url=self.param.tc_url,
-                    app=self.param.app,
-                    page_url=self.param.embed_url,
-                    swf_url=self.param.swf_url,
-                    proxy=self._proxy,
-                    is_win=True
-                )
-                self.connection.connect(
-                    {
-                        'account': self.account,
-                        'type': self.param.roomtype,
-                        'prefix': u'tinychat',
-                        'room': self.roomname,
-                        'version': self.param.desktop_version,
-                        'cookie': self.param.cauth_cookie()
-                    }
-                )
+                # the connection and the send queue are set before connecting,
+                # the pool may call _pool_connect or _pool_close before _open_connection returns.
+                self.connection = self._create_connection()
+                self._send_queue = send_queue.SendQueue(self.connection, rate=config.SEND_RATE,
+                                                        burst=config.SEND_BURST, max_size=config.SEND_QUEUE_SIZE,
+                                                        started=False, name='%s-send-queue' % self.roomname)
+                if self.connection_pool is not None:
+                    # a connect failing on the event loop reconnects through _pool_close.
+                    self.is_connected = True
+                self._open_connection(self.connection,
+                                      {
+                                          'account': self.account,
+                                          'type': self.param.roomtype,
+                                          'prefix': u'tinychat',
+                                          'room': self.roomname,
+                                          'version': self.param.desktop_version,
+                                          'cookie': self.param.cauth_cookie()
+                                      })
+                if self.connection_pool is None:
+                    self._send_queue.start()
                 self.is_connected = True
             except Exception as e:
                 log.critical('connect error: %s' % e, exc_info=True)
@@ -177,6 +300,11 @@ class TinychatRTMPClient(object):
             finally:
                 if config.RESET_INIT_TIME:
                     self._init_time = time.time()
+                if self.connection_pool is not None:
+                    # the messages are delivered by the event loop of the pool.
+                    if self.param.is_greenroom and not self.is_green_connected:
+                        self.__connect_green()
+                    return
                 if self.param.is_greenroom and not self.is_green_connected:
                     threading.Thread(target=self.__connect_green).start()
                 self.__callback()
@@ -185,26 +313,19 @@ class TinychatRTMPClient(object):
         """ Make a connection to the greenroom application. """
         if not self.is_green_connected:
             try:
-                self.green_connection = rtmp.RtmpClient(
-                    ip=self.param.ip,
-                    port=self.param.port,
-                    tc_url=self.param.tc_url,
-                    app=self.param.app,
-                    page_url=self.param.embed_url,
-                    swf_url=self.param.swf_url,
-                    proxy=self._proxy,
-                    is_win=True
-                )
-                self.green_connection.connect(
-                    {
-                        'account': '',
-                        'type': self.param.roomtype,
-                        'prefix': u'greenroom',
-                        'room': self.roomname,
-                        'version': self.param.desktop_version,
-                        'cookie': ''
-                    }
-                )
+                self.green_connection = self._create_connection()
+                if self.connection_pool is not None:
+                    # a connect failing on the event loop reconnects through _pool_close.
+                    self.is_green_connected = True
+                self._open_connection(self.green_connection,
+                                      {
+                                          'account': '',
+                                          'type': self.param.roomtype,
+                                          'prefix': u'greenroom',
+                                          'room': self.roomname,
+                                          'version': self.param.desktop_version,
+                                          'cookie': ''
+                                      })
                 self.is_green_connected = True
             except Exception as e:
                 log.critical('greenroom connect error: %s' % e, exc_info=True)
@@ -213,7 +334,15 @@ class TinychatRTMPClient(object):
                 if config.DEBUG_MODE:
                     traceback.print_exc()
             finally:
-                self.__green_callback()
+                if self.connection_pool is None:
+                    self.__green_callback()
+
+    def _close_connection(self, connection):
+        """ Close a connection, on the event loop of the connection pool if there is one. """
+        if self.connection_pool is None:
+            connection.shutdown()
+        else:
+            self.connection_pool.close(connection)
 
     def disconnect(self, greenroom=False):
         """ Close the connection with the remote RTMP server.
@@ -227,12 +356,15 @@ class TinychatRTMPClient(object):
             if greenroom:
                 log.info('disconnection from greenroom application')
                 self.is_green_connected = False
-                self.green_connection.shutdown()
+                self._close_connection(self.green_connection)
             else:
                 self.is_connected = False
                 self._bauth_key = None
                 self.users.clear()
-                self.connection.shutdown()
+                if self._send_queue is not None:
+                    self._send_queue.close()
+                    self._send_queue = None
+                self._close_connection(self.connection)
         except Exception as e:
             log.error('disconnect error, greenroom: %s, error: %s' % (greenroom, e), exc_info=True)
             if config.DEBUG_MODE:
@@ -281,12 +413,9 @@ class TinychatRTMPClient(object):
         """ Read packets from the greenroom RTMP application. """
         log.info('starting greenroom callback loop. is_green_connected: %s' % self.is_green_connected)
         fails = 0
-        amf0_data_type = - 1
-        amf0_data = None
         while self.is_green_connected:
             try:
                 amf0_data = self.green_connection.amf()
-                amf0_data_type = amf0_data['msg']
             except rtmp.AmfDataReadError as e:
                 fails += 1
                 log.error('greenroom amf read error: %s %s' % (fails, e), exc_info=True)
@@ -297,44 +426,39 @@ class TinychatRTMPClient(object):
                     break
             else:
                 fails = 0
-            try:
-                if amf0_data_type == rtmp.rtmp_type.DT_COMMAND:
-
-                    amf0_cmd = amf0_data['command']
-                    cmd = amf0_cmd[0]
-
-                    if cmd == '_result':
-                        self.on_result(amf0_cmd, greenroom=True)
-
-                    elif cmd == '_error':
-                        self.on_error(amf0_cmd, greenroom=True)
+                self.green_amf_handler(amf0_data)
 
-                    elif cmd == 'notice':
-                        notice_msg = amf0_cmd[3]
-                        notice_msg_id = amf0_cmd[4]
-                        if notice_msg == 'avon':
-                            avon_name = amf0_cmd[5]
-                            self.on_avon(notice_msg_id, avon_name, greenroom=True)
-                    else:
-                        if config.DEBUG_MODE:
-                            self.console_write(COLOR['white'], 'ignoring greenroom command: %s' % cmd)
+    def green_amf_handler(self, amf0_data):
+        """ Handle a packet from the greenroom RTMP application.
 
-            except Exception as gge:
-                log.error('general greenroom callback error: %s' % gge, exc_info=True)
-                if config.DEBUG_MODE:
-                    traceback.print_exc()
+        :param amf0_data: The decoded packet.
+        :type amf0_data: dict
+        """
+        try:
+            if amf0_data['msg'] == rtmp.rtmp_type.DT_COMMAND:
+                amf0_cmd = amf0_data['command']
+                handler = self._green_command_handlers.get(amf0_cmd[0])
+                if handler is not None:
+                    handler(amf0_cmd)
+                elif config.DEBUG_MODE:
+                    self.console_write(COLOR['white'], 'ignoring greenroom command: %s' % amf0_cmd[0])
+
+        except Exception as gge:
+            log.error('general greenroom callback error: %s' % gge, exc_info=True)
+            if config.DEBUG_MODE:
+                traceback.print_exc()
+            if self.connection_pool is None:
                 self.reconnect(greenroom=True)
+            else:
+                threading.Thread(target=self.reconnect, kwargs={'greenroom': True}).start()
 
     def __callback(self):
         """ Read packets from the RTMP application. """
         log.info('starting callback loop. is_connected: %s' % self.is_connected)
         fails = 0
-        amf0_data_type = -1
-        amf0_data = None
         while self.is_connected:
             try:
                 amf0_data = self.connection.amf()
-                amf0_data_type = amf0_data['msg']
             except rtmp.AmfDataReadError as e:
                 fails += 1
                 log.error('amf data read error count: %s %s' % (fails, e), exc_info=True)
@@ -345,159 +469,178 @@ class TinychatRTMPClient(object):
                     break
             else:
                 fails = 0
-            try:
-                if amf0_data_type == rtmp.rtmp_type.DT_COMMAND:
-
-                    create_stream_res = self.connection.is_create_stream_response(amf0_data)
-                    if create_stream_res:
-                        msg = 'create stream response, stream_id: %s' % self.connection.stream_id
-                        log.info(msg)
-                        self.connection.publish(self._client_id)
-                        if config.DEBUG_MODE:
-                            self.console_write(COLOR['white'], msg)
-                        continue
-
-                    amf0_cmd = amf0_data['command']
-                    cmd = amf0_cmd[0]
-                    iparam0 = 0
-
-                    if cmd == '_result':
-                        self.on_result(amf0_cmd)
-
-                    elif cmd == '_error':
-                        self.on_error(amf0_cmd)
-
-                    elif cmd == 'onBWDone':
-                        self.on_bwdone()
-
-                    elif cmd == 'onStatus':
-                        self.on_status(amf0_cmd)
-
-                    elif cmd == 'registered':
-                        client_info_dict = amf0_cmd[3]
-                        self.on_registered(client_info_dict)
-
-                    elif cmd == 'join':
-                        join_info = amf0_cmd[3]
-                        threading.Thread(target=self.on_join, args=(join_info,)).start()
-
-                    elif cmd == 'joins':
-                        current_room_users_info_list = amf0_cmd[3:]
-                        if len(current_room_users_info_list) is not 0:
-                            while iparam0 < len(current_room_users_info_list):
-                                self.on_joins(current_room_users_info_list[iparam0])
-                                iparam0 += 1
-
-                    elif cmd == 'joinsdone':
-                        self.on_joinsdone()
-
-                    elif cmd == 'oper':
-                        oper_id_name = amf0_cmd[3:]
-                        while iparam0 < len(oper_id_name):
-                            oper_id = str(int(oper_id_name[iparam0]))
-                            oper_name = oper_id_name[iparam0 + 1]
-                            if len(oper_id) == 1:
-                                self.on_oper(oper_id[0], oper_name)
-                            iparam0 += 2
-
-                    elif cmd == 'deop':
-                        deop_id = amf0_cmd[3]
-                        deop_nick = amf0_cmd[4]
-                        self.on_deop(deop_id, deop_nick)
-
-                    # elif cmd == 'owner':
-                    #     self.on_owner()
-
-                    elif cmd == 'avons':
-                        avons_id_name = amf0_cmd[4:]
-                        if len(avons_id_name) is not 0:
-                            while iparam0 < len(avons_id_name):
-                                avons_id = avons_id_name[iparam0]
-                                avons_name = avons_id_name[iparam0 + 1]
-                                self.on_avon(avons_id, avons_name)
-                                iparam0 += 2
-
-                    elif cmd == 'pros':
-                        pro_ids = amf0_cmd[4:]
-                        if len(pro_ids) is not 0:
-                            for pro_id in pro_ids:
-                                pro_id = str(int(pro_id))
-                                self.on_pro(pro_id)
-
-                    elif cmd == 'nick':
-                        old_nick = amf0_cmd[3]
-                        new_nick = amf0_cmd[4]
-                        nick_id = int(amf0_cmd[5])
-                        self.on_nick(old_nick, new_nick, nick_id)
-
-                    elif cmd == 'nickinuse':
-                        self.on_nickinuse()
-
-                    elif cmd == 'quit':
-                        quit_name = amf0_cmd[3]
-                        quit_id = amf0_cmd[4]
-                        self.on_quit(quit_id, quit_name)
-
-                    elif cmd == 'kick':
-                        kick_id = amf0_cmd[3]
-                        kick_name = amf0_cmd[4]
-                        self.on_kick(kick_id, kick_name)
-
-                    elif cmd == 'banned':
-                        self.on_banned()
-
-                    elif cmd == 'banlist':
-                        banlist_id_nick = amf0_cmd[3:]
-                        if len(banlist_id_nick) is not 0:
-                            while iparam0 < len(banlist_id_nick):
-                                banned_id = banlist_id_nick[iparam0]
-                                banned_nick = banlist_id_nick[iparam0 + 1]
-                                self.on_banlist(banned_id, banned_nick)
-                                iparam0 += 2
-
-                    elif cmd == 'startbanlist':
-                        # print(amf0_data)
-                        pass
-
-                    elif cmd == 'topic':
-                        topic = amf0_cmd[3]
-                        self.on_topic(topic)
-
-                    elif cmd == 'from_owner':
-                        owner_msg = amf0_cmd[3]
-                        self.on_from_owner(owner_msg)
-
-                    elif cmd == 'doublesignon':
-                        self.on_doublesignon()
-
-                    elif cmd == 'privmsg':
-                        raw_msg = amf0_cmd[4]
-                        msg_color = amf0_cmd[5]
-                        msg_sender = amf0_cmd[6]
-                        self.on_privmsg(msg_sender, raw_msg, msg_color)
-
-                    elif cmd == 'notice':
-                        notice_msg = amf0_cmd[3]
-                        notice_msg_id = amf0_cmd[4]
-                        if notice_msg == 'avon':
-                            avon_name = amf0_cmd[5]
-                            self.on_avon(notice_msg_id, avon_name)
-                        elif notice_msg == 'pro':
-                            self.on_pro(notice_msg_id)
-
-                    elif cmd == 'gift':
-                        gift_to = amf0_cmd[3]
-                        gift_sender = amf0_data[4]
-                        gift_info = amf0_data[5]
-                        self.on_gift(gift_sender, gift_to, gift_info)
-
-                    else:
-                        self.console_write(COLOR['bright_red'], 'Unknown command: %s' % cmd)
-
-            except Exception as ex:
-                log.error('general callback error: %s' % ex, exc_info=True)
-                if config.DEBUG_MODE:
-                    traceback.print_exc()
+                self.amf_handler(amf0_data)
+
+    def amf_handler(self, amf0_data):
+        """ Handle a packet from the RTMP application.
+
+        :param amf0_data: The decoded packet.
+        :type amf0_data: dict
+        """
+        try:
+            if amf0_data['msg'] == rtmp.rtmp_type.DT_COMMAND:
+
+                create_stream_res = self.connection.is_create_stream_response(amf0_data)
+                if create_stream_res:
+                    msg = 'create stream response, stream_id: %s' % self.connection.stream_id
+                    log.info(msg)
+                    self.connection.publish(self._client_id)
+                    if config.DEBUG_MODE:
+                        self.console_write(COLOR['white'], msg)
+                    return
+
+                amf0_cmd = amf0_data['command']
+                handler = self._command_handlers.get(amf0_cmd[0])
+                if handler is not None:
+                    handler(amf0_cmd)
+                else:
+                    self.console_write(COLOR['bright_red'], 'Unknown command: %s' % amf0_cmd[0])
+
+        except Exception as ex:
+            log.error('general callback error: %s' % ex, exc_info=True)
+            if config.DEBUG_MODE:
+                traceback.print_exc()
+
+    def _build_command_handlers(self):
+        """ Create the tables of handlers for the commands of the RTMP applications.
+
+        The handlers are bound to this instance, and take the decoded command
+        (name, transaction id, command object, arguments..).
+        """
+        self._command_handlers = {
+            '_result': self.on_result,
+            '_error': self.on_error,
+            'onBWDone': _unpack(self.on_bwdone),
+            'onStatus': self.on_status,
+            'registered': self._handle_registered,
+            'join': self._handle_join,
+            'joins': self._handle_joins,
+            'joinsdone': _unpack(self.on_joinsdone),
+            'oper': self._handle_oper,
+            'deop': _unpack(self.on_deop, 3, 4),
+            'avons': self._handle_avons,
+            'pros': self._handle_pros,
+            'nick': self._handle_nick,
+            'nickinuse': _unpack(self.on_nickinuse),
+            'quit': _unpack(self.on_quit, 4, 3),
+            'kick': _unpack(self.on_kick, 3, 4),
+            'banned': _unpack(self.on_banned),
+            'banlist': self._handle_banlist,
+            'startbanlist': _unpack(lambda: None),
+            'topic': _unpack(self.on_topic, 3),
+            'from_owner': _unpack(self.on_from_owner, 3),
+            'doublesignon': _unpack(self.on_doublesignon),
+            'privmsg': _unpack(self.on_privmsg, 6, 4, 5),
+            'notice': self._handle_notice,
+            'gift': _unpack(self.on_gift, 4, 3, 5)
+        }
+        self._green_command_handlers = {
+            '_result': lambda amf0_cmd: self.on_result(amf0_cmd, greenroom=True),
+            '_error': lambda amf0_cmd: self.on_error(amf0_cmd, greenroom=True),
+            'notice': lambda amf0_cmd: self._handle_notice(amf0_cmd, greenroom=True)
+        }
+
+    def register_command(self, cmd, handler, greenroom=False):
+        """ Register a handler for a command, replacing the current handler of the command.
+
+        Usage:
+            def on_custom(amf0_cmd):
+                print(amf0_cmd[3])
+            client.register_command('custom', on_custom)
+
+        :param cmd: The name of the command.
+        :type cmd: str
+        :param handler: Callable taking the decoded command (name, transaction id, command object, arguments..)
+        :param greenroom: Register the handler for the greenroom RTMP application.
+        :type greenroom: bool
+        """
+        if greenroom:
+            self._green_command_handlers[cmd] = handler
+        else:
+            self._command_handlers[cmd] = handler
+
+    def unregister_command(self, cmd, greenroom=False):
+        """ Remove the handler of a command.
+
+        :param cmd: The name of the command.
+        :type cmd: str
+        :param greenroom: Remove the handler for the greenroom RTMP application.
+        :type greenroom: bool
+        :return: The removed handler, or None if the command had no handler.
+        """
+        if greenroom:
+            return self._green_command_handlers.pop(cmd, None)
+        return self._command_handlers.pop(cmd, None)
+
+    def _handle_registered(self, amf0_cmd):
+        client_info_dict = amf0_cmd[3]
+        if self.connection_pool is None:
+            self.on_registered(client_info_dict)
+        else:
+            # fetches the captcha key, keep it off the event loop.
+            self.api_workers.submit(self.on_registered, client_info_dict)
+
+    def _handle_join(self, amf0_cmd):
+        join_info = amf0_cmd[3]
+        # the join checks are quick, the account lookup is submitted to the api workers by on_join.
+        self.mod_workers.submit(self.on_join, join_info)
+
+    def _handle_joins(self, amf0_cmd):
+        for joins_info in amf0_cmd[3:]:
+            self.on_joins(joins_info)
+
+    def _handle_oper(self, amf0_cmd):
+        oper_id_name = amf0_cmd[3:]
+        for i in range(0, len(oper_id_name) - 1, 2):
+            oper_id = str(int(oper_id_name[i]))
+            if len(oper_id) == 1:
+                self.on_oper(oper_id[0], oper_id_name[i + 1])
+
+    def _handle_avons(self, amf0_cmd):
+        avons_id_name = amf0_cmd[4:]
+        for i in range(0, len(avons_id_name) - 1, 2):
+            self.on_avon(avons_id_name[i], avons_id_name[i + 1])
+
+    def _handle_pros(self, amf0_cmd):
+        for pro_id in amf0_cmd[4:]:
+            self.on_pro(str(int(pro_id)))
+
+    def _handle_nick(self, amf0_cmd):
+        self.on_nick(amf0_cmd[3], amf0_cmd[4], int(amf0_cmd[5]))
+
+    def _handle_banlist(self, amf0_cmd):
+        banlist_id_nick = amf0_cmd[3:]
+        for i in range(0, len(banlist_id_nick) - 1, 2):
+            self.on_banlist(banlist_id_nick[i], banlist_id_nick[i + 1])
+
+    def _handle_notice(self, amf0_cmd, greenroom=False):
+        notice_msg = amf0_cmd[3]
+        notice_msg_id = amf0_cmd[4]
+        if notice_msg == 'avon':
+            self.on_avon(notice_msg_id, amf0_cmd[5], greenroom=greenroom)
+        elif notice_msg == 'pro' and not greenroom:
+            self.on_pro(notice_msg_id)
+
+    def _pool_message(self, connection, amf0_data):
+        """ Called by the event loop of the connection pool with every packet. """
+        if connection is self.connection:
+            self.amf_handler(amf0_data)
+        elif connection is self.green_connection:
+            self.green_amf_handler(amf0_data)
+
+    def _pool_connect(self, connection):
+        """ Called by the event loop of the connection pool once a connection can make calls. """
+        queue = self._send_queue
+        if connection is self.connection and queue is not None and queue.client is connection:
+            queue.start()
+
+    def _pool_close(self, connection):
+        """ Called by the event loop of the connection pool when a connection is lost. """
+        # reconnecting blocks, keep it off the event loop.
+        if connection is self.connection and self.is_connected:
+            threading.Thread(target=self.reconnect).start()
+        elif connection is self.green_connection and self.is_green_connected:
+            threading.Thread(target=self.reconnect, kwargs={'greenroom': True}).start()
 
     # Callback Event Methods.
     def on_result(self, result_info, greenroom=False):
@@ -588,10 +731,7 @@ class TinychatRTMPClient(object):
         _user = self.users.add(join_info)
         if _user is not None:
             if _user.account:
-                tc_info = apis.tinychat.user_info(_user.account)
-                if tc_info is not None:
-                    _user.tinychat_id = tc_info['tinychat_id']
-                    _user.last_login = tc_info['last_active']
+                self.api_workers.submit(self.lookup_user_info, _user)
                 if _user.is_owner:
                     _user.user_level = 1
                     self.console_write(COLOR['red'], 'Room Owner %s:%d:%s' %
@@ -609,6 +749,19 @@ class TinychatRTMPClient(object):
         else:
             log.warning('user join: %s' % _user)
 
+    def lookup_user_info(self, _user):
+        """ Look up the tinychat id and last login of a user with an account.
+
+        This blocks on a web API lookup, submit it to the api workers.
+
+        :param _user: The user.
+        :type _user: user.User
+        """
+        tc_info = apis.tinychat.user_info(_user.account)
+        if tc_info is not None:
+            _user.tinychat_id = tc_info['tinychat_id']
+            _user.last_login = tc_info['last_active']
+
     def on_joins(self, joins_info):
         """ Application message received for every user in the room when the client joins the room.
 
@@ -852,8 +1005,7 @@ class TinychatRTMPClient(object):
                     if len(msg_cmd) == 4:
                         media_type = msg_cmd[1]
                         media_id = msg_cmd[2]
-                        threading.Thread(target=self.on_media_broadcast_start,
-                                         args=(media_type, media_id, msg_sender,)).start()
+                        self.api_workers.submit(self.on_media_broadcast_start, media_type, media_id, msg_sender)
 
             elif msg_cmd[0] == '/mbc':
                 if self.active_user.is_mod:
@@ -965,15 +1117,33 @@ class TinychatRTMPClient(object):
                            (usr_nick, media_type, time_point))
 
     # Message Methods.
+    def _send(self, calls, priority=send_queue.PRIORITY_CHAT):
+        """ Queue calls on the send queue of the connection, they are sent together.
+
+        Without a send queue the calls are sent right away.
+
+        :param calls: The calls as (process name, parameters) tuples.
+        :type calls: list
+        :param priority: The send_queue.PRIORITY_* of the calls.
+        :type priority: int
+        """
+        queue = self._send_queue
+        if queue is not None:
+            queue.put(calls, priority)
+        else:
+            with self.connection.batch():
+                for process_name, parameters in calls:
+                    self.connection.call(process_name, parameters)
+
     def send_bauth_msg(self):
         """ Get and send the bauth key needed before we can start a broadcast. """
         if self._bauth_key is not None:
-            self.connection.call('bauth', [u'' + self._bauth_key])
+            self._send([('bauth', [u'' + self._bauth_key])], send_queue.PRIORITY_CONTROL)
         else:
             _token = self.param.get_broadcast_token(self.nickname, self._client_id)
             if _token != 'PW':
                 self._bauth_key = _token
-                self.connection.call('bauth', [u'' + _token])
+                self._send([('bauth', [u'' + _token])], send_queue.PRIORITY_CONTROL)
 
     def send_cauth_msg(self, cauthkey):
         """ Send the cauth message, we need to send this before we can chat.
@@ -981,7 +1151,7 @@ class TinychatRTMPClient(object):
         :param cauthkey: The cauth key.
         :type cauthkey: str
         """
-        self.connection.call('cauth', [u'' + cauthkey])
+        self._send([('cauth', [u'' + cauthkey])], send_queue.PRIORITY_CONTROL)
 
     def send_owner_run_msg(self, msg):
         """ Send owner run message.
@@ -991,7 +1161,7 @@ class TinychatRTMPClient(object):
         """
         if self.is_client_mod:
             msg = string_util.quote_str(msg)
-            self.connection.call('owner_run', [u'notice' + msg])
+            self._send([('owner_run', [u'notice' + msg])], send_queue.PRIORITY_CHAT)
 
     def send_cam_approve_msg(self, nick, uid=None):
         """ Send cam approval message.
@@ -1007,19 +1177,21 @@ class TinychatRTMPClient(object):
             if uid is None:
                 _user = self.users.search(nick)
                 if _user is not None:
-                    self.connection.call('privmsg', [u'' + self._encode_msg(msg), u'#0,en',
-                                                     u'n' + str(_user.id) + '-' + nick])
+                    self._send([('privmsg', [u'' + self._encode_msg(msg), u'#0,en',
+                                             u'n' + str(_user.id) + '-' + nick])], send_queue.PRIORITY_MODERATION)
             else:
-                self.connection.call('privmsg',
-                                     [u'' + self._encode_msg(msg), u'#0,en', u'n' + str(uid) + '-' + nick])
+                self._send([('privmsg', [u'' + self._encode_msg(msg), u'#0,en',
+                                         u'n' + str(uid) + '-' + nick])], send_queue.PRIORITY_MODERATION)
 
-    def send_chat_msg(self, msg):
+    def send_chat_msg(self, msg, priority=send_queue.PRIORITY_CHAT):
         """  Send a chat room message.
 
         :param msg: The message to send.
         :type msg: str
+        :param priority: The send_queue.PRIORITY_* of the message.
+        :type priority: int
         """
-        self.connection.call('privmsg', [u'' + self._encode_msg(msg), u'#262626,en'])
+        self._send([('privmsg', [u'' + self._encode_msg(msg), u'#262626,en'])], priority)
 
     def send_private_msg(self, msg, nick):
         """ Send a private message.
@@ -1031,10 +1203,10 @@ class TinychatRTMPClient(object):
         """
         _user = self.users.search(nick)
         if _user is not None:
-            self.connection.call('privmsg', [u'' + self._encode_msg('/msg ' + nick + ' ' + msg),
-                                             u'#262626,en', u'n' + str(_user.id) + '-' + nick])
-            self.connection.call('privmsg', [u'' + self._encode_msg('/msg ' + nick + ' ' + msg),
-                                             u'#262626,en', u'b' + str(_user.id) + '-' + nick])
+            self._send([('privmsg', [u'' + self._encode_msg('/msg ' + nick + ' ' + msg),
+                                     u'#262626,en', u'n' + str(_user.id) + '-' + nick]),
+                        ('privmsg', [u'' + self._encode_msg('/msg ' + nick + ' ' + msg),
+                                     u'#262626,en', u'b' + str(_user.id) + '-' + nick])])
 
     def send_userinfo_request_msg(self, user_id):
         """ Send user info request to a user.
@@ -1042,9 +1214,9 @@ class TinychatRTMPClient(object):
         :param user_id: User id of the user we want info from.
         :type user_id: str
         """
-        self.connection.call('account', [u'' + str(user_id)])
+        self._send([('account', [u'' + str(user_id)])], send_queue.PRIORITY_MODERATION)
 
-    def send_undercover_msg(self, nick, msg, use_b=True, use_n=True):
+    def send_undercover_msg(self, nick, msg, use_b=True, use_n=True, priority=send_queue.PRIORITY_CHAT):
         """ Send a 'undercover' message.
 
         This is a special message that appears in the main chat, but is only visible to the user it is sent to.
@@ -1056,22 +1228,25 @@ class TinychatRTMPClient(object):
         :type msg: str
         :param use_b:
         :param use_n:
+        :param priority: The send_queue.PRIORITY_* of the message.
+        :type priority: int
         """
         _user = self.users.search(nick)
         if _user is not None:
+            calls = []
             if use_b:
-                self.connection.call('privmsg', [u'' + self._encode_msg(msg),
-                                                 '#0,en', u'b' + str(_user.id) + '-' + nick])
+                calls.append(('privmsg', [u'' + self._encode_msg(msg), '#0,en', u'b' + str(_user.id) + '-' + nick]))
             if use_n:
-                self.connection.call('privmsg', [u'' + self._encode_msg(msg),
-                                                 '#0,en', u'n' + str(_user.id) + '-' + nick])
+                calls.append(('privmsg', [u'' + self._encode_msg(msg), '#0,en', u'n' + str(_user.id) + '-' + nick]))
+            if calls:
+                self._send(calls, priority)
 
     def set_nick(self):
         """ Send the nick message. """
         if not self.nickname:
             self.nickname = string_util.create_random_string(5, 25)
         self.console_write(COLOR['bright_magenta'], 'Setting nick: %s' % self.nickname)
-        self.connection.call('nick', [u'' + self.nickname])
+        self._send([('nick', [u'' + self.nickname])], send_queue.PRIORITY_CONTROL)
 
     def send_ban_msg(self, nick, uid=None):
         """ Send ban message.
@@ -1085,9 +1260,9 @@ class TinychatRTMPClient(object):
             if uid is None:
                 _user = self.users.search(nick)
                 if _user is not None:
-                    self.connection.call('kick', [u'' + nick, str(_user.id)])
+                    self._send([('kick', [u'' + nick, str(_user.id)])], send_queue.PRIORITY_MODERATION)
             else:
-                self.connection.call('kick', [u'' + nick, str(uid)])
+                self._send([('kick', [u'' + nick, str(uid)])], send_queue.PRIORITY_MODERATION)
 
     def send_forgive_msg(self, uid):
         """ Send forgive message.
@@ -1096,14 +1271,14 @@ class TinychatRTMPClient(object):
         :type uid: int | str
         """
         if self.is_client_mod:
-            self.connection.call('forgive', [u'' + str(uid)])
+            self._send([('forgive', [u'' + str(uid)])], send_queue.PRIORITY_MODERATION)
             # get the updated ban list.
             self.send_banlist_msg()
 
     def send_banlist_msg(self):
         """ Send ban list message. """
         if self.is_client_mod:
-            self.connection.call('banlist')
+            self._send([('banlist', None)], send_queue.PRIORITY_MODERATION)
 
     def send_topic_msg(self, topic):
         """ Send a room topic message.
@@ -1112,7 +1287,7 @@ class TinychatRTMPClient(object):
         :type topic: str
         """
         if self.is_client_mod:
-            self.connection.call('topic', [u'' + topic])
+            self._send([('topic', [u'' + topic])], send_queue.PRIORITY_MODERATION)
 
     def send_close_user_msg(self, nick):
         """ Send close user broadcast message.
@@ -1121,7 +1296,7 @@ class TinychatRTMPClient(object):
         :type nick: str
         """
         if self.is_client_mod:
-            self.connection.call('owner_run', [u'_close' + nick])
+            self._send([('owner_run', [u'_close' + nick])], send_queue.PRIORITY_MODERATION)
 
     # Media Message Functions
     def send_media_broadcast_start(self, media_type, video_id, time_point=0, private_nick=None):
@@ -1138,9 +1313,9 @@ class TinychatRTMPClient(object):
         """
         mbs_msg = '/mbs %s %s %s' % (media_type, video_id, time_point)
         if private_nick is not None:
-            self.send_undercover_msg(private_nick, mbs_msg)
+            self.send_undercover_msg(private_nick, mbs_msg, priority=send_queue.PRIORITY_MEDIA)
         else:
-            self.send_chat_msg(mbs_msg)
+            self.send_chat_msg(mbs_msg, priority=send_queue.PRIORITY_MEDIA)
 
     def send_media_broadcast_close(self, media_type, private_nick=None):
         """ Close a media broadcast.
@@ -1152,9 +1327,9 @@ class TinychatRTMPClient(object):
         """
         mbc_msg = '/mbc %s' % media_type
         if private_nick is not None:
-            self.send_undercover_msg(private_nick, mbc_msg)
+            self.send_undercover_msg(private_nick, mbc_msg, priority=send_queue.PRIORITY_MEDIA)
         else:
-            self.send_chat_msg(mbc_msg)
+            self.send_chat_msg(mbc_msg, priority=send_queue.PRIORITY_MEDIA)
 
     def send_media_broadcast_play(self, media_type, time_point, private_nick=None):
         """ Play a currently paused media broadcast.
@@ -1168,9 +1343,9 @@ class TinychatRTMPClient(object):
         """
         mbpl_msg = '/mbpl %s %s' % (media_type, time_point)
         if private_nick is not None:
-            self.send_undercover_msg(private_nick, mbpl_msg)
+            self.send_undercover_msg(private_nick, mbpl_msg, priority=send_queue.PRIORITY_MEDIA)
         else:
-            self.send_chat_msg(mbpl_msg)
+            self.send_chat_msg(mbpl_msg, priority=send_queue.PRIORITY_MEDIA)
 
     def send_media_broadcast_pause(self, media_type, private_nick=None):
         """ Pause a currently playing media broadcast.
@@ -1182,9 +1357,9 @@ class TinychatRTMPClient(object):
         """
         mbpa_msg = '/mbpa %s' % media_type
         if private_nick is not None:
-            self.send_undercover_msg(private_nick, mbpa_msg)
+            self.send_undercover_msg(private_nick, mbpa_msg, priority=send_queue.PRIORITY_MEDIA)
         else:
-            self.send_chat_msg(mbpa_msg)
+            self.send_chat_msg(mbpa_msg, priority=send_queue.PRIORITY_MEDIA)
 
     def send_media_broadcast_skip(self, media_type, time_point, private_nick=None):
         """ Time search a currently playing/paused media broadcast.
@@ -1198,9 +1373,9 @@ class TinychatRTMPClient(object):
         """
         mbsk_msg = '/mbsk %s %s' % (media_type, time_point)
         if private_nick is not None:
-            self.send_undercover_msg(private_nick, mbsk_msg)
+            self.send_undercover_msg(private_nick, mbsk_msg, priority=send_queue.PRIORITY_MEDIA)
         else:
-            self.send_chat_msg(mbsk_msg)
+            self.send_chat_msg(mbsk_msg, priority=send_queue.PRIORITY_MEDIA)
 
     # Helper Methods
     def get_runtime(self, milliseconds=True):
@@ -1259,12 +1434,78 @@ class TinychatRTMPClient(object):
                         # if it is not enabled anymore.
                         self.disconnect(greenroom=True)
             log.debug('recv configuration: %s' % self.param.config_dict)
-        self.start_auto_job_timer()
 
     def start_auto_job_timer(self):
         """
         Just like using tinychat with a browser, this method will
         fetch the room config from tinychat API every 5 minute(300 seconds)(default).
         See line 228 at http://tinychat.com/embed/chat.js
+
+        The timer fires on the scheduler thread, the config is fetched by the api workers.
+        """
+        if self._auto_job_timer is not None:
+            self._auto_job_timer.cancel()
+        self._auto_job_timer = self.scheduler.call_every(config.AUTO_JOB_INTERVAL,
+                                                         self.api_workers.submit, self.auto_job_handler)
+
+
+class RoomPool(object):
+    """
+    Runs the connections of many rooms from one process, on the single event loop
+    of a rtmplib connection pool instead of a thread per connection.
+
+    Usage:
+        room_pool = RoomPool()
+        room_pool.start()
+        room_pool.add(tinybot.TinychatBot(roomname='room1', connection_pool=room_pool.connection_pool))
+    """
+    def __init__(self, connection_pool=None):
+        """ Create a instance of the RoomPool class.
+
+        :param connection_pool: The connection pool to use, a new pool is created if None.
+        :type connection_pool: rtmplib.pool.ConnectionPool | None
+        """
+        self.connection_pool = connection_pool or pool.ConnectionPool()
+        self.rooms = {}
+
+    def start(self):
+        """ Start the event loop. """
+        self.connection_pool.start()
+
+    def add(self, room):
+        """ Set the RTMP parameters of a room and connect it.
+
+        This blocks while the RTMP parameters are fetched, the connection is made by the event loop.
+
+        :param room: The room client, created with the connection pool of this room pool.
+        :type room: TinychatRTMPClient
+        :return: True if the room is connecting, False if the RTMP parameters could not be set.
+        :rtype: bool
+        """
+        if room.connection_pool is not self.connection_pool:
+            raise ValueError('room %s does not use the connection pool of this room pool.' % room.roomname)
+        self.rooms[room.roomname] = room
+        status = room.set_rtmp_parameters()
+        if status != 3:
+            log.error('failed to set rtmp parameters for %s, %s' % (room.roomname, status))
+            return False
+        room.connect()
+        return True
+
+    def remove(self, room_name):
+        """ Disconnect a room and remove it from the pool.
+
+        :param room_name: The name of the room.
+        :type room_name: str
         """
-        threading.Timer(config.AUTO_JOB_INTERVAL, self.auto_job_handler).start()
+        room = self.rooms.pop(room_name, None)
+        if room is not None:
+            if room.is_green_connected:
+                room.disconnect(greenroom=True)
+            room.disconnect()
+
+    def stop(self):
+        """ Disconnect all rooms and stop the event loop. """
+        for room_name in list(self.rooms):
+            self.remove(room_name)
+        self.connection_pool.stop()
@@ -0,0 +1,395 @@
+"""
+An event driven RTMP client.
+
+The client uses a non blocking socket driven by asyncore, so a single event loop
+can serve many connections without a thread per connection. Incoming bytes are
+parsed with the push style RtmpParser, and outgoing messages are queued and written
+whenever the socket is writable.
+
+asyncio is not available on python 2.7, asyncore is the standard library event loop
+used instead. Run the loop with asyncore.loop(map=client.sock_map)
+"""
+import asyncore
+import collections
+import logging
+import socket
+import threading
+import time
+
+import pyamf.util.pure
+
+from . import handshake, reader, writer, rtmp, socks
+
+log = logging.getLogger(__name__)
+
+# connection states.
+STATE_CLOSED = 0
+STATE_CONNECTING = 1
+STATE_HANDSHAKE = 2
+STATE_CONNECTED = 3
+STATE_PROXY = 4
+
+
+class OutgoingStream(pyamf.util.pure.DataTypeMixIn):
+    """
+    A write only stream collecting the bytes written by a RtmpWriter.
+
+    On flush the collected bytes are handed to the connection's send queue.
+    """
+    def __init__(self, client):
+        self.client = client
+        self._pending = []
+        pyamf.util.pure.DataTypeMixIn.__init__(self)
+
+    def write(self, data):
+        self._pending.append(data)
+
+    def flush(self):
+        if self._pending:
+            if len(self._pending) == 1:
+                data = self._pending[0]
+            else:
+                data = ''.join(str(part) for part in self._pending)
+            self._pending = []
+            self.client.send_bytes(data)
+
+    @staticmethod
+    def at_eof():
+        return False
+
+
+class RtmpDispatcher(asyncore.dispatcher):
+    """ Forwards the socket events of the event loop to a AsyncRtmpClient. """
+    def __init__(self, client, sock_map=None):
+        asyncore.dispatcher.__init__(self, map=sock_map)
+        self.client = client
+
+    def handle_connect(self):
+        self.client.connection_made()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.client.data_received(data)
+
+    def writable(self):
+        # while connecting, the socket must be polled for writing to detect the connect.
+        return not self.connected or self.client.has_outgoing()
+
+    def handle_write(self):
+        self.client.send_pending()
+
+    def handle_close(self):
+        self.close()
+        self.client.connection_lost()
+
+    def handle_error(self):
+        log.error('dispatcher error for %s:%s' % (self.client.ip, self.client.port), exc_info=True)
+        self.handle_close()
+
+
+class AsyncRtmpClient(rtmp.RtmpClient):
+    """ Represents an event driven RTMP client. """
+    def __init__(self, ip, port, tc_url, app, **kwargs):
+        """ Initialize a new event driven RTMP client.
+
+        Takes the same keyword arguments as RtmpClient, and additionally:
+        sock_map: The asyncore socket map of the event loop, None uses the default map.
+        on_message: Callable called with the client and every decoded message,
+        if None the messages are queued and can be read with poll()
+        on_close: Callable called with the client when the connection is lost.
+        on_connect: Callable called with the client once the handshake is done and the connect
+        command has been sent, from then on calls can be made.
+        """
+        rtmp.RtmpClient.__init__(self, ip, port, tc_url, app, **kwargs)
+        self.sock_map = kwargs.get('sock_map')
+        self.on_message = kwargs.get('on_message')
+        self.on_close = kwargs.get('on_close')
+        self.on_connect = kwargs.get('on_connect')
+        self.state = STATE_CLOSED
+        self.messages = collections.deque()
+        self.dispatcher = None
+        # the seconds each phase of the proxy negotiation took.
+        self.proxy_timings = {}
+
+        self._negotiator = None
+        self._connect_started = None
+        # the time a connect through a proxy of a proxy pool times out, None without a deadline.
+        self._connect_deadline = None
+        # the proxies of the pool tried by the current connect.
+        self._tried_proxies = []
+        self._connect_params = None
+        self._handshake_buffer = ''
+        self._outgoing = collections.deque()
+        self._outgoing_lock = threading.Lock()
+
+    def connect(self, connect_params=None):
+        """ Start connecting to the remote server.
+
+        This returns immediately, the handshake and the NetConnection connect
+        are completed by the event loop.
+
+        With a proxy pool, each proxy gets the timeout of the pool to connect, checked
+        by check_timeout. The next proxy is tried when a proxy fails, up to the
+        max_attempts of the pool.
+
+        :param connect_params: A list or dict containing application specific connect parameters
+        :type connect_params: list | dict
+        :raises GeneralProxyError if the proxy pool has no proxy to use.
+        """
+        self._connect_params = connect_params
+        self._tried_proxies = []
+        self._open()
+
+    def _open(self):
+        """ Open the socket to the remote server, or to the next proxy. """
+        self._connect_deadline = None
+        if self.proxy is not None:
+            if self._select_proxy(exclude=self._tried_proxies) is None:
+                raise socks.GeneralProxyError('no proxy in %s' % self.proxy)
+            self._tried_proxies.append(self.active_proxy)
+
+        self._handshake_buffer = ''
+        self._outgoing.clear()
+
+        self.stream = OutgoingStream(self)
+        self.reader = reader.RtmpParser()
+        self.writer = writer.RtmpWriter(self.stream)
+
+        self.dispatcher = RtmpDispatcher(self, self.sock_map)
+        self.dispatcher.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket = self.dispatcher.socket
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.is_win:
+            self.socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 10000, 3000))
+
+        self.state = STATE_CONNECTING
+        self._negotiator = None
+        self._connect_started = time.time()
+        if self.proxy is not None:
+            if self._is_proxy_pool():
+                self._connect_deadline = self._connect_started + self.proxy.timeout
+            self.dispatcher.connect(self._proxy_address())
+        else:
+            self.dispatcher.connect((self.ip, self.port))
+
+    def connection_made(self):
+        """ Called by the event loop when the socket is connected.
+        Starts the proxy negotiation, or sends C0 and C1.
+        """
+        if self.proxy is not None:
+            log.debug('connected to proxy %s, negotiating' % self.active_proxy)
+            self.proxy_timings = {'connect': time.time() - self._connect_started}
+            self._negotiator = socks.ProxyNegotiator(socks.HTTP, self.ip, self.port)
+            self.state = STATE_PROXY
+            self.send_bytes(self._negotiator.data_to_send())
+            return
+        self._start_handshake()
+
+    def _start_handshake(self):
+        """ Send C0 and C1. """
+        log.debug('connected to %s:%s, starting handshake' % (self.ip, self.port))
+        self.state = STATE_HANDSHAKE
+        self.handshake_metrics = handshake.HandshakeMetrics()
+        self.send_bytes(handshake.create_c0c1())
+        self.handshake_metrics.c0c1_sent = time.time()
+
+    def data_received(self, data):
+        """ Called by the event loop with the bytes received from the remote server.
+
+        :param data: The received bytes.
+        :type data: str
+        """
+        self.bytes_received += len(data)
+        if self.state == STATE_PROXY:
+            try:
+                self._negotiator.feed(data)
+            except socks.ProxyError as pe:
+                log.error('proxy negotiation with %s failed: %s' % (self.active_proxy, pe))
+                self.dispatcher.handle_close()
+                return
+            pending = self._negotiator.data_to_send()
+            if pending:
+                self.send_bytes(pending)
+            if not self._negotiator.done:
+                return
+            self.proxy_timings.update(self._negotiator.timings)
+            self._connect_deadline = None
+            self._report_proxy(time.time() - self._connect_started)
+            log.debug('connected through proxy %s %s' % (self.active_proxy, self.proxy_timings))
+            data = self._negotiator.remainder
+            self._negotiator = None
+            # the proxy response does not count towards the acknowledgements.
+            self.bytes_received = len(data)
+            self._start_handshake()
+            if not data:
+                return
+
+        if self.state == STATE_HANDSHAKE:
+            self._handshake_buffer += data
+            if self.pipeline and self.handshake_metrics.c2_sent is None \
+                    and len(self._handshake_buffer) >= handshake.C0_C1_LENGTH:
+                # send C2 and the connect sequence in one write, without waiting for S2.
+                self.handshake_metrics.s0s1_received = time.time()
+                self._queue_calls()
+                self.stream.write(handshake.create_c2(self._handshake_buffer))
+                self._connect_rtmp(self._connect_params)
+                self.handshake_metrics.c2_sent = time.time()
+                self._connect_sent()
+
+            if len(self._handshake_buffer) < handshake.S0_S1_S2_LENGTH:
+                return
+            self.handshake_metrics.s0s1s2_received = time.time()
+            data = self._handshake_buffer[handshake.S0_S1_S2_LENGTH:]
+            if self.handshake_metrics.c2_sent is None:
+                self.handshake_metrics.s0s1_received = self.handshake_metrics.s0s1s2_received
+                self.send_bytes(handshake.create_c2(self._handshake_buffer))
+                self.handshake_metrics.c2_sent = time.time()
+                self._connect_rtmp(self._connect_params)
+                self._connect_sent()
+            self._handshake_buffer = ''
+            self.state = STATE_CONNECTED
+            if not data:
+                return
+
+        for message in self.reader.feed(data):
+            if self.handle:
+                if self.handle_packet(message):
+                    log.debug('handled amf data: %s' % message)
+            self.message_received(message)
+        self.acknowledge()
+
+    def _connect_sent(self):
+        """ Tell on_connect that calls can be made. """
+        if self.on_connect is not None:
+            self.on_connect(self)
+
+    def message_received(self, message):
+        """ Deliver a decoded message to on_message, or queue it for poll().
+
+        :param message: The decoded message.
+        :type message: dict
+        """
+        if self.on_message is not None:
+            self.on_message(self, message)
+        else:
+            self.messages.append(message)
+
+    def poll(self):
+        """ Iterate the messages received so far.
+
+        :return: A generator of decoded messages.
+        """
+        while self.messages:
+            yield self.messages.popleft()
+
+    def connection_lost(self):
+        """ Called by the event loop when the connection was closed. """
+        if self.state == STATE_CLOSED:
+            return
+        if self.proxy is not None and self.state in (STATE_CONNECTING, STATE_PROXY):
+            self._proxy_failed(socks.ProxyConnectionError('connection to proxy %s lost' % self.active_proxy))
+            return
+        log.info('connection to %s:%s lost' % (self.ip, self.port))
+        self.state = STATE_CLOSED
+        self._fail_calls('connection lost')
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def check_timeout(self, now=None):
+        """ Called by the event loop to fail a connect through a proxy that is past its deadline.
+
+        :param now: The current time, None for time.time()
+        :type now: float | None
+        """
+        if self._connect_deadline is None or self.state not in (STATE_CONNECTING, STATE_PROXY):
+            return
+        if (now or time.time()) >= self._connect_deadline:
+            self._connect_deadline = None
+            self._proxy_failed(socks.ProxyConnectionError('connect through proxy %s timed out after %ss'
+                                                          % (self.active_proxy, self.proxy.timeout)))
+
+    def _proxy_failed(self, error):
+        """ Report a failed proxy to the proxy pool, and connect through the next proxy,
+        or fail the connection when no attempt is left.
+
+        :param error: The reason the proxy failed.
+        :type error: Exception
+        """
+        log.warning('connect through proxy %s failed: %s' % (self.active_proxy, error))
+        self._report_proxy()
+        if self.dispatcher is not None and self.dispatcher.socket is not None:
+            self.dispatcher.close()
+        if self._is_proxy_pool() and len(self._tried_proxies) < self.proxy.max_attempts:
+            try:
+                self._open()
+                return
+            except Exception as e:
+                error = e
+        self.connection_failed(error)
+
+    def connection_failed(self, error):
+        """ Called by the event loop when connect() raised, the connection counts as lost.
+
+        :param error: The exception raised by connect()
+        :type error: Exception
+        """
+        log.error('connecting to %s:%s failed: %s' % (self.ip, self.port, error))
+        if self.dispatcher is not None and self.dispatcher.socket is not None:
+            self.dispatcher.close()
+        self.state = STATE_CLOSED
+        self._connect_deadline = None
+        self._fail_calls('connect failed: %s' % error)
+        if self.on_close is not None:
+            self.on_close(self)
+
+    def has_outgoing(self):
+        """ Check if there are bytes waiting to be sent. """
+        return len(self._outgoing) > 0
+
+    def send_bytes(self, data):
+        """ Queue bytes for the remote server, sending as much as the socket accepts right away.
+
+        This may be called from any thread.
+
+        :param data: The bytes to send.
+        :type data: str
+        """
+        with self._outgoing_lock:
+            self._outgoing.append(data)
+        if self.dispatcher is not None and self.dispatcher.connected:
+            self.send_pending()
+
+    def send_pending(self):
+        """ Send queued bytes until the socket would block. """
+        with self._outgoing_lock:
+            while self._outgoing:
+                data = self._outgoing[0]
+                sent = self.dispatcher.send(data)
+                if sent < len(data):
+                    self._outgoing[0] = data[sent:]
+                    break
+                self._outgoing.popleft()
+
+    def amf(self):
+        """ Get the next received message without blocking, like RtmpClient.amf reads the next one.
+
+        The messages are handled by handle_packet as they arrive. Only the messages queued
+        for poll() are returned, with on_message set they are delivered there instead.
+
+        :return: amf data packet, or None if no message is queued.
+        :rtype: message.Message | None
+        :raises AmfDataReadError if the connection is closed and no message is queued.
+        """
+        if self.messages:
+            return self.messages.popleft()
+        if self.state == STATE_CLOSED:
+            raise rtmp.AmfDataReadError('connection to %s:%s is closed' % (self.ip, self.port))
+        return None
+
+    def shutdown(self):
+        """ Closes the socket connection. """
+        self._fail_calls('connection closed')
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        self.state = STATE_CLOSED
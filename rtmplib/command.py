@@ -0,0 +1,174 @@
+"""
+Pre-encoded AMF0 command templates.
+
+A command is encoded as its name, the transaction id, a null command object
+and the arguments. The constant parts of a command, the name and any fixed
+arguments, are encoded once when the template is created. Sending a command
+only encodes the transaction id and the variable arguments, with a fast path
+for strings, numbers, booleans and None. Other values fall back to the
+amf0.Encoder.
+
+Usage:
+    privmsg = CommandTemplate('privmsg', [VARIABLE, u'#262626,en'])
+    client.writer.write(privmsg.message(0, u'hello'))
+"""
+import struct
+import threading
+
+from pyamf import amf0
+import pyamf.util
+
+from . import rtmp_type
+
+# marks the place of a variable argument in the arguments of a template.
+VARIABLE = object()
+
+_DOUBLE = struct.Struct('!d')
+_UINT16 = struct.Struct('!H')
+_UINT32 = struct.Struct('!I')
+
+_NULL = amf0.TYPE_NULL
+_TRUE = amf0.TYPE_BOOL + '\x01'
+_FALSE = amf0.TYPE_BOOL + '\x00'
+
+
+def _encode_number(n):
+    return amf0.TYPE_NUMBER + _DOUBLE.pack(float(n))
+
+
+def _encode_bytes(s):
+    if len(s) > 0xffff:
+        return amf0.TYPE_LONGSTRING + _UINT32.pack(len(s)) + s
+    return amf0.TYPE_STRING + _UINT16.pack(len(s)) + s
+
+
+def _encode_unicode(u):
+    return _encode_bytes(u.encode('utf-8'))
+
+
+_ENCODERS = {
+    unicode: _encode_unicode,
+    str: _encode_bytes,
+    int: _encode_number,
+    long: _encode_number,
+    float: _encode_number,
+    bool: lambda b: _TRUE if b else _FALSE,
+    type(None): lambda n: _NULL
+}
+
+
+def encode_values(values):
+    """
+    Encode values as a sequence of AMF0 elements.
+
+    :param values: The values to encode.
+    :type values: list | tuple
+    :return: The encoded values.
+    :rtype: str
+    """
+    try:
+        return ''.join([_ENCODERS[type(value)](value) for value in values])
+    except KeyError:
+        # objects, lists and such. Encode all values with one encoder so references are shared.
+        stream = pyamf.util.BufferedByteStream()
+        encoder = amf0.Encoder(stream)
+        for value in values:
+            encoder.writeElement(value)
+        return stream.getvalue()
+
+
+class CommandTemplate(object):
+    """ A command with its constant parts pre-encoded. """
+
+    def __init__(self, name, args=None):
+        """
+        Create a command template.
+
+        :param name: The name of the command.
+        :type name: str
+        :param args: The arguments following the command object, VARIABLE marking
+        the arguments given when the command is encoded. None takes any amount of
+        variable arguments.
+        :type args: list | None
+        """
+        self.name = name
+        self._prefix = encode_values([name])
+        # the encoded constant arguments, each followed by a variable argument.
+        # the last segment is the encoded constant arguments at the end of the command.
+        self._segments = None
+        self.variables = None
+        if args is not None:
+            segments = []
+            constants = []
+            for arg in args:
+                if arg is VARIABLE:
+                    segments.append(encode_values(constants))
+                    constants = []
+                else:
+                    constants.append(arg)
+            segments.append(encode_values(constants))
+            self._segments = segments
+            self.variables = len(segments) - 1
+
+    def __repr__(self):
+        return '<CommandTemplate %s>' % self.name
+
+    def encode(self, trans_id, *values):
+        """
+        Encode the command body.
+
+        :param trans_id: The transaction id.
+        :type trans_id: int
+        :param values: The variable arguments.
+        :return: The AMF0 encoded command.
+        :rtype: str
+        :raises ValueError if the amount of values does not match the template.
+        """
+        head = self._prefix + _encode_number(trans_id) + _NULL
+        if self._segments is None:
+            return head + encode_values(values)
+
+        if len(values) != self.variables:
+            raise ValueError('%s takes %s variable arguments, got %s' % (self.name, self.variables, len(values)))
+        parts = [head]
+        for segment, value in zip(self._segments, values):
+            parts.append(segment)
+            parts.append(encode_values([value]))
+        parts.append(self._segments[-1])
+        return ''.join(parts)
+
+    def message(self, trans_id, *values):
+        """
+        Create a message for RtmpWriter.write with a pre-encoded body.
+
+        :return: The message.
+        :rtype: dict
+        """
+        return {
+            'msg': rtmp_type.DT_COMMAND,
+            'name': self.name,
+            'body': self.encode(trans_id, *values)
+        }
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(name):
+    """
+    Get the cached template of a command taking any arguments.
+
+    :param name: The name of the command.
+    :type name: str
+    :return: The template.
+    :rtype: CommandTemplate
+    """
+    template = _templates.get(name)
+    if template is None:
+        with _templates_lock:
+            template = _templates.get(name)
+            if template is None:
+                template = CommandTemplate(name)
+                _templates[name] = template
+    return template
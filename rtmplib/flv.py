@@ -0,0 +1,243 @@
+"""
+Streams local FLV files to a RTMP server.
+
+The FLV file is memory mapped, and the tag bodies are handed to the RtmpWriter
+as buffers of the mapping, so the media is never copied into python strings
+before being written to the socket.
+
+Usage:
+    client.createstream()
+    # wait for the createStream response, then
+    client.publish(publishing_name)
+    publisher = FlvPublisher(client, ['song1.flv', 'song2.flv'], loop=True)
+    publisher.run()  # blocks, call publisher.stop() from another thread to end it.
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from . import rtmp_type
+
+log = logging.getLogger(__name__)
+
+# FLV tag types.
+TAG_AUDIO = 8
+TAG_VIDEO = 9
+TAG_SCRIPT = 18
+
+# the message types the tags are sent as.
+TAG_DATA_TYPES = {
+    TAG_AUDIO: rtmp_type.DT_AUDIO_MESSAGE,
+    TAG_VIDEO: rtmp_type.DT_VIDEO_MESSAGE,
+    TAG_SCRIPT: rtmp_type.DT_DATA_MESSAGE
+}
+
+FLV_HEADER_LENGTH = 9
+TAG_HEADER_LENGTH = 11
+PREVIOUS_TAG_SIZE_LENGTH = 4
+
+_UINT32 = struct.Struct('!I')
+
+
+class FlvError(Exception):
+    """ Raised when a file is not a valid FLV file. """
+    pass
+
+
+class FlvTag(object):
+    """ A single FLV tag. """
+
+    __slots__ = ('tag_type', 'timestamp', 'body')
+
+    def __init__(self, tag_type, timestamp, body):
+        self.tag_type = tag_type
+        # the timestamp in milliseconds.
+        self.timestamp = timestamp
+        # a buffer of the memory mapped file.
+        self.body = body
+
+    def __repr__(self):
+        return '<FlvTag type=%s timestamp=%s size=%s>' % (self.tag_type, self.timestamp, len(self.body))
+
+
+class FlvReader:
+    """ Reads the tags of a memory mapped FLV file. """
+
+    def __init__(self, path):
+        """
+        Open and memory map a FLV file.
+
+        :param path: The path to the FLV file.
+        :type path: str
+        :raises FlvError if the file is not a FLV file.
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._map = None
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < FLV_HEADER_LENGTH:
+                raise FlvError('%s is too small to be a FLV file.' % path)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            if self._map[:3] != 'FLV':
+                raise FlvError('%s does not have a FLV signature.' % path)
+            self.has_audio = bool(ord(self._map[4]) & 0x04)
+            self.has_video = bool(ord(self._map[4]) & 0x01)
+            # the header is followed by the size of the (non existing) tag before the first tag.
+            self.data_offset = _UINT32.unpack(self._map[5:9])[0] + PREVIOUS_TAG_SIZE_LENGTH
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        return self.tags()
+
+    def tags(self):
+        """
+        Iterate the tags of the file.
+
+        A truncated last tag ends the iteration.
+
+        :return: A generator of FlvTag.
+        """
+        mm = self._map
+        size = len(mm)
+        pos = self.data_offset
+        while pos + TAG_HEADER_LENGTH <= size:
+            tag_header = mm[pos:pos + TAG_HEADER_LENGTH]
+            tag_type = ord(tag_header[0]) & 0x1f
+            body_length = _UINT32.unpack('\x00' + tag_header[1:4])[0]
+            timestamp = _UINT32.unpack(tag_header[7] + tag_header[4:7])[0]
+            pos += TAG_HEADER_LENGTH
+            if pos + body_length > size:
+                log.warning('truncated tag at the end of %s' % self.path)
+                return
+            body = buffer(mm, pos, body_length)
+            pos += body_length + PREVIOUS_TAG_SIZE_LENGTH
+            yield FlvTag(tag_type, timestamp, body)
+
+    def close(self):
+        """ Close the mapping and the file. """
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+
+class FlvPublisher:
+    """ Publishes FLV files on the published stream of a RtmpClient. """
+
+    def __init__(self, client, playlist, loop=False, buffer_time=1.0, retry_delay=5.0):
+        """
+        Initialize the publisher.
+
+        :param client: A connected client that has published a stream.
+        :type client: rtmp.RtmpClient
+        :param playlist: The paths of the FLV files to publish, in order.
+        :type playlist: list
+        :param loop: Start over from the first file when the playlist ends.
+        :type loop: bool
+        :param buffer_time: The seconds of media that may be sent ahead of real time.
+        :type buffer_time: float
+        :param retry_delay: The seconds to wait before looping again over a playlist of which no file could be published.
+        :type retry_delay: float
+        """
+        self.client = client
+        self.playlist = list(playlist)
+        if not self.playlist:
+            raise ValueError('the playlist is empty.')
+        self.loop = loop
+        self.buffer_time = buffer_time
+        self.retry_delay = retry_delay
+        # the stream timestamp the next file starts at.
+        self.timestamp = 0
+        self.current = None
+        self._stop_event = threading.Event()
+
+    @property
+    def is_stopped(self):
+        return self._stop_event.is_set()
+
+    def stop(self):
+        """ Stop publishing. May be called from any thread. """
+        self._stop_event.set()
+
+    def run(self):
+        """
+        Publish the playlist, blocking until it ends or stop() is called.
+
+        Each tag is written when its timestamp is less than buffer_time ahead of the
+        time passed since the start, timestamps continue across files and loops.
+        Writes block while the connection is not keeping up.
+        """
+        self._stop_event.clear()
+        start_time = time.time()
+        while not self.is_stopped:
+            published = 0
+            for path in self.playlist:
+                if self.is_stopped:
+                    break
+                try:
+                    flv = FlvReader(path)
+                except (IOError, FlvError) as e:
+                    log.error('can not publish %s: %s' % (path, e))
+                    continue
+                self.current = path
+                try:
+                    self.timestamp, written = self._publish(flv, start_time)
+                finally:
+                    flv.close()
+                    self.current = None
+                if written:
+                    published += 1
+            if not self.loop:
+                break
+            if not published:
+                # looping over files that all fail or hold no media would spin, wait for them to be fixed.
+                log.error('no file of the playlist could be published, retrying in %s seconds' % self.retry_delay)
+                if self._stop_event.wait(self.retry_delay):
+                    break
+
+    def _publish(self, flv, start_time):
+        """
+        Write the tags of a single file.
+
+        :return: The stream timestamp following the last tag written, and the amount of tags written.
+        :rtype: tuple
+        """
+        base = self.timestamp
+        first = None
+        last = base
+        written = 0
+        for tag in flv:
+            if self.is_stopped:
+                break
+            data_type = TAG_DATA_TYPES.get(tag.tag_type)
+            if data_type is None:
+                continue
+            if first is None:
+                first = tag.timestamp
+            timestamp = base + max(0, tag.timestamp - first)
+
+            delay = timestamp / 1000.0 - self.buffer_time - (time.time() - start_time)
+            if delay > 0 and self._stop_event.wait(delay):
+                break
+            self._wait_writable()
+
+            self.client.writer.write({'msg': data_type, 'body': tag.body, 'timestamp': timestamp})
+            self.client.writer.flush()
+            last = timestamp
+            written += 1
+        # leave a frame worth of gap between files.
+        return last + 40, written
+
+    def _wait_writable(self):
+        """ Wait for the send queue of an event driven client to drain. """
+        has_outgoing = getattr(self.client, 'has_outgoing', None)
+        if has_outgoing is None:
+            return
+        while has_outgoing() and not self._stop_event.wait(0.01):
+            pass
@@ -0,0 +1,151 @@
+"""
+The simple (unencrypted) RTMP handshake.
+
+C0 and C1 are built in a single buffer and sent with one write, S0, S1 and S2
+are received with one exact size read, and C2 is sent with one write.
+
+In pipelined mode C2 is sent as soon as S1 arrives, together with the first
+messages of the client, and S2 is read afterwards.
+"""
+import os
+import socket
+import struct
+import time
+
+from . import packet
+
+# the RTMP version sent in C0.
+RTMP_VERSION = 3
+
+# C0 + C1 sent by the client, S0 + S1 + S2 sent by the server.
+C0_C1_LENGTH = 1 + packet.HANDSHAKE_LENGTH
+S0_S1_S2_LENGTH = 1 + packet.HANDSHAKE_LENGTH * 2
+
+# the time and zero fields in front of the random bytes of C1.
+_C1_PREFIX = struct.Struct('!BLL')
+
+
+class HandshakeError(Exception):
+    """ Raised when the handshake with the remote server fails. """
+    pass
+
+
+class HandshakeMetrics(object):
+    """ The timings of a handshake, as time.time() values. """
+
+    __slots__ = ('started', 'c0c1_sent', 's0s1_received', 'c2_sent', 's0s1s2_received')
+
+    def __init__(self):
+        self.started = time.time()
+        self.c0c1_sent = None
+        self.s0s1_received = None
+        self.c2_sent = None
+        self.s0s1s2_received = None
+
+    @property
+    def round_trip_time(self):
+        """ The seconds between sending C0+C1 and receiving S0+S1. """
+        if self.c0c1_sent is None or self.s0s1_received is None:
+            return None
+        return self.s0s1_received - self.c0c1_sent
+
+    @property
+    def duration(self):
+        """ The seconds the whole handshake took. """
+        if self.c2_sent is None or self.s0s1s2_received is None:
+            return None
+        return max(self.c2_sent, self.s0s1s2_received) - self.started
+
+    def __repr__(self):
+        return '<HandshakeMetrics rtt=%s duration=%s>' % (self.round_trip_time, self.duration)
+
+
+def create_c0c1():
+    """
+    Create C0 and C1 in one buffer.
+
+    :return: C0 + C1
+    :rtype: str
+    """
+    return _C1_PREFIX.pack(RTMP_VERSION, 0, 0) + os.urandom(packet.HANDSHAKE_LENGTH - 8)
+
+
+def create_c2(s0s1s2):
+    """
+    Create C2 from the bytes received from the server, C2 echoes S1.
+
+    :param s0s1s2: S0 + S1 (+ S2)
+    :type s0s1s2: str | bytearray
+    :return: C2
+    :rtype: str
+    :raises HandshakeError if the server uses a unsupported RTMP version.
+    """
+    version = s0s1s2[0]
+    if not isinstance(version, int):
+        version = ord(version)
+    if version != RTMP_VERSION:
+        raise HandshakeError('unsupported RTMP version %s sent by server' % version)
+    return bytes(s0s1s2[1:C0_C1_LENGTH])
+
+
+def recv_exact(sock, length):
+    """
+    Receive exactly length bytes from a socket.
+
+    :param sock: The connected socket.
+    :type sock: socket.socket
+    :param length: The amount of bytes to receive.
+    :type length: int
+    :return: The received bytes.
+    :rtype: bytearray
+    :raises HandshakeError if the connection is closed first.
+    """
+    buf = bytearray(length)
+    view = memoryview(buf)
+    received = 0
+    while received < length:
+        read = sock.recv_into(view[received:], length - received)
+        if not read:
+            raise HandshakeError('connection closed after %s of %s handshake bytes' % (received, length))
+        received += read
+    return buf
+
+
+def perform(sock, early_data=None):
+    """
+    Perform the handshake on a connected socket.
+
+    Nothing beyond S2 is read from the socket, so a buffered file made from
+    the socket can be used for reading afterwards.
+
+    :param sock: The connected socket.
+    :type sock: socket.socket
+    :param early_data: Bytes to send right behind C2, before S2 is received. (pipelined mode)
+    :type early_data: str | None
+    :return: The timings of the handshake.
+    :rtype: HandshakeMetrics
+    :raises HandshakeError if the handshake fails.
+    """
+    metrics = HandshakeMetrics()
+    try:
+        sock.sendall(create_c0c1())
+        metrics.c0c1_sent = time.time()
+
+        if early_data is None:
+            s0s1s2 = recv_exact(sock, S0_S1_S2_LENGTH)
+            metrics.s0s1_received = metrics.s0s1s2_received = time.time()
+
+            sock.sendall(create_c2(s0s1s2))
+            metrics.c2_sent = time.time()
+        else:
+            s0s1 = recv_exact(sock, C0_C1_LENGTH)
+            metrics.s0s1_received = time.time()
+
+            sock.sendall(create_c2(s0s1) + early_data)
+            metrics.c2_sent = time.time()
+
+            recv_exact(sock, packet.HANDSHAKE_LENGTH)
+            metrics.s0s1s2_received = time.time()
+    except socket.error as se:
+        raise HandshakeError('socket error during handshake: %s' % se)
+    return metrics
@@ -10,9 +10,13 @@ This is a edited version of rtmp-python based on the original by prekageo
 https://github.com/prekageo/rtmp-python
 """
 import logging
+import struct
 
 log = logging.getLogger(__name__)
 
+_UINT32 = struct.Struct('!L')
+_UINT32_LE = struct.Struct('<L')
+
 
 def decode(stream):
     """
@@ -58,13 +62,9 @@ def decode(stream):
 
     if header.timestamp == 0xffffff:
         header.timestamp = stream.read_ulong()
-    # WORKAROUND: even though the RTMP specification states that the
-    # extended timestamp field DOES NOT follow type 3 chunks, it seems
-    # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
-    # and expect this field here.
-
-    # if header.timestamp >= 0x00ffffff:
-    #     self.stream.read_ulong()
+        header.extended = True
+    # a type 3 header is followed by the extended timestamp too, when the previous
+    # header of its chunk stream had one. Only the reader knows, and reads it.
 
     log.info('header recv: %s' % header)
 
@@ -111,6 +111,9 @@ def encode(stream, header, previous=None):
         stream.write_uchar(channel_id >> 0x08)
 
     if size == 0xc0:
+        if header.timestamp >= 0xffffff:
+            # a type 3 header repeats the extended timestamp of the header it continues.
+            stream.write_ulong(header.timestamp)
         return
 
     if size <= 0x80:
@@ -133,13 +136,67 @@ def encode(stream, header, previous=None):
             stream.write_ulong(header.timestamp)
 
 
+def pack(header, previous=None):
+    """
+    Encodes a RTMP header to a byte string.
+
+    Produces the same bytes as L{encode}, but builds them with a few struct
+    calls instead of one stream write per field, which makes it suitable
+    for the send path where a header is encoded for every chunk.
+
+    @param header: The L{Header} to encode.
+    @param previous: The previous header (if any).
+    @return: The encoded header.
+    @rtype: C{str}
+    """
+    if previous is None:
+        size = 0
+    else:
+        size = min_bytes_required(header, previous)
+
+    channel_id = header.channel_id
+
+    if channel_id < 64:
+        basic = chr(size | channel_id)
+    elif channel_id < 320:
+        basic = chr(size) + chr(channel_id - 64)
+    else:
+        channel_id -= 64
+        basic = chr(size + 1) + chr(channel_id & 0xff) + chr(channel_id >> 0x08)
+
+    if size == 0xc0:
+        if header.timestamp >= 0xffffff:
+            # a type 3 header repeats the extended timestamp of the header it continues.
+            return basic + _UINT32.pack(header.timestamp)
+        return basic
+
+    timestamp = header.timestamp
+    extended = timestamp >= 0xffffff
+    if extended:
+        fields = [basic, _UINT32.pack(0xffffff)[1:]]
+    else:
+        fields = [basic, _UINT32.pack(timestamp)[1:]]
+
+    if size <= 0x40:
+        fields.append(_UINT32.pack(header.body_length)[1:])
+        fields.append(chr(header.data_type))
+
+    if size == 0:
+        fields.append(_UINT32_LE.pack(header.stream_id))
+
+    if extended:
+        fields.append(_UINT32.pack(timestamp))
+
+    return ''.join(fields)
+
+
 class Header(object):
     """
     An RTMP Header. Holds contextual information for an RTMP Channel.
     """
 
     __slots__ = ('stream_id', 'data_type', 'timestamp',
-                 'body_length', 'channel_id', 'full')
+                 'body_length', 'channel_id', 'full', 'extended')
 
     def __init__(self, channel_id, timestamp=-1, data_type=-1,
                  body_length=-1, stream_id=-1, full=False):
@@ -149,6 +206,8 @@ class Header(object):
         self.body_length = body_length
         self.stream_id = stream_id
         self.full = full
+        # whether the header was read with the 0xffffff extended timestamp marker.
+        self.extended = False
 
     def __repr__(self):
         attrs = []
@@ -0,0 +1,284 @@
+"""
+The decoded RTMP messages returned by the RtmpReader.
+
+Each message type is a small class with __slots__ instead of a dict, tagged
+with its data type in the msg attribute. The fields can be read as attributes,
+or as dict items like the dicts the reader used to return:
+
+    message.command == message['command']
+    message.get('stream_id', 0)
+"""
+from . import rtmp_type
+
+
+class Message(object):
+    """ The base of the decoded messages. """
+
+    __slots__ = ('msg',)
+    # the names of all the fields of the message, the keys of the dict accessor.
+    fields = ('msg',)
+
+    def __init__(self, msg):
+        # the data type of the message.
+        self.msg = msg
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def get(self, key, default=None):
+        if key in self.fields:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return list(self.fields)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.fields]
+
+    def to_dict(self):
+        """ The message as a dict, like the reader used to return. """
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (Message, dict)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.to_dict())
+
+
+class UserControl(Message):
+    __slots__ = ('event_type', 'event_data')
+    fields = Message.fields + __slots__
+
+    def __init__(self, event_type, event_data):
+        self.msg = rtmp_type.DT_USER_CONTROL
+        self.event_type = event_type
+        self.event_data = event_data
+
+
+class Acknowledgement(Message):
+    __slots__ = ('sequence_number',)
+    fields = Message.fields + __slots__
+
+    def __init__(self, sequence_number):
+        self.msg = rtmp_type.DT_ACKNOWLEDGEMENT
+        self.sequence_number = sequence_number
+
+
+class Abort(Message):
+    __slots__ = ('chunk_stream_id',)
+    fields = Message.fields + __slots__
+
+    def __init__(self, chunk_stream_id):
+        self.msg = rtmp_type.DT_ABORT
+        self.chunk_stream_id = chunk_stream_id
+
+
+class WindowAckSize(Message):
+    __slots__ = ('window_ack_size',)
+    fields = Message.fields + __slots__
+
+    def __init__(self, window_ack_size):
+        self.msg = rtmp_type.DT_WINDOW_ACK_SIZE
+        self.window_ack_size = window_ack_size
+
+
+class SetPeerBandwidth(Message):
+    __slots__ = ('window_ack_size', 'limit_type')
+    fields = Message.fields + __slots__
+
+    def __init__(self, window_ack_size, limit_type):
+        self.msg = rtmp_type.DT_SET_PEER_BANDWIDTH
+        self.window_ack_size = window_ack_size
+        self.limit_type = limit_type
+
+
+class SetChunkSize(Message):
+    __slots__ = ('chunk_size',)
+    fields = Message.fields + __slots__
+
+    def __init__(self, chunk_size):
+        self.msg = rtmp_type.DT_SET_CHUNK_SIZE
+        self.chunk_size = chunk_size
+
+
+class SharedObjectEvent(Message):
+    """ A single event of a shared object message, type is the SO_* event type. """
+
+    __slots__ = ('type', 'data')
+    fields = __slots__
+
+    def __init__(self, event_type, data):
+        self.type = event_type
+        self.data = data
+
+
+class SharedObjectMessage(Message):
+    __slots__ = ('obj_name', 'curr_version', 'flags', 'events')
+    fields = Message.fields + __slots__
+
+    def __init__(self, msg, obj_name, curr_version, flags, events):
+        self.msg = msg
+        self.obj_name = obj_name
+        self.curr_version = curr_version
+        self.flags = flags
+        # a list of SharedObjectEvent.
+        self.events = events
+
+
+class LazyValues(object):
+    """
+    The values of a AMF encoded body, decoded when they are accessed.
+
+    Values are decoded in order, up to the highest index accessed, so the
+    values behind the ones a handler reads are never decoded. Slices, negative
+    indexes, len() and comparisons decode all the values.
+    """
+
+    __slots__ = ('_stream', '_decoder', '_values')
+
+    def __init__(self, stream, decoder):
+        """
+        :param stream: The body stream, positioned at the first value.
+        :type stream: reader.MemoryViewStream
+        :param decoder: A amf0 or amf3 decoder reading from the stream.
+        """
+        self._stream = stream
+        self._decoder = decoder
+        self._values = []
+
+    def _decode(self, index=None):
+        """ Decode the values up to index, or all values if index is None. """
+        values = self._values
+        while self._decoder is not None and (index is None or len(values) <= index):
+            if self._stream.at_eof():
+                # release the body buffer.
+                self._stream = self._decoder = None
+                break
+            values.append(self._decoder.readElement())
+        return values
+
+    def __getitem__(self, index):
+        if isinstance(index, slice) or index < 0:
+            return self._decode()[index]
+        return self._decode(index)[index]
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __nonzero__(self):
+        return len(self._decode(0)) > 0
+
+    def __iter__(self):
+        index = 0
+        while True:
+            values = self._decode(index)
+            if index >= len(values):
+                return
+            yield values[index]
+            index += 1
+
+    def __contains__(self, value):
+        return value in self._decode()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyValues):
+            other = other._decode()
+        return self._decode() == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._decode())
+
+    @property
+    def decoded(self):
+        """ The amount of values decoded so far. """
+        return len(self._values)
+
+
+class Command(Message):
+    """
+    A command message.
+
+    The name and the transaction id are decoded when the message is read,
+    the command object and the arguments when they are accessed.
+    """
+
+    __slots__ = ('name', 'trans_id', 'command')
+    fields = Message.fields + ('command',)
+
+    def __init__(self, msg, command):
+        self.msg = msg
+        # the name, transaction id, command object and arguments. (list | LazyValues)
+        self.command = command
+        self.name = self.trans_id = None
+        try:
+            self.name = command[0]
+            self.trans_id = command[1]
+        except IndexError:
+            pass
+
+
+class MediaMessage(Message):
+    """ A audio or video message, the body is passed through as is. """
+
+    __slots__ = ('timestamp', 'stream_id', 'body')
+    fields = Message.fields + __slots__
+
+    def __init__(self, msg, timestamp, stream_id, body):
+        self.msg = msg
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+        self.body = body
+
+
+class DataMessage(Message):
+    __slots__ = ('timestamp', 'stream_id', 'data', 'body')
+    fields = Message.fields + __slots__
+
+    def __init__(self, msg, timestamp, stream_id, data, body):
+        self.msg = msg
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+        self.data = data
+        self.body = body
+
+
+class AggregateMessage(Message):
+    __slots__ = ('timestamp', 'stream_id', 'messages')
+    fields = Message.fields + __slots__
+
+    def __init__(self, timestamp, stream_id, messages):
+        self.msg = rtmp_type.DT_AGGREGATE_MESSAGE
+        self.timestamp = timestamp
+        self.stream_id = stream_id
+        # the decoded sub-messages.
+        self.messages = messages
@@ -0,0 +1,177 @@
+"""
+Runs many event driven RTMP connections on a single event loop thread.
+
+Usage:
+    pool = ConnectionPool()
+    pool.start()
+    client = pool.client(ip, port, tc_url, app, on_message=handler)
+    pool.connect(client, connect_params)
+    ...
+    pool.stop()
+"""
+import asyncore
+import collections
+import logging
+import threading
+import time
+
+from . import async_rtmp
+
+log = logging.getLogger(__name__)
+
+# the seconds between checks of the connect deadlines of the clients.
+TIMEOUT_CHECK_INTERVAL = 0.25
+
+
+class ConnectionPool(object):
+    """ Owns a number of AsyncRtmpClient connections sharing one event loop. """
+
+    def __init__(self, timeout=0.05):
+        """
+        Initialize the pool.
+
+        :param timeout: The seconds the event loop waits for socket events before
+        running the tasks queued with call_soon.
+        :type timeout: float
+        """
+        self.timeout = timeout
+        self.sock_map = {}
+        self.clients = set()
+        self._tasks = collections.deque()
+        self._next_timeout_check = 0
+        self._thread = None
+        self._running = threading.Event()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.clients)
+
+    @property
+    def is_running(self):
+        return self._running.is_set()
+
+    def client(self, ip, port, tc_url, app, **kwargs):
+        """
+        Create a client on the event loop of the pool.
+
+        Takes the same arguments as AsyncRtmpClient. on_message, on_connect and
+        on_close are called on the event loop thread, so they should not block.
+
+        :return: The client, not yet connected.
+        :rtype: async_rtmp.AsyncRtmpClient
+        """
+        on_close = kwargs.get('on_close')
+
+        def closed(client):
+            with self._lock:
+                self.clients.discard(client)
+            if on_close is not None:
+                on_close(client)
+
+        kwargs['sock_map'] = self.sock_map
+        kwargs['on_close'] = closed
+        client = async_rtmp.AsyncRtmpClient(ip, port, tc_url, app, **kwargs)
+        with self._lock:
+            self.clients.add(client)
+        return client
+
+    def connect(self, client, connect_params=None):
+        """
+        Connect a client created by the pool, on the event loop thread.
+
+        :param client: The client.
+        :type client: async_rtmp.AsyncRtmpClient
+        :param connect_params: A list or dict containing application specific connect parameters
+        :type connect_params: list | dict
+        """
+        with self._lock:
+            self.clients.add(client)
+        self.call_soon(self._connect, client, connect_params)
+
+    @staticmethod
+    def _connect(client, connect_params):
+        try:
+            client.connect(connect_params)
+        except Exception as e:
+            # on_close of the client is called, so the owner can reconnect.
+            client.connection_failed(e)
+
+    def close(self, client):
+        """ Close a client on the event loop thread. """
+        with self._lock:
+            self.clients.discard(client)
+        self.call_soon(client.shutdown)
+
+    def call_soon(self, fn, *args):
+        """
+        Run fn on the event loop thread. May be called from any thread.
+
+        :param fn: The callable to run.
+        :param args: The arguments for fn.
+        """
+        self._tasks.append((fn, args))
+
+    def start(self):
+        """ Start the event loop in a daemon thread. """
+        if self.is_running:
+            return
+        self._running.set()
+        self._thread = threading.Thread(target=self.run, name='rtmp-pool')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, close_clients=True):
+        """
+        Stop the event loop.
+
+        :param close_clients: Close all the connections of the pool.
+        :type close_clients: bool
+        """
+        if close_clients:
+            with self._lock:
+                clients = list(self.clients)
+            for client in clients:
+                self.close(client)
+        self._running.clear()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        # the queued shutdowns.
+        self._run_tasks()
+
+    def run(self):
+        """ Run the event loop until stop() is called. """
+        self._running.set()
+        log.info('connection pool loop started')
+        while self._running.is_set():
+            self._run_tasks()
+            self._check_timeouts()
+            if self.sock_map:
+                # poll scales past the file descriptor limit of select.
+                asyncore.loop(timeout=self.timeout, use_poll=hasattr(asyncore.select, 'poll'),
+                              map=self.sock_map, count=1)
+            else:
+                time.sleep(self.timeout)
+        log.info('connection pool loop stopped')
+
+    def _check_timeouts(self):
+        """ Fail the connects through a proxy that take longer than the timeout of the proxy pool. """
+        now = time.time()
+        if now < self._next_timeout_check:
+            return
+        self._next_timeout_check = now + TIMEOUT_CHECK_INTERVAL
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.check_timeout(now)
+            except Exception as e:
+                log.error('connection pool timeout check error: %s' % e, exc_info=True)
+
+    def _run_tasks(self):
+        while self._tasks:
+            fn, args = self._tasks.popleft()
+            try:
+                fn(*args)
+            except Exception as e:
+                log.error('connection pool task error: %s' % e, exc_info=True)
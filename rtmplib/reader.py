@@ -1,12 +1,102 @@
 import logging
+import struct
 
 from pyamf import amf0, amf3
 import pyamf.util.pure
 
-from . import header, rtmp_type
+from . import header, message, rtmp_type
 
 log = logging.getLogger(__name__)
 
+_UINT32 = struct.Struct('!I')
+
+
+class RtmpReadError(Exception):
+    """ Raised when the incoming data can not be parsed as RTMP chunks. """
+    pass
+
+
+class MemoryViewStream(pyamf.util.pure.DataTypeMixIn):
+    """
+    A read-only stream over a message body buffer.
+
+    Reads are served straight from a memoryview of the buffer, so the
+    reassembled body is handed to the decoders without being copied into
+    an intermediate StringIO first.
+    """
+    def __init__(self, buf):
+        self._view = memoryview(buf)
+        self._len = len(self._view)
+        self._pos = 0
+        pyamf.util.pure.DataTypeMixIn.__init__(self)
+
+    def __len__(self):
+        return self._len
+
+    def read(self, length=-1):
+        """ Read length bytes from the buffer.
+
+        :param length: The amount of bytes to read, -1 reads the remaining bytes.
+        :type length: int
+        :return: The bytes read.
+        :rtype: str
+        :raises IOError if reading past the end of the buffer.
+        """
+        if length == -1:
+            if self.at_eof():
+                raise IOError('Attempted to read from the buffer but already at the end')
+            length = self._len - self._pos
+        elif self._pos + length > self._len:
+            raise IOError('Attempted to read %d bytes from the buffer but only %d remain' %
+                          (length, self._len - self._pos))
+
+        start = self._pos
+        self._pos += length
+        return self._view[start:self._pos].tobytes()
+
+    def peek(self, size=1):
+        """ Look size bytes ahead in the buffer without moving the position. """
+        if size == -1:
+            size = self._len - self._pos
+        end = min(self._pos + size, self._len)
+        return self._view[self._pos:end].tobytes()
+
+    def seek(self, pos, mode=0):
+        if mode == 1:
+            pos += self._pos
+        elif mode == 2:
+            pos += self._len
+        self._pos = max(0, min(pos, self._len))
+
+    def tell(self):
+        return self._pos
+
+    def remaining(self):
+        return self._len - self._pos
+
+    def at_eof(self):
+        return self._pos >= self._len
+
+    def getvalue(self):
+        return self._view.tobytes()
+
+
+class ChunkStream(object):
+    """ The receive state of a single chunk stream(channel_id). """
+
+    __slots__ = ('header', 'delta', 'body', 'received', 'extended')
+
+    def __init__(self):
+        # the last header seen on this chunk stream, with an absolute timestamp.
+        self.header = None
+        # the timestamp delta used by a type 3 header starting a new message.
+        self.delta = 0
+        # the buffer of a partially received message, None if no message is in progress.
+        self.body = None
+        self.received = 0
+        # whether the last header, other than a type 3 one, carried the extended timestamp marker.
+        self.extended = False
+
 
 class RtmpReader:
     """ This class reads RTMP messages from a stream. """
@@ -19,7 +109,7 @@ class RtmpReader:
         Initialize the RTMP reader and set it to read from the specified stream.
         """
         self.stream = stream
-        self.prv_header = None
+        self.chunk_streams = {}
 
     def __iter__(self):
         # AttributeError: 'NoneType' object has no attribute 'next'
@@ -32,76 +122,152 @@ class RtmpReader:
         """ Read one RTMP message from the stream and return it. """
         if self.stream.at_eof():
             raise StopIteration
-        # Read the message into body_stream. The message may span a number of
-        # chunks (each one with its own header).
-        message_body = []
-        msg_body_len = 0
-        _header = header.decode(self.stream)
-        log.debug('header %s' % _header)
+        # The message may span a number of chunks (each one with its own header),
+        # and chunks belonging to different chunk streams may be interleaved.
+        while True:
+            complete = self.read_chunk()
+            if complete is not None:
+                message = self.decode_message(*complete)
+                if message is not None:
+                    return message
 
-        # FIXME: this should really be implemented inside header_decode
-        if _header.data_type == rtmp_type.DT_NONE:
-            _header = self.prv_header
-        self.prv_header = _header
+    def read_chunk(self):
+        """
+        Read one chunk from the stream.
 
-        while True:
-            # NOTE: this whole loop section needs to be looked at.
-            read_bytes = min(_header.body_length - msg_body_len, self.chunk_size)
+        The chunk payload is read straight into the message buffer of its chunk
+        stream, the buffer being preallocated from the body length of the header.
+        The state of the chunk stream is only updated once the whole chunk has been read,
+        so an IOError raised while reading leaves the reader untouched.
 
-            message_body.append(self.stream.read(read_bytes))
-            msg_body_len += read_bytes
-            if msg_body_len >= _header.body_length:
-                break
-            next_header = header.decode(self.stream)
-            # WORKAROUND: even though the RTMP specification states that the
-            # extended timestamp field DOES NOT follow type 3 chunks, it seems
-            # that Flash player 10.1.85.3 and Flash Media Server 3.0.2.217 send
-            # and expect this field here.
-            if _header.timestamp >= 0x00ffffff:
-                self.stream.read_ulong()
-            assert next_header.stream_id == -1, (_header, next_header)
-            assert next_header.data_type == -1, (_header, next_header)
-            assert next_header.timestamp == -1, (_header, next_header)
-            assert next_header.body_length == -1, (_header, next_header)
-        assert _header.body_length == msg_body_len, (_header, msg_body_len)
-        body_stream = pyamf.util.BufferedByteStream(''.join(message_body))
+        :return: The header and body of the message if the chunk completed one, else None.
+        :rtype: tuple | None
+        :raises RtmpReadError if the chunk can not be tied to a message.
+        """
+        _header = header.decode(self.stream)
+        log.debug('header %s' % _header)
+        # a type 3 header, carrying nothing but the chunk stream id.
+        basic_only = _header.timestamp == -1
+
+        chunk_stream = self.chunk_streams.get(_header.channel_id)
+        if chunk_stream is None:
+            chunk_stream = ChunkStream()
+            self.chunk_streams[_header.channel_id] = chunk_stream
+
+        prv_header = chunk_stream.header
+        body = chunk_stream.body
+        received = chunk_stream.received
+        extended = chunk_stream.extended
+
+        if body is not None and _header.timestamp != -1:
+            log.warning('new header on chunk stream %s while a message was in progress, '
+                        'discarding %s of %s bytes' % (_header.channel_id, received, prv_header.body_length))
+            body = None
+
+        if body is None and not basic_only:
+            # the header on the wire tells if the type 3 chunks that follow carry an extended timestamp,
+            # a type 3 header keeps the flag of the header it repeats.
+            extended = _header.extended
+
+        if body is not None:
+            # continuation chunk of the message in progress.
+            _header = prv_header
+            delta = chunk_stream.delta
+        elif _header.full:
+            delta = _header.timestamp
+        else:
+            if prv_header is None:
+                raise RtmpReadError('no previous header for chunk stream %s: %s' % (_header.channel_id, _header))
+
+            if _header.timestamp == -1:
+                delta = chunk_stream.delta
+            else:
+                delta = _header.timestamp
+
+            if _header.body_length == -1:
+                _header.body_length = prv_header.body_length
+                _header.data_type = prv_header.data_type
+            _header.stream_id = prv_header.stream_id
+            _header.timestamp = prv_header.timestamp + delta
+
+        # a type 3 chunk, continuing a message or starting a new one, carries the extended
+        # timestamp when the header before it on the chunk stream had the 0xffffff marker,
+        # like Flash Media Server and librtmp send it. Only the marker tells, not the absolute timestamp.
+        if basic_only and extended:
+            self.stream.read_ulong()
+
+        if body is None:
+            body = bytearray(_header.body_length)
+            received = 0
+
+        read_bytes = min(_header.body_length - received, self.chunk_size)
+        self.read_into(memoryview(body)[received:received + read_bytes])
+        received += read_bytes
+
+        chunk_stream.header = _header
+        chunk_stream.delta = delta
+        chunk_stream.extended = extended
+        if received < _header.body_length:
+            chunk_stream.body = body
+            chunk_stream.received = received
+            return None
+
+        chunk_stream.body = None
+        chunk_stream.received = 0
+        return _header, body
+
+    def decode_message(self, _header, message_body):
+        """
+        Decode a complete message based on the datatype present in the header.
+
+        :param _header: The header of the message.
+        :type _header: header.Header
+        :param message_body: The reassembled message body.
+        :type message_body: bytearray
+        :return: The decoded message, or None if the message was discarded.
+        :rtype: message.Message | None
+        """
+        body_stream = MemoryViewStream(message_body)
 
         # Decode the message based on the datatype present in the header
-        ret = {'msg': _header.data_type}
+        data_type = _header.data_type
+
+        if data_type == rtmp_type.DT_COMMAND or data_type == rtmp_type.DT_AMF3_COMMAND:
+            if data_type == rtmp_type.DT_COMMAND:
+                decoder = amf0.Decoder(body_stream)
+            else:
+                decoder = amf3.Decoder(body_stream)
+            # the arguments are decoded when the handler accesses them.
+            ret = message.Command(data_type, message.LazyValues(body_stream, decoder))
 
-        if ret['msg'] == rtmp_type.DT_NONE:
+        elif data_type == rtmp_type.DT_NONE:
             log.warning('WARNING: message with datatype None received: %s' % _header)
-            return self.next()
+            return None
 
-        elif ret['msg'] == rtmp_type.DT_USER_CONTROL:
-            ret['event_type'] = body_stream.read_ushort()
-            ret['event_data'] = body_stream.read()
+        elif data_type == rtmp_type.DT_USER_CONTROL:
+            ret = message.UserControl(body_stream.read_ushort(), body_stream.read())
 
-        elif ret['msg'] == rtmp_type.DT_WINDOW_ACK_SIZE:
-            ret['window_ack_size'] = body_stream.read_ulong()
+        elif data_type == rtmp_type.DT_ACKNOWLEDGEMENT:
+            ret = message.Acknowledgement(body_stream.read_ulong())
 
-        elif ret['msg'] == rtmp_type.DT_SET_PEER_BANDWIDTH:
-            ret['window_ack_size'] = body_stream.read_ulong()
-            ret['limit_type'] = body_stream.read_uchar()
+        elif data_type == rtmp_type.DT_ABORT:
+            ret = message.Abort(body_stream.read_ulong())
+            chunk_stream = self.chunk_streams.get(ret.chunk_stream_id)
+            if chunk_stream is not None:
+                chunk_stream.body = None
+                chunk_stream.received = 0
 
-        elif ret['msg'] == rtmp_type.DT_SHARED_OBJECT:
-            decoder = amf0.Decoder(body_stream)
-            obj_name = decoder.readString()
-            curr_version = body_stream.read_ulong()
-            flags = body_stream.read(8)
-            # A shared object message may contain a number of events.
-            events = []
-            while not body_stream.at_eof():
-                event = self.read_shared_object_event(body_stream, decoder)
-                events.append(event)
+        elif data_type == rtmp_type.DT_WINDOW_ACK_SIZE:
+            ret = message.WindowAckSize(body_stream.read_ulong())
 
-            ret['obj_name'] = obj_name
-            ret['curr_version'] = curr_version
-            ret['flags'] = flags
-            ret['events'] = events
+        elif data_type == rtmp_type.DT_SET_PEER_BANDWIDTH:
+            ret = message.SetPeerBandwidth(body_stream.read_ulong(), body_stream.read_uchar())
 
-        elif ret['msg'] == rtmp_type.DT_AMF3_SHARED_OBJECT:
-            decoder = amf3.Decoder(body_stream)
+        elif data_type == rtmp_type.DT_SHARED_OBJECT or data_type == rtmp_type.DT_AMF3_SHARED_OBJECT:
+            if data_type == rtmp_type.DT_SHARED_OBJECT:
+                decoder = amf0.Decoder(body_stream)
+            else:
+                decoder = amf3.Decoder(body_stream)
             obj_name = decoder.readString()
             curr_version = body_stream.read_ulong()
             flags = body_stream.read(8)
@@ -110,34 +276,109 @@ class RtmpReader:
             while not body_stream.at_eof():
                 event = self.read_shared_object_event(body_stream, decoder)
                 events.append(event)
-
-            ret['obj_name'] = obj_name
-            ret['curr_version'] = curr_version
-            ret['flags'] = flags
-            ret['events'] = events
-
-        elif ret['msg'] == rtmp_type.DT_COMMAND:
-            decoder = amf0.Decoder(body_stream)
-            commands = []
-            while not body_stream.at_eof():
-                commands.append(decoder.readElement())
-            ret['command'] = commands
-
-        elif ret['msg'] == rtmp_type.DT_AMF3_COMMAND:
-            decoder = amf3.Decoder(body_stream)
-            commands = []
+            ret = message.SharedObjectMessage(data_type, obj_name, curr_version, flags, events)
+
+        elif data_type == rtmp_type.DT_AUDIO_MESSAGE or data_type == rtmp_type.DT_VIDEO_MESSAGE:
+            # the payload is passed through as is, the buffer is not copied.
+            ret = message.MediaMessage(data_type, _header.timestamp, _header.stream_id, message_body)
+
+        elif data_type == rtmp_type.DT_DATA_MESSAGE or data_type == rtmp_type.DT_AMF3_DATA_MESSAGE:
+            if data_type == rtmp_type.DT_DATA_MESSAGE:
+                decoder = amf0.Decoder(body_stream)
+            else:
+                decoder = amf3.Decoder(body_stream)
+            data = []
             while not body_stream.at_eof():
-                commands.append(decoder.readElement())
-            ret['command'] = commands
-
-        elif ret['msg'] == rtmp_type.DT_SET_CHUNK_SIZE:
-            ret['chunk_size'] = body_stream.read_ulong()
+                data.append(decoder.readElement())
+            ret = message.DataMessage(data_type, _header.timestamp, _header.stream_id, data, message_body)
+
+        elif data_type == rtmp_type.DT_AGGREGATE_MESSAGE:
+            ret = message.AggregateMessage(_header.timestamp, _header.stream_id,
+                                           self.read_aggregate_messages(_header, message_body))
+
+        elif data_type == rtmp_type.DT_SET_CHUNK_SIZE:
+            ret = message.SetChunkSize(body_stream.read_ulong())
+            # the chunks following this message are already split by the new size,
+            # apply it right away since a RtmpParser may have them buffered.
+            if 0 < ret.chunk_size <= 65536:
+                self.chunk_size = ret.chunk_size
         else:
             assert False, _header
 
         log.debug('recv %r', ret)
         return ret
 
+    def read_aggregate_messages(self, _header, message_body):
+        """
+        Unpack the sub-messages of an aggregate message.
+
+        Each sub-message is a 11 byte message header followed by the body
+        and a 4 byte back pointer. The sub-message timestamps are rebased
+        on the timestamp of the aggregate message, and the bodies are
+        memoryviews of the aggregate body rather than copies.
+
+        :param _header: The header of the aggregate message.
+        :type _header: header.Header
+        :param message_body: The body of the aggregate message.
+        :type message_body: bytearray
+        :return: The decoded sub-messages.
+        :rtype: list
+        :raises RtmpReadError if a sub-message runs past the end of the body.
+        """
+        view = memoryview(message_body)
+        size = len(view)
+        messages = []
+        pos = 0
+        first_timestamp = None
+        while pos + 11 <= size:
+            sub_header = view[pos:pos + 11].tobytes()
+            data_type = ord(sub_header[0])
+            body_length = _UINT32.unpack('\x00' + sub_header[1:4])[0]
+            timestamp = _UINT32.unpack(sub_header[7] + sub_header[4:7])[0]
+            stream_id = _UINT32.unpack('\x00' + sub_header[8:11])[0]
+            pos += 11
+            if pos + body_length > size:
+                raise RtmpReadError('aggregate sub-message of %s bytes exceeds the aggregate body: %s' %
+                                    (body_length, _header))
+
+            if first_timestamp is None:
+                first_timestamp = timestamp
+            sub = header.Header(
+                channel_id=_header.channel_id,
+                timestamp=_header.timestamp + timestamp - first_timestamp,
+                data_type=data_type,
+                body_length=body_length,
+                stream_id=stream_id,
+                full=True)
+            message = self.decode_message(sub, view[pos:pos + body_length])
+            if message is not None:
+                messages.append(message)
+            # skip the body and the back pointer.
+            pos += body_length + 4
+        return messages
+
+    def read_into(self, view):
+        """
+        Fill a memoryview with bytes from the stream.
+
+        Uses the readinto method of the stream if it has one,
+        else the bytes are read and copied into the view.
+
+        :param view: The part of the message buffer to fill.
+        :type view: memoryview
+        :raises IOError if the stream could not fill the view.
+        """
+        length = len(view)
+        if hasattr(self.stream, 'readinto'):
+            read_bytes = self.stream.readinto(view)
+        else:
+            data = self.stream.read(length)
+            read_bytes = len(data)
+            view[:read_bytes] = data
+
+        if read_bytes != length:
+            raise IOError('expected %d bytes from the stream, got %d' % (length, read_bytes))
+
     @staticmethod
     def read_shared_object_event(body_stream, decoder):
         """
@@ -147,16 +388,15 @@ class RtmpReader:
         so_body_type = body_stream.read_uchar()
         so_body_size = body_stream.read_ulong()
 
-        event = {'type': so_body_type}
-        if event['type'] == rtmp_type.SO_USE:
+        if so_body_type == rtmp_type.SO_USE:
             assert so_body_size == 0, so_body_size
-            event['data'] = ''
+            data = ''
 
-        elif event['type'] == rtmp_type.SO_RELEASE:
+        elif so_body_type == rtmp_type.SO_RELEASE:
             assert so_body_size == 0, so_body_size
-            event['data'] = ''
+            data = ''
 
-        elif event['type'] == rtmp_type.SO_CHANGE:
+        elif so_body_type == rtmp_type.SO_CHANGE:
             start_pos = body_stream.tell()
             changes = {}
             while body_stream.tell() < start_pos + so_body_size:
@@ -166,29 +406,100 @@ class RtmpReader:
                 changes[attrib_name] = attrib_value
             assert body_stream.tell() == start_pos + so_body_size,\
                 (body_stream.tell(), start_pos, so_body_size)
-            event['data'] = changes
+            data = changes
 
-        elif event['type'] == rtmp_type.SO_SEND_MESSAGE:
+        elif so_body_type == rtmp_type.SO_SEND_MESSAGE:
             start_pos = body_stream.tell()
             msg_params = []
             while body_stream.tell() < start_pos + so_body_size:
                 msg_params.append(decoder.readElement())
             assert body_stream.tell() == start_pos + so_body_size,\
                 (body_stream.tell(), start_pos, so_body_size)
-            event['data'] = msg_params
+            data = msg_params
 
-        elif event['type'] == rtmp_type.SO_CLEAR:
+        elif so_body_type == rtmp_type.SO_CLEAR:
             assert so_body_size == 0, so_body_size
-            event['data'] = ''
+            data = ''
 
-        elif event['type'] == rtmp_type.SO_REMOVE:
-            event['data'] = decoder.readString()
+        elif so_body_type == rtmp_type.SO_REMOVE:
+            data = decoder.readString()
 
-        elif event['type'] == rtmp_type.SO_USE_SUCCESS:
+        elif so_body_type == rtmp_type.SO_USE_SUCCESS:
             assert so_body_size == 0, so_body_size
-            event['data'] = ''
+            data = ''
 
         else:
-            assert False, event['type']
+            assert False, so_body_type
 
-        return event
+        return message.SharedObjectEvent(so_body_type, data)
+
+
+class RtmpParser(RtmpReader):
+    """
+    A push style RTMP reader.
+
+    Instead of pulling bytes from a blocking stream, bytes are fed to the parser
+    in slices of any size as they arrive. Partial headers and bodies are kept
+    between feeds, so a single event loop can parse many connections.
+    """
+    def __init__(self):
+        RtmpReader.__init__(self, pyamf.util.BufferedByteStream())
+
+    def next(self):
+        """ Return the next message from the bytes fed so far.
+
+        :raises StopIteration if more bytes are needed.
+        """
+        while True:
+            complete = self._read_buffered_chunk()
+            if complete is None:
+                raise StopIteration
+            if complete is not False:
+                message = self.decode_message(*complete)
+                if message is not None:
+                    return message
+
+    def feed(self, data):
+        """ Feed bytes received from the remote server to the parser.
+
+        :param data: The received bytes.
+        :type data: str | bytearray | memoryview
+        :return: The messages completed by the fed bytes.
+        :rtype: list
+        """
+        pos = self.stream.tell()
+        self.stream.seek(0, 2)
+        self.stream.write(bytes(data))
+        self.stream.seek(pos)
+
+        messages = []
+        while True:
+            complete = self._read_buffered_chunk()
+            if complete is None:
+                break
+            if complete is not False:
+                message = self.decode_message(*complete)
+                if message is not None:
+                    messages.append(message)
+        self.stream.consume()
+        return messages
+
+    def _read_buffered_chunk(self):
+        """ Read one chunk from the buffered bytes.
+
+        :return: The header and body of a complete message, False if a chunk was read
+        but the message is not complete, or None if the buffer holds no complete chunk.
+        :rtype: tuple | bool | None
+        """
+        if self.stream.at_eof():
+            return None
+        pos = self.stream.tell()
+        try:
+            complete = self.read_chunk()
+        except IOError:
+            # not enough bytes for a complete chunk, wait for the next feed.
+            self.stream.seek(pos)
+            return None
+        if complete is None:
+            return False
+        return complete
@@ -0,0 +1,155 @@
+"""
+Futures for remote procedure calls made with RtmpClient.call_async
+
+Every call gets its own transaction id, and the future of the call is
+resolved when the _result or _error with the same transaction id arrives.
+
+Usage:
+    future = client.call_async('account', [u'123'])
+    try:
+        info = future.result(timeout=10)
+    except RpcTimeout:
+        ...
+    except RpcError as e:
+        print e.info
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class RpcError(Exception):
+    """ Raised when a remote procedure call failed. """
+    def __init__(self, message, info=None):
+        Exception.__init__(self, message)
+        # the values of the _error response, if any.
+        self.info = info
+
+
+class RpcTimeout(RpcError):
+    """ Raised when the response to a remote procedure call did not arrive in time. """
+    pass
+
+
+class RpcFuture(object):
+    """ The pending result of a remote procedure call. """
+
+    def __init__(self, trans_id, process_name, timeout=None):
+        """
+        Initialize the future.
+
+        :param trans_id: The transaction id of the call.
+        :type trans_id: int
+        :param process_name: The name of the remote method.
+        :type process_name: str
+        :param timeout: Seconds after which the call is given up on, None waits forever.
+        :type timeout: int | float | None
+        """
+        self.trans_id = trans_id
+        self.process_name = process_name
+        self.expires = None
+        if timeout is not None:
+            self.expires = time.time() + timeout
+
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def __repr__(self):
+        return '<RpcFuture %s %s done=%s>' % (self.trans_id, self.process_name, self.done())
+
+    def done(self):
+        """ Check if the call has been answered, failed or timed out. """
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Wait for the response to the call.
+
+        :param timeout: Seconds to wait, None waits until the call is done.
+        :type timeout: int | float | None
+        :return: The values following the command object of the _result,
+        a single value is returned as is, and None if there are no values.
+        :raises RpcTimeout if the response did not arrive within timeout.
+        :raises RpcError if the call failed.
+        """
+        if not self._event.wait(timeout):
+            raise RpcTimeout('no response to %s(%s) within %s seconds' %
+                             (self.process_name, self.trans_id, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """
+        Wait for the call, and return the exception it failed with.
+
+        :return: The exception, or None if the call succeeded.
+        :rtype: RpcError | None
+        :raises RpcTimeout if the response did not arrive within timeout.
+        """
+        if not self._event.wait(timeout):
+            raise RpcTimeout('no response to %s(%s) within %s seconds' %
+                             (self.process_name, self.trans_id, timeout))
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """
+        Call fn with the future once it is done.
+
+        If the future is already done, fn is called right away. Otherwise it is
+        called by the thread reading the connection, so it should not block.
+
+        :param fn: Callable taking the future as argument.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        self._run_callback(fn)
+
+    def set_response(self, command):
+        """
+        Resolve the future from a _result or _error command.
+
+        :param command: The decoded command.
+        :type command: list
+        """
+        values = list(command[3:])
+        if len(values) == 0:
+            value = None
+        elif len(values) == 1:
+            value = values[0]
+        else:
+            value = values
+
+        if command[0] == '_error':
+            self._finish(None, RpcError('%s(%s) failed: %s' % (self.process_name, self.trans_id, value), value))
+        else:
+            self._finish(value, None)
+
+    def set_exception(self, exception):
+        """ Fail the future with the exception. """
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            self._run_callback(fn)
+
+    def _run_callback(self, fn):
+        try:
+            fn(self)
+        except Exception as e:
+            log.error('rpc callback error for %s: %s' % (self, e), exc_info=True)
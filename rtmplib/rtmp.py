@@ -1,12 +1,14 @@
 import logging
+import os
 import random
 import socket
 import struct
+import threading
 import time
 
 import pyamf.util.pure
 
-from . import packet, reader, writer, rtmp_type, socks
+from . import command, handshake, reader, rpc, shared_object, writer, rtmp_type, socks
 
 
 log = logging.getLogger(__name__)
@@ -24,10 +26,31 @@ class FileDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
     """
     def __init__(self, fileobject):
         self.fileobject = fileobject
+        # the total amount of bytes read from the file object.
+        self.bytes_read = 0
         pyamf.util.pure.DataTypeMixIn.__init__(self)
 
     def read(self, length):
-        return self.fileobject.read(length)
+        data = self.fileobject.read(length)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buf):
+        """ Read bytes from the file object directly into a writable buffer.
+
+        :param buf: The buffer to fill.
+        :type buf: memoryview | bytearray
+        :return: The number of bytes read.
+        :rtype: int
+        """
+        if hasattr(self.fileobject, 'readinto'):
+            read = self.fileobject.readinto(buf)
+        else:
+            data = self.fileobject.read(len(buf))
+            buf[:len(data)] = data
+            read = len(data)
+        self.bytes_read += read
+        return read
 
     def write(self, data):
         self.fileobject.write(data)
@@ -40,6 +63,33 @@ class FileDataTypeMixIn(pyamf.util.pure.DataTypeMixIn):
         return False
 
 
+class SocketStream(object):
+    """ A write only stream sending everything written to it with a single sendall. """
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, data):
+        self.sock.sendall(data)
+
+    def flush(self):
+        pass
+
+
+class BufferStream(object):
+    """ A write only stream keeping everything written to it in memory. """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(str(data))
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
 class RtmpClient:
     """ Represents an RTMP client. """
     def __init__(self, ip, port, tc_url, app, **kwargs):
@@ -50,19 +100,52 @@ class RtmpClient:
         self.app = app
         self.page_url = kwargs.get('page_url', u'')
         self.swf_url = kwargs.get('swf_url', u'')
-        self.proxy = kwargs.get('proxy', '')
+        # a proxy in the format IP:PORT, or a pool of proxies like util.proxy_pool.ProxyPool,
+        # None (or an empty string) connects directly. An empty pool fails to connect instead.
+        self.proxy = kwargs.get('proxy')
+        if self.proxy == '':
+            self.proxy = None
+        # the proxy used by the current connection.
+        self.active_proxy = None
         self.is_win = kwargs.get('is_win', False)
         self.handle = kwargs.get('handle', True)
         self.flash_version = kwargs.get('flash_version', 'WIN 22.0.0.209')
-        self.shared_objects = []
+        self.chunk_size = kwargs.get('chunk_size', 4096)
+        # send the connect command along with C2, and queue calls until the connect result.
+        self.pipeline = kwargs.get('pipeline', False)
+        # seconds after which unanswered calls are given up on.
+        self.rpc_timeout = kwargs.get('rpc_timeout', 30)
+        # the shared objects in use, by name.
+        self.shared_objects = shared_object.SharedObjectStore()
         self.socket = None
         self.stream = None
         self.file = None
         self.writer = None
         self.reader = None
+        # the timings of the last handshake.
+        self.handshake_metrics = None
 
         self.stream_id = 0
         self._transaction_id = 2
+        # the futures of the calls waiting for a response, by transaction id.
+        self._calls = {}
+        self._calls_lock = threading.Lock()
+        self._next_expire_check = 0
+        self._create_stream_trans_id = None
+        # the future of the NetConnection connect, set by _connect_rtmp
+        self.connect_future = None
+
+        # the acknowledgement window set by the server, None until the server sets one.
+        self.window_ack_size = None
+        # the total amount of bytes received, and the amount last acknowledged.
+        self.bytes_received = 0
+        self._acknowledged = 0
+        # the sequence number of the last acknowledgement from the server.
+        self.peer_acknowledged = 0
+
+        # calls made before the connect result arrived, None when not queueing calls.
+        self._pending_calls = None
+        self._pending_lock = threading.Lock()
 
     @staticmethod
     def create_random_bytes(length, readable=False):
@@ -75,37 +158,44 @@ class RtmpClient:
         :return: A string of random bytes
         :rtype: str
         """
-        ran_bytes = ''
-        i, j = 0, 0xff
-        if readable:
-            i, j = 0x41, 0x7a
-        for x in xrange(0, length):
-            ran_bytes += chr(random.randint(i, j))
-        return ran_bytes
-
-    def handshake(self):
-        """ Perform the handshake sequence with the remote server. """
-        self.stream.write_uchar(3)
-        c1 = packet.Handshake()
-        c1.first = 0
-        c1.second = 0
-        c1.payload = self.create_random_bytes(1528)
-        c1.encode(self.stream)
-        self.stream.flush()
-
-        self.stream.read_uchar()
-        s1 = packet.Handshake()
-        s1.decode(self.stream)
-
-        c2 = packet.Handshake()
-        c2.first = s1.first
-        c2.second = s1.second
-        c2.payload = s1.payload
-        c2.encode(self.stream)
-        self.stream.flush()
-
-        s2 = packet.Handshake()
-        s2.decode(self.stream)
+        if not readable:
+            return os.urandom(length)
+        return ''.join([chr(random.randint(0x41, 0x7a)) for _ in xrange(length)])
+
+    def handshake(self, early_data=None):
+        """ Perform the handshake sequence with the remote server.
+
+        :param early_data: Bytes to send along with C2, before S2 is received.
+        :type early_data: str | None
+        """
+        self.handshake_metrics = handshake.perform(self.socket, early_data)
+        # the handshake bytes bypass the stream, but count towards the acknowledgements.
+        self.stream.bytes_read += handshake.S0_S1_S2_LENGTH
+        log.debug('handshake with %s:%s done %s' % (self.ip, self.port, self.handshake_metrics))
+
+    def _queue_calls(self):
+        """ Queue calls until the connect result arrives. """
+        with self._pending_lock:
+            self._pending_calls = []
+
+    def _send_pending_calls(self, connected):
+        """ Stop queueing calls, and send the queued calls in a single write.
+
+        :param connected: True if the connect succeeded, else the queued calls are dropped.
+        :type connected: bool
+        """
+        with self._pending_lock:
+            pending = self._pending_calls
+            self._pending_calls = None
+            if not pending:
+                return
+            if not connected:
+                log.warning('connect failed, dropping %s queued calls' % len(pending))
+                return
+            log.debug('sending %s queued calls' % len(pending))
+            with self.writer.batch():
+                for msg in pending:
+                    self.writer.write(msg)
 
     def _connect_rtmp(self, connect_params):
         """ Initiate a NetConnection with a Flash Media Server.
@@ -139,6 +229,27 @@ class RtmpClient:
         else:
             msg['command'].extend(connect_params)
 
+        self.connect_future = self._register_call(1, 'connect')
+        with self.writer.batch():
+            if self.chunk_size != self.writer.chunk_size:
+                self.set_chunk_size(self.chunk_size)
+            self.writer.write(msg)
+            self.writer.flush()
+
+    def set_chunk_size(self, chunk_size):
+        """ Announce a new outbound chunk size to the server, and split
+        all following messages by that size.
+
+        :param chunk_size: The chunk size, between 128 and 65536.
+        :type chunk_size: int
+        """
+        if not 128 <= chunk_size <= 65536:
+            raise ValueError('chunk size must be between 128 and 65536, got %s' % chunk_size)
+        msg = {
+            'msg': rtmp_type.DT_SET_CHUNK_SIZE,
+            'chunk_size': chunk_size
+        }
+        log.debug('setting outbound chunk size: %s' % chunk_size)
         self.writer.write(msg)
         self.writer.flush()
 
@@ -151,6 +262,8 @@ class RtmpClient:
         """
         try:
             amf_data = self.reader.next()
+            self.bytes_received = self.stream.bytes_read
+            self.acknowledge()
             if self.handle:
                 if self.handle_packet(amf_data):
                     log.debug('handled amf data: %s' % amf_data)
@@ -166,6 +279,16 @@ class RtmpClient:
         :return: True if the amf data was handled, else False.
         :rtype: bool
         """
+        if amf_data['msg'] == rtmp_type.DT_COMMAND:
+            # responses are still passed on to the application.
+            command = amf_data['command']
+            # the name is checked first, len() decodes all the arguments of a lazy command.
+            if command and command[0] in ('_result', '_error') and len(command) > 1:
+                if self._pending_calls is not None and command[1] == 1:
+                    self._send_pending_calls(command[0] == '_result')
+                self._resolve_call(command)
+        self._expire_calls()
+
         if amf_data['msg'] == rtmp_type.DT_USER_CONTROL and amf_data['event_type'] == rtmp_type.UC_PING_REQUEST:
             resp = {
                 'msg': rtmp_type.DT_USER_CONTROL,
@@ -182,15 +305,19 @@ class RtmpClient:
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_WINDOW_ACK_SIZE:
-            assert amf_data['window_ack_size'] == 2500000, amf_data
+            log.debug('window acknowledgement size set by server: %s' % amf_data['window_ack_size'])
+            self.window_ack_size = amf_data['window_ack_size']
             ack_msg = {'msg': rtmp_type.DT_WINDOW_ACK_SIZE, 'window_ack_size': amf_data['window_ack_size']}
             self.writer.write(ack_msg)
             self.writer.flush()
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_SET_PEER_BANDWIDTH:
-            assert amf_data['window_ack_size'] == 2500000, amf_data
-            assert amf_data['limit_type'] == 2, amf_data
+            self.writer.set_peer_bandwidth(amf_data['window_ack_size'], amf_data['limit_type'])
+            return True
+
+        elif amf_data['msg'] == rtmp_type.DT_ACKNOWLEDGEMENT:
+            self.peer_acknowledged = amf_data['sequence_number']
             return True
 
         elif amf_data['msg'] == rtmp_type.DT_USER_CONTROL and amf_data['event_type'] == rtmp_type.UC_STREAM_BEGIN:
@@ -203,9 +330,81 @@ class RtmpClient:
             self.reader.chunk_size = amf_data['chunk_size']
             return True
 
+        elif amf_data['msg'] in (rtmp_type.DT_SHARED_OBJECT, rtmp_type.DT_AMF3_SHARED_OBJECT):
+            # messages for shared objects not in use are passed on to the application.
+            return self.shared_objects.apply(amf_data) is not None
+
         else:
             return False
 
+    def _register_call(self, trans_id, process_name):
+        """ Create the future of a call waiting for a response.
+
+        :param trans_id: The transaction id of the call.
+        :type trans_id: int
+        :param process_name: The name of the remote method.
+        :type process_name: str
+        :return: The future of the call.
+        :rtype: rpc.RpcFuture
+        """
+        future = rpc.RpcFuture(trans_id, process_name, self.rpc_timeout)
+        with self._calls_lock:
+            self._calls[trans_id] = future
+        return future
+
+    def _resolve_call(self, command):
+        """ Resolve the future of the call a _result or _error responds to.
+
+        :param command: The _result or _error command.
+        :type command: list
+        """
+        with self._calls_lock:
+            future = self._calls.pop(command[1], None)
+        if future is not None:
+            future.set_response(command)
+
+    def _expire_calls(self):
+        """ Fail the calls that did not get a response within rpc_timeout, at most once a second. """
+        now = time.time()
+        if now < self._next_expire_check:
+            return
+        self._next_expire_check = now + 1
+        with self._calls_lock:
+            expired = [future for future in self._calls.values()
+                       if future.expires is not None and future.expires <= now]
+            for future in expired:
+                del self._calls[future.trans_id]
+        for future in expired:
+            future.set_exception(rpc.RpcTimeout('no response to %s(%s) within %s seconds' %
+                                                (future.process_name, future.trans_id, self.rpc_timeout)))
+
+    def _fail_calls(self, reason):
+        """ Fail all the calls waiting for a response.
+
+        :param reason: The reason the calls failed.
+        :type reason: str
+        """
+        with self._calls_lock:
+            calls = self._calls.values()
+            self._calls = {}
+        for future in calls:
+            future.set_exception(rpc.RpcError('%s(%s) failed: %s' % (future.process_name, future.trans_id, reason)))
+
+    def acknowledge(self):
+        """ Send an acknowledgement if a window worth of bytes was received since the last one. """
+        if not self.window_ack_size:
+            return
+        if self.bytes_received - self._acknowledged >= self.window_ack_size:
+            self._acknowledged = self.bytes_received
+            msg = {
+                'msg': rtmp_type.DT_ACKNOWLEDGEMENT,
+                # the sequence number wraps around at 4GB.
+                'sequence_number': self.bytes_received & 0xffffffff
+            }
+            log.debug('acknowledging %s bytes' % self.bytes_received)
+            self.writer.write(msg)
+            self.writer.flush()
+
     def is_create_stream_response(self, amf_data):
         """ Check amf data to determine if it is a createStream response.
 
@@ -214,8 +413,9 @@ class RtmpClient:
         :return: True if the amf data was considered a response to a createStream message, else False.
         :rtype: bool
         """
-        if amf_data['msg'] == rtmp_type.DT_COMMAND and len(amf_data['command']) is 4:
-            if amf_data['command'][0] == '_result' and type(amf_data['command'][3]) is int:
+        if amf_data['msg'] == rtmp_type.DT_COMMAND and amf_data['command'] and amf_data['command'][0] == '_result':
+            if amf_data['command'][1] == self._create_stream_trans_id and len(amf_data['command']) == 4:
+                self._create_stream_trans_id = None
                 log.info('create stream response received, stream id : %s' % amf_data['command'][3])
                 self.stream_id = amf_data['command'][3]
                 self.writer.stream_id = self.stream_id
@@ -229,18 +429,11 @@ class RtmpClient:
         :param connect_params: A list or dict containing application specific connect parameters
         :type connect_params: list | dict
         """
-        if self.proxy:
-            parts = self.proxy.split(':')
-            ip = parts[0]
-            port = int(parts[1])
-
-            ps = socks.socksocket()
-            ps.set_proxy(socks.HTTP, addr=ip, port=port)
-            self.socket = ps
+        if self.proxy is not None:
+            self.socket = self._connect_proxy()
         else:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        self.socket.connect((self.ip, self.port))
+            self.socket.connect((self.ip, self.port))
         self.file = self.socket.makefile()
         self.stream = FileDataTypeMixIn(self.file)
 
@@ -248,39 +441,165 @@ class RtmpClient:
         if self.is_win:
             self.socket.ioctl(socket.SIO_KEEPALIVE_VALS, (1, 10000, 3000))
 
-        self.handshake()
-
         self.reader = reader.RtmpReader(self.stream)
-        self.writer = writer.RtmpWriter(self.stream)
+        if self.pipeline:
+            # encode the connect sequence up front, so it goes out with C2.
+            early = BufferStream()
+            self.writer = writer.RtmpWriter(early)
+            self._queue_calls()
+            self._connect_rtmp(connect_params)
+            self.writer.stream = SocketStream(self.socket)
+            self.handshake(early.getvalue())
+        else:
+            self.handshake()
+            self.writer = writer.RtmpWriter(SocketStream(self.socket))
+            self._connect_rtmp(connect_params)
+
+    def _is_proxy_pool(self):
+        return hasattr(self.proxy, 'select')
+
+    def _select_proxy(self, exclude=()):
+        """ Set the proxy to use for the next connection.
+
+        :param exclude: Proxies of the pool not to use.
+        :type exclude: list
+        :return: The proxy, or None if the proxy pool has no proxy left to use.
+        :rtype: str | None
+        """
+        if self._is_proxy_pool():
+            self.active_proxy = self.proxy.select(exclude=exclude)
+        else:
+            self.active_proxy = self.proxy
+        return self.active_proxy
+
+    def _report_proxy(self, latency=None):
+        """ Report the outcome of a connection through the active proxy to the proxy pool.
+
+        :param latency: The seconds the connection took, None if it failed.
+        :type latency: float | None
+        """
+        if not self._is_proxy_pool() or self.active_proxy is None:
+            return
+        if latency is None:
+            self.proxy.report_failure(self.active_proxy)
+        else:
+            self.proxy.report_success(self.active_proxy, latency)
+
+    def _connect_proxy(self):
+        """ Connect to the remote server through the proxy.
+
+        With a proxy pool the next proxy is tried when a proxy fails,
+        up to the max_attempts of the pool.
+
+        :return: The connected socket.
+        :rtype: socks.SockSocket
+        :raises IOError if no proxy could connect.
+        """
+        attempts = 1
+        timeout = None
+        if self._is_proxy_pool():
+            attempts = self.proxy.max_attempts
+            timeout = self.proxy.timeout
+
+        tried = []
+        error = socks.GeneralProxyError('no proxy in %s' % self.proxy)
+        for _ in range(attempts):
+            if self._select_proxy(exclude=tried) is None:
+                break
+            tried.append(self.active_proxy)
+            ip, port = self._proxy_address()
 
-        self._connect_rtmp(connect_params)
+            ps = socks.socksocket()
+            ps.set_proxy(socks.HTTP, addr=ip, port=port)
+            ps.settimeout(timeout)
+            start = time.time()
+            try:
+                ps.connect((self.ip, self.port))
+            except IOError as e:
+                log.warning('connect through proxy %s failed: %s' % (self.active_proxy, e))
+                ps.close()
+                self._report_proxy()
+                error = e
+                continue
+            self._report_proxy(time.time() - start)
+            ps.settimeout(None)
+            log.debug('connected through proxy %s %s' % (self.active_proxy, ps.proxy_timings))
+            return ps
+        raise error
+
+    def _proxy_address(self):
+        """ The ip and port of the active proxy, from the IP:PORT proxy string.
+
+        :return: The proxy ip and port.
+        :rtype: tuple
+        """
+        parts = self.active_proxy.split(':')
+        return parts[0], int(parts[1])
 
     def shutdown(self):
         """ Closes the socket connection. """
+        self._fail_calls('connection closed')
         try:
             self.socket.shutdown(socket.SHUT_RDWR)
             self.socket.close()
         except socket.error as se:
             log.error('socket error %s' % se)
 
-    def shared_object_use(self, so):
-        """ Use a shared object and add it to the managed list of SOs. """
-        if so in self.shared_objects:
-            return
+    def batch(self):
+        """ Send the messages written inside a with block together, in one flush.
+
+        Usage:
+            with client.batch():
+                client.call('kick', [...])
+                client.call('forgive', [...])
+        """
+        return self.writer.batch()
+
+    def shared_object_use(self, so, persistent=False):
+        """ Use a shared object and add it to the managed shared objects.
+
+        :param so: The shared object, or the name of the shared object.
+        :type so: shared_object.SharedObject | str
+        :param persistent: Whether the shared object is persistent, when so is a name.
+        :type persistent: bool
+        :return: The shared object.
+        :rtype: shared_object.SharedObject
+        """
+        if not isinstance(so, shared_object.SharedObject):
+            existing = self.shared_objects.get(so)
+            if existing is not None:
+                return existing
+            so = shared_object.SharedObject(so, persistent)
+        elif so in self.shared_objects:
+            return so
+        self.shared_objects.add(so)
         so.use(self.reader, self.writer)
-        self.shared_objects.append(so)
+        return so
+
+    def shared_object_release(self, name):
+        """ Release a shared object and stop managing it.
+
+        :param name: The name of the shared object.
+        :type name: str
+        """
+        so = self.shared_objects.remove(name)
+        if so is not None:
+            so.release(self.writer)
 
     def _get_next_transaction_id(self):
         """ Get the next transaction ID. """
-        transaction_id = self._transaction_id
-        self._transaction_id += 1
-        if self._transaction_id > 8388607:
-            self._transaction_id = 2
-        return transaction_id
+        with self._calls_lock:
+            transaction_id = self._transaction_id
+            self._transaction_id += 1
+            if self._transaction_id > 8388607:
+                self._transaction_id = 2
+            return transaction_id
 
     def call(self, process_name, parameters=None, trans_id=0):
         """ Runs remote procedure calls (RPC) at the receiving end.
 
+        The call is fire and forget, use call_async for a call expecting a response.
+
         :param process_name: The name of the remote method
         :type process_name: str
         :param parameters: A list of parameters to pass to the remote method.
@@ -288,18 +607,36 @@ class RtmpClient:
         :param trans_id: The transaction Id for this call.
         :type trans_id: int
         """
+        self._expire_calls()
+        self._send_call(process_name, parameters, trans_id)
+
+    def call_async(self, process_name, parameters=None):
+        """ Runs a remote procedure call with a new transaction id, expecting a response.
+
+        :param process_name: The name of the remote method
+        :type process_name: str
+        :param parameters: A list of parameters to pass to the remote method.
+        :type parameters: list
+        :return: The future of the call, resolved by the _result or _error of the server.
+        :rtype: rpc.RpcFuture
+        """
+        self._expire_calls()
+        trans_id = self._get_next_transaction_id()
+        future = self._register_call(trans_id, process_name)
+        self._send_call(process_name, parameters, trans_id)
+        return future
+
+    def _send_call(self, process_name, parameters, trans_id):
         if parameters is None:
             parameters = []
-        msg = {
-            'msg': rtmp_type.DT_COMMAND,
-            'command':
-            [
-                process_name,
-                trans_id,
-                None
-            ]
-        }
-        msg['command'].extend(parameters)
+        # the name is encoded once per process name, only the transaction id and parameters are encoded here.
+        msg = command.get_template(process_name).message(trans_id, *parameters)
+
+        if self._pending_calls is not None:
+            with self._pending_lock:
+                if self._pending_calls is not None:
+                    self._pending_calls.append(msg)
+                    return
 
         self.writer.write(msg)
         self.writer.flush()
@@ -316,13 +653,21 @@ class RtmpClient:
         self.writer.flush()
 
     def createstream(self):
-        """ Send createStream message. """
+        """ Send createStream message.
+
+        :return: The future of the call, resolving to the stream id.
+        :rtype: rpc.RpcFuture
+        """
+        trans_id = self._get_next_transaction_id()
+        future = self._register_call(trans_id, 'createStream')
+        self._create_stream_trans_id = trans_id
         msg = {
             'msg': rtmp_type.DT_COMMAND,
-            'command': ['createStream', self._get_next_transaction_id(), None]
+            'command': ['createStream', trans_id, None]
         }
         self.writer.write(msg)
         self.writer.flush()
+        return future
 
     def closestream(self):
         """ Send closeStream message. """
@@ -53,6 +53,14 @@ UC_PING_REQUEST = 6
 
 UC_PING_RESPONSE = 7
 
+# === peer bandwidth limit types ===
+
+LIMIT_HARD = 0
+
+LIMIT_SOFT = 1
+
+LIMIT_DYNAMIC = 2
+
 # === shared object types ===
 
 SO_USE = 1
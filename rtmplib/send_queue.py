@@ -0,0 +1,163 @@
+"""
+A prioritized, rate limited queue of outgoing calls for one connection.
+
+Calls are queued by priority and sent in order of priority, then in the order
+they were queued, at the rate of a token bucket. A call that is already
+waiting in the queue is not queued again. Queueing never blocks, the calls
+are sent by a sender thread of the queue, so a slow connection only holds up
+its own calls.
+
+Usage:
+    queue = SendQueue(client, rate=3, burst=10)
+    queue.put([('kick', [u'nick', u'123'])], PRIORITY_MODERATION)
+    queue.put([('privmsg', [u'..', u'#262626,en'])], PRIORITY_CHAT)
+"""
+import heapq
+import itertools
+import logging
+import threading
+
+from . import writer
+
+log = logging.getLogger(__name__)
+
+# connection setup, like authentication and the nick.
+PRIORITY_CONTROL = 0
+# kicks, bans, forgives and such.
+PRIORITY_MODERATION = 1
+# media broadcast control messages.
+PRIORITY_MEDIA = 2
+# chat and private messages.
+PRIORITY_CHAT = 3
+
+
+def _coalesce_key(calls):
+    try:
+        key = tuple((name, tuple(params or ())) for name, params in calls)
+        hash(key)
+        return key
+    except TypeError:
+        # unhashable parameters, like dicts, are never coalesced.
+        return None
+
+
+class SendQueue(object):
+    """ Sends the calls of one connection by priority, at a limited rate. Thread safe. """
+
+    def __init__(self, client, rate=3, burst=10, max_size=500, started=True, name='send-queue'):
+        """
+        Create a send queue.
+
+        :param client: The connected client to make the calls with.
+        :type client: rtmp.RtmpClient
+        :param rate: The calls per second.
+        :type rate: int | float
+        :param burst: The calls that may be sent at once after a quiet period.
+        :type burst: int
+        :param max_size: The maximum amount of queued entries.
+        :type max_size: int
+        :param started: False holds the calls until start() is called, for a client still connecting.
+        :type started: bool
+        :param name: The name of the sender thread.
+        :type name: str
+        """
+        self.client = client
+        self.limiter = writer.RateLimiter(rate, burst)
+        self.max_size = max_size
+        self.name = name
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+        self._heap = []
+        self._keys = set()
+        self._counter = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closed = False
+        if started:
+            self.start()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, calls, priority=PRIORITY_CHAT):
+        """
+        Queue calls to be sent together, in one flush.
+
+        :param calls: The calls as (process name, parameters) tuples.
+        :type calls: list
+        :param priority: The priority, lower is sent first.
+        :type priority: int
+        :return: True if the calls were queued, False if they were coalesced with
+        the same calls already in the queue, or dropped.
+        :rtype: bool
+        """
+        key = _coalesce_key(calls)
+        with self._condition:
+            if self._closed:
+                return False
+            if key is not None and key in self._keys:
+                self.coalesced += 1
+                return False
+            if len(self._heap) >= self.max_size:
+                self.dropped += 1
+                log.warning('send queue is full (%s), dropping %s' % (self.max_size, calls[0][0]))
+                return False
+            if key is not None:
+                self._keys.add(key)
+            heapq.heappush(self._heap, (priority, next(self._counter), calls, key))
+            # the new calls may go before the calls the sender is waiting on.
+            self._condition.notify()
+        return True
+
+    def start(self):
+        """ Start sending the calls, once the client is connected. """
+        with self._condition:
+            if self._closed or self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        """ Stop sending, and drop the queued calls. """
+        with self._condition:
+            self._closed = True
+            self._heap = []
+            self._keys.clear()
+            self._condition.notify()
+
+    def _run(self):
+        """ Send the queued calls as the rate allows, until closed. """
+        while True:
+            with self._condition:
+                calls = None
+                while calls is None:
+                    if self._closed:
+                        return
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    # a batch larger than the burst could never fit the bucket, it takes a full bucket instead.
+                    cost = min(len(self._heap[0][2]), self.limiter.burst)
+                    delay = self.limiter.delay(cost)
+                    if delay > 0:
+                        self._condition.wait(delay)
+                        continue
+                    self.limiter.consume(cost)
+                    _, _, calls, key = heapq.heappop(self._heap)
+                    self._keys.discard(key)
+            self._send(calls)
+
+    def _send(self, calls):
+        try:
+            if len(calls) == 1:
+                self.client.call(*calls[0])
+            else:
+                with self.client.batch():
+                    for name, params in calls:
+                        self.client.call(name, params)
+            self.sent += len(calls)
+        except Exception as e:
+            log.error('send queue error sending %s: %s' % (calls[0][0], e), exc_info=True)
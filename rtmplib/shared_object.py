@@ -0,0 +1,240 @@
+"""
+Remote shared objects, kept up to date from the shared object messages of the server.
+
+The events of each shared object message are applied to the data of the
+shared object as they arrive, and the handlers subscribed to an attribute are
+called with the attributes that actually changed.
+
+Usage:
+    so = client.shared_object_use('users')
+    so.subscribe(on_topic, 'topic')  # on_topic(so, 'topic', value, old_value)
+    ...
+    so['topic']
+"""
+import logging
+import struct
+import threading
+
+from . import rtmp_type
+
+log = logging.getLogger(__name__)
+
+# the value of an attribute that was removed or cleared, passed to subscribers.
+REMOVED = object()
+
+# the flag of a persistent shared object.
+FLAG_PERSISTENT = 2
+
+
+class SharedObject(object):
+    """ A remote shared object. """
+
+    def __init__(self, name, persistent=False):
+        """
+        Initialize the shared object.
+
+        :param name: The name of the shared object.
+        :type name: str
+        :param persistent: Whether the shared object is persistent on the server.
+        :type persistent: bool
+        """
+        self.name = name
+        self.persistent = persistent
+        # the attributes of the shared object.
+        self.data = {}
+        # the version of the last message applied.
+        self.version = 0
+        self.use_success = False
+        # attribute name -> handlers, the handlers of None are called for every attribute.
+        self._subscribers = {}
+        self._message_subscribers = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<SharedObject %s version=%s attributes=%s>' % (self.name, self.version, len(self.data))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def subscribe(self, fn, attribute=None):
+        """
+        Call fn when an attribute changes.
+
+        :param fn: Callable taking the shared object, the attribute name, the new value
+        and the old value. The new value is REMOVED when the attribute is removed, and
+        the old value is REMOVED when the attribute is new.
+        :param attribute: The name of the attribute, None for all attributes.
+        :type attribute: str | None
+        """
+        with self._lock:
+            self._subscribers.setdefault(attribute, []).append(fn)
+
+    def unsubscribe(self, fn, attribute=None):
+        """ Stop calling fn when an attribute changes. """
+        with self._lock:
+            handlers = self._subscribers.get(attribute)
+            if handlers is not None and fn in handlers:
+                handlers.remove(fn)
+                if not handlers:
+                    del self._subscribers[attribute]
+
+    def subscribe_messages(self, fn):
+        """
+        Call fn with the arguments of the messages sent on the shared object. (SO_SEND_MESSAGE)
+
+        :param fn: Callable taking the shared object and a list of arguments.
+        """
+        with self._lock:
+            self._message_subscribers.append(fn)
+
+    def use(self, rtmp_reader, rtmp_writer):
+        """
+        Ask the server to use the shared object.
+
+        :param rtmp_reader: The reader of the connection. (unused, kept for compatibility)
+        :param rtmp_writer: The writer of the connection.
+        :type rtmp_writer: writer.RtmpWriter
+        """
+        self._send_event(rtmp_writer, rtmp_type.SO_USE)
+
+    def release(self, rtmp_writer):
+        """
+        Tell the server the shared object is no longer used.
+
+        :param rtmp_writer: The writer of the connection.
+        :type rtmp_writer: writer.RtmpWriter
+        """
+        self._send_event(rtmp_writer, rtmp_type.SO_RELEASE)
+        self.use_success = False
+
+    def _send_event(self, rtmp_writer, event_type):
+        flags = struct.pack('!I', FLAG_PERSISTENT if self.persistent else 0) + '\x00' * 4
+        rtmp_writer.write({
+            'msg': rtmp_type.DT_SHARED_OBJECT,
+            'obj_name': self.name,
+            'curr_version': 0,
+            'flags': flags,
+            'events': [{'type': event_type, 'data': ''}]
+        })
+        rtmp_writer.flush()
+
+    def apply(self, message):
+        """
+        Apply the events of a shared object message.
+
+        A message older than the last applied message is ignored.
+
+        :param message: A shared object message from the RtmpReader.
+        :type message: dict
+        :return: The names of the attributes that changed.
+        :rtype: list
+        """
+        notifications = []
+        messages = []
+        with self._lock:
+            version = message['curr_version']
+            if version < self.version:
+                log.debug('ignoring version %s of %s, at version %s' % (version, self.name, self.version))
+                return []
+            self.version = version
+
+            for event in message['events']:
+                event_type = event['type']
+                if event_type == rtmp_type.SO_CHANGE:
+                    for name, value in event['data'].iteritems():
+                        old_value = self.data.get(name, REMOVED)
+                        if old_value is not REMOVED and old_value == value:
+                            continue
+                        self.data[name] = value
+                        notifications.append((name, value, old_value))
+
+                elif event_type == rtmp_type.SO_REMOVE:
+                    name = event['data']
+                    if name in self.data:
+                        notifications.append((name, REMOVED, self.data.pop(name)))
+
+                elif event_type == rtmp_type.SO_CLEAR:
+                    for name, old_value in self.data.iteritems():
+                        notifications.append((name, REMOVED, old_value))
+                    self.data = {}
+
+                elif event_type == rtmp_type.SO_USE_SUCCESS:
+                    self.use_success = True
+
+                elif event_type == rtmp_type.SO_SEND_MESSAGE:
+                    messages.append(event['data'])
+
+            handlers = dict((k, list(v)) for k, v in self._subscribers.iteritems())
+            message_handlers = list(self._message_subscribers)
+
+        # the handlers are called outside the lock, so they may subscribe and read the data.
+        any_handlers = handlers.get(None, [])
+        for name, value, old_value in notifications:
+            for fn in handlers.get(name, []) + any_handlers:
+                self._run_handler(fn, name, value, old_value)
+        for params in messages:
+            for fn in message_handlers:
+                self._run_handler(fn, params)
+        return [name for name, _, _ in notifications]
+
+    def _run_handler(self, fn, *args):
+        try:
+            fn(self, *args)
+        except Exception as e:
+            log.error('shared object handler error for %s: %s' % (self.name, e), exc_info=True)
+
+
+class SharedObjectStore(object):
+    """ The shared objects of a connection, by name. """
+
+    def __init__(self):
+        self._objects = {}
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, so):
+        if isinstance(so, SharedObject):
+            return self._objects.get(so.name) is so
+        return so in self._objects
+
+    def __iter__(self):
+        return iter(self._objects.values())
+
+    def get(self, name):
+        """
+        Get a shared object by name.
+
+        :param name: The name of the shared object.
+        :type name: str
+        :rtype: SharedObject | None
+        """
+        return self._objects.get(name)
+
+    def add(self, so):
+        """ Add a shared object, replacing one with the same name. """
+        self._objects[so.name] = so
+
+    def remove(self, name):
+        """ Remove a shared object by name. """
+        return self._objects.pop(name, None)
+
+    def apply(self, message):
+        """
+        Apply a shared object message to the shared object it is for.
+
+        :param message: A shared object message from the RtmpReader.
+        :type message: dict
+        :return: The shared object, or None if the message is for a unknown shared object.
+        :rtype: SharedObject | None
+        """
+        so = self._objects.get(message['obj_name'])
+        if so is not None:
+            so.apply(message)
+        return so
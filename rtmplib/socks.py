@@ -57,6 +57,7 @@ Modifications made by Anorov (https://github.com/Anorov)
 
 import socket
 import struct
+import time
 from errno import EOPNOTSUPP, EINVAL, EAGAIN
 from io import BytesIO
 from os import SEEK_CUR
@@ -175,10 +176,6 @@ def wrap_module(module):
 wrapmodule = wrap_module
 
 
-def socksocket():
-    pass
-
-
 def create_connection(dest_pair, proxy_type=None, proxy_addr=None,
                       proxy_port=None, proxy_rdns=True,
                       proxy_username=None, proxy_password=None,
@@ -270,6 +267,340 @@ def _read_socks5_address(filezz):
     return addr, port
 
 
+def _write_socks5_address(addr, filed, rdns):
+    """
+    Write the host and port packed for the SOCKS5 protocol,
+    and return the resolved address as a tuple object.
+    """
+    host, port = addr
+
+    # If the given destination address is an IP address, we'll
+    # use the IPv4 address request even if remote resolving was specified.
+    try:
+        addr_bytes = socket.inet_aton(host)
+        filed.write(b"\x01" + addr_bytes)
+        host = socket.inet_ntoa(addr_bytes)
+    except socket.error:
+        # Well it's not an IP number, so it's probably a DNS name.
+        if rdns:
+            # Resolve remotely
+            host_bytes = host.encode('idna')
+            filed.write(b"\x03" + chr(len(host_bytes)).encode() + host_bytes)
+        else:
+            # Resolve locally
+            addr_bytes = socket.inet_aton(socket.gethostbyname(host))
+            filed.write(b"\x01" + addr_bytes)
+            host = socket.inet_ntoa(addr_bytes)
+
+    filed.write(struct.pack(">H", port))
+    return host, port
+
+
+class ProxyNegotiator(object):
+    """
+    Negotiates a connection through a proxy without doing any I/O itself.
+
+    Supports SOCKS4, SOCKS4a, SOCKS5 and HTTP CONNECT. The owner sends the bytes
+    returned by data_to_send() to the proxy, and feeds the bytes received from the
+    proxy to feed() until done is True. bytes_needed tells a blocking reader how
+    many bytes to read without reading past the proxy response, it is None while
+    the end of a HTTP response header is searched for.
+
+    Usage:
+        negotiator = ProxyNegotiator(SOCKS5, 'example.com', 1935)
+        sock.sendall(negotiator.data_to_send())
+        while not negotiator.done:
+            negotiator.feed(sock.recv(negotiator.bytes_needed or 4096))
+            sock.sendall(negotiator.data_to_send())
+    """
+
+    def __init__(self, proxy_type, dest_addr, dest_port, rdns=True, username=None, password=None,
+                 command=b"\x01"):
+        """
+        :param proxy_type: SOCKS4, SOCKS5 or HTTP
+        :param dest_addr: The destination host name or IP address.
+        :param dest_port: The destination port.
+        :param rdns: Let the proxy resolve host names.
+        :param username: SOCKS5 user name, or SOCKS4 user id.
+        :param password: SOCKS5 password.
+        :param command: The SOCKS5 command, CONNECT by default.
+        """
+        if proxy_type not in (SOCKS4, SOCKS5, HTTP):
+            raise GeneralProxyError("Invalid proxy type")
+        self.proxy_type = proxy_type
+        self.dest_addr = dest_addr
+        self.dest_port = dest_port
+        self.rdns = rdns
+        self.username = username
+        self.password = password
+        self.command = command
+
+        self.done = False
+        # the bytes received past the end of the proxy response.
+        self.remainder = b""
+        # the bound address at the proxy and the address the proxy connected to.
+        self.proxy_sockname = None
+        self.proxy_peername = None
+        # the seconds each phase of the negotiation took.
+        self.timings = {}
+
+        self._out = []
+        self._in = bytearray()
+        self._state = None
+        self._phase_start = time.time()
+        self._started = self._phase_start
+
+        if proxy_type == SOCKS4:
+            self._start_socks4()
+        elif proxy_type == SOCKS5:
+            self._start_socks5()
+        else:
+            self._start_http()
+
+    @property
+    def bytes_needed(self):
+        """ The bytes needed to make progress, None if unknown. """
+        if self.done:
+            return 0
+        if self._state == 'http':
+            return None
+        return max(1, self._expect - len(self._in))
+
+    def data_to_send(self):
+        """ Get the bytes that should be sent to the proxy. """
+        data = b"".join(self._out)
+        self._out = []
+        return data
+
+    def feed(self, data):
+        """
+        Process bytes received from the proxy.
+
+        :param data: The received bytes.
+        :type data: str
+        :raises ProxyError if the proxy refused or sent invalid data.
+        """
+        if self.done:
+            self.remainder += data
+            return
+        if not data:
+            raise GeneralProxyError("Connection closed unexpectedly")
+        self._in += data
+        while not self.done:
+            if self._state == 'http':
+                end = self._in.find(b"\r\n\r\n")
+                if end == -1:
+                    if len(self._in) > 16384:
+                        raise GeneralProxyError("HTTP proxy server sent a too large response header")
+                    return
+                response = bytes(self._in[:end + 4])
+                del self._in[:end + 4]
+                self._http_response(response)
+            else:
+                if len(self._in) < self._expect:
+                    return
+                handler = getattr(self, '_' + self._state)
+                # handlers take what they need, or raise the amount they need.
+                handler()
+        self.remainder = bytes(self._in)
+        self._in = bytearray()
+
+    def _phase(self, name):
+        """ Record the duration of a phase of the negotiation. """
+        now = time.time()
+        self.timings[name] = now - self._phase_start
+        self._phase_start = now
+
+    def _finish(self):
+        self._phase('request')
+        self.timings['total'] = time.time() - self._started
+        self.done = True
+
+    def _take(self, count):
+        data = bytes(self._in[:count])
+        del self._in[:count]
+        return data
+
+    # SOCKS4(a)
+    def _start_socks4(self):
+        self._remote_resolve = False
+        try:
+            self._addr_bytes = socket.inet_aton(self.dest_addr)
+        except socket.error:
+            if self.rdns:
+                self._addr_bytes = b"\x00\x00\x00\x01"
+                self._remote_resolve = True
+            else:
+                self._addr_bytes = socket.inet_aton(socket.gethostbyname(self.dest_addr))
+
+        request = [struct.pack(">BBH", 0x04, 0x01, self.dest_port), self._addr_bytes]
+        if self.username:
+            request.append(self.username)
+        request.append(b"\x00")
+        if self._remote_resolve:
+            # SOCKS4a
+            request.append(self.dest_addr.encode('idna') + b"\x00")
+        self._out.append(b"".join(request))
+        self._state = 'socks4_response'
+        self._expect = 8
+
+    def _socks4_response(self):
+        resp = self._take(8)
+        if resp[0:1] != b"\x00":
+            raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
+        status = ord(resp[1:2])
+        if status != 0x5A:
+            error = SOCKS4_ERRORS.get(status, "Unknown error")
+            raise SOCKS4Error("{0:#04x}: {1}".format(status, error))
+
+        self.proxy_sockname = (socket.inet_ntoa(resp[4:]), struct.unpack(">H", resp[2:4])[0])
+        if self._remote_resolve:
+            self.proxy_peername = socket.inet_ntoa(self._addr_bytes), self.dest_port
+        else:
+            self.proxy_peername = self.dest_addr, self.dest_port
+        self._finish()
+
+    # SOCKS5
+    def _start_socks5(self):
+        if self.username and self.password:
+            self._out.append(b"\x05\x02\x00\x02")
+        else:
+            self._out.append(b"\x05\x01\x00")
+        self._state = 'socks5_method'
+        self._expect = 2
+
+    def _socks5_method(self):
+        chosen_auth = self._take(2)
+        if chosen_auth[0:1] != b"\x05":
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+        if chosen_auth[1:2] == b"\x02":
+            if not (self.username and self.password):
+                raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+            self._out.append(b"\x01" + chr(len(self.username)).encode() + self.username +
+                             chr(len(self.password)).encode() + self.password)
+            self._state = 'socks5_auth'
+            self._expect = 2
+        elif chosen_auth[1:2] == b"\x00":
+            self._phase('auth')
+            self._socks5_request()
+        elif chosen_auth[1:2] == b"\xFF":
+            raise SOCKS5AuthError("All offered SOCKS5 authentication methods were rejected")
+        else:
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+
+    def _socks5_auth(self):
+        auth_status = self._take(2)
+        if auth_status[0:1] != b"\x01":
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+        if auth_status[1:2] != b"\x00":
+            raise SOCKS5AuthError("SOCKS5 authentication failed")
+        self._phase('auth')
+        self._socks5_request()
+
+    def _socks5_request(self):
+        address = BytesIO()
+        self.proxy_peername = _write_socks5_address((self.dest_addr, self.dest_port), address, self.rdns)
+        self._out.append(b"\x05" + self.command + b"\x00" + address.getvalue())
+        self._state = 'socks5_reply'
+        # version, reply, reserved, address type and the first byte of the address.
+        self._expect = 5
+
+    def _socks5_reply(self):
+        resp = bytes(self._in[:5])
+        if resp[0:1] != b"\x05":
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+        status = ord(resp[1:2])
+        if status != 0x00:
+            error = SOCKS5_ERRORS.get(status, "Unknown error")
+            raise SOCKS5Error("{0:#04x}: {1}".format(status, error))
+
+        atyp = resp[3:4]
+        if atyp == b"\x01":
+            length = 4 + 4 + 2
+        elif atyp == b"\x03":
+            length = 4 + 1 + ord(resp[4:5]) + 2
+        elif atyp == b"\x04":
+            length = 4 + 16 + 2
+        else:
+            raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
+        if len(self._in) < length:
+            self._expect = length
+            return
+
+        reply = self._take(length)
+        if atyp == b"\x01":
+            host = socket.inet_ntoa(reply[4:8])
+        elif atyp == b"\x03":
+            host = reply[5:-2]
+        else:
+            host = reply[4:20]
+        self.proxy_sockname = (host, struct.unpack(">H", reply[-2:])[0])
+        self._finish()
+
+    # HTTP CONNECT
+    def _start_http(self):
+        self._http_addr = self.dest_addr if self.rdns else socket.gethostbyname(self.dest_addr)
+        self._out.append(b"CONNECT " + self._http_addr.encode('idna') + b":" + str(self.dest_port).encode() +
+                         b" HTTP/1.1\r\n" + b"Host: " + self.dest_addr.encode('idna') + b"\r\n\r\n")
+        self._state = 'http'
+
+    def _http_response(self, response):
+        status_line = response.split(b"\r\n", 1)[0]
+        try:
+            proto, status_code, status_msg = status_line.split(" ", 2)
+        except ValueError:
+            raise GeneralProxyError("HTTP proxy server sent invalid response")
+
+        if not proto.startswith("HTTP/"):
+            raise GeneralProxyError("Proxy server does not appear to be an HTTP proxy")
+
+        try:
+            status_code = int(status_code)
+        except ValueError:
+            raise HTTPError("HTTP proxy server did not return a valid HTTP status")
+
+        if status_code != 200:
+            error = "{0}: {1}".format(status_code, status_msg)
+            if status_code in (400, 403, 405):
+                error += ("\n[*] Note: The HTTP proxy server may not be supported by PySocks"
+                          " (must be a CONNECT tunnel proxy)")
+            raise HTTPError(error)
+
+        self.proxy_sockname = (b"0.0.0.0", 0)
+        self.proxy_peername = self._http_addr, self.dest_port
+        self._finish()
+
+
+def negotiate(sock, negotiator):
+    """
+    Run a ProxyNegotiator on a connected blocking socket.
+
+    Reads never go past the end of the proxy response, the HTTP response header
+    is found by peeking at the socket first.
+
+    :param sock: A socket connected to the proxy.
+    :param negotiator: The negotiator.
+    :type negotiator: ProxyNegotiator
+    """
+    sock.sendall(negotiator.data_to_send())
+    while not negotiator.done:
+        needed = negotiator.bytes_needed
+        if needed is None:
+            peeked = sock.recv(4096, socket.MSG_PEEK)
+            if not peeked:
+                raise GeneralProxyError("Connection closed unexpectedly")
+            end = (bytes(negotiator._in) + peeked).find(b"\r\n\r\n")
+            if end == -1:
+                needed = len(peeked)
+            else:
+                needed = end + 4 - len(negotiator._in)
+        negotiator.feed(sock.recv(needed))
+        data = negotiator.data_to_send()
+        if data:
+            sock.sendall(data)
+
+
 # noinspection PyTypeChecker
 class SockSocket(_BaseSocket):
     """socksocket([family[, type[, proto]]]) -> socket object
@@ -296,6 +627,8 @@ class SockSocket(_BaseSocket):
             self.proxy = (None, None, None, None, None, None)
         self.proxy_sockname = None
         self.proxy_peername = None
+        # the seconds each phase of the last proxy connect took.
+        self.proxy_timings = {}
 
     def set_proxy(self, proxy_type=None, addr=None, port=None, rdns=True, username=None, password=None):
         """set_proxy(proxy_type, addr[, port[, rdns[, username[, password]]]])
@@ -437,14 +770,16 @@ class SockSocket(_BaseSocket):
 
     getpeername = get_peername
 
-    # noinspection PyTypeChecker
-    def _negotiate_socks5(self, *dest_addr):
+    def _negotiate(self, dest_addr, dest_port):
         """
-        Negotiates a stream connection through a SOCKS5 server.
+        Negotiates a stream connection through the proxy.
         """
-        c_o_n_n_e_c_t = b"\x01"
-        self.proxy_peername, self.proxy_sockname = self._socks5_request(self,
-                                                                        c_o_n_n_e_c_t, dest_addr)
+        proxy_type, addr, port, rdns, username, password = self.proxy
+        negotiator = ProxyNegotiator(proxy_type, dest_addr, dest_port, rdns, username, password)
+        negotiate(self, negotiator)
+        self.proxy_sockname = negotiator.proxy_sockname
+        self.proxy_peername = negotiator.proxy_peername
+        self.proxy_timings.update(negotiator.timings)
 
     def _socks5_request(self, conn, cmd, dst):
         """
@@ -452,219 +787,16 @@ class SockSocket(_BaseSocket):
         address (DST field). Returns resolved DST address that was used.
         """
         proxy_type, addr, port, rdns, username, password = self.proxy
-
-        writer = conn.makefile("wb")
-        reader = conn.makefile("rb", 0)  # buffering=0 renamed in Python 3
-        try:
-            # First we'll send the authentication packages we support.
-            if username and password:
-                # The username/password details were supplied to the
-                # set_proxy method so we support the USERNAME/PASSWORD
-                # authentication (in addition to the standard none).
-                writer.write(b"\x05\x02\x00\x02")
-            else:
-                # No username/password were entered, therefore we
-                # only support connections with no authentication.
-                writer.write(b"\x05\x01\x00")
-
-            # We'll receive the server's response to determine which
-            # method was selected
-            writer.flush()
-            chosen_auth = _readall(reader, 2)
-
-            if chosen_auth[0:1] != b"\x05":
-                # Note: string[i:i+1] is used because indexing of a bytestring
-                # via bytestring[i] yields an integer in Python 3
-                raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-
-            # Check the chosen authentication method
-
-            if chosen_auth[1:2] == b"\x02":
-                # Okay, we need to perform a basic username/password
-                # authentication.
-                writer.write(b"\x01" + chr(len(username)).encode()
-                             + username
-                             + chr(len(password)).encode() + password)
-                writer.flush()
-                auth_status = _readall(reader, 2)
-                if auth_status[0:1] != b"\x01":
-                    # Bad response
-                    raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-                if auth_status[1:2] != b"\x00":
-                    # Authentication failed
-                    raise SOCKS5AuthError("SOCKS5 authentication failed")
-
-                    # Otherwise, authentication succeeded
-
-            # No authentication is required if 0x00
-            elif chosen_auth[1:2] != b"\x00":
-                # Reaching here is always bad
-                if chosen_auth[1:2] == b"\xFF":
-                    raise SOCKS5AuthError("All offered SOCKS5 authentication methods were rejected")
-                else:
-                    raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-
-            # Now we can request the actual connection
-            writer.write(b"\x05" + cmd + b"\x00")
-            resolved = self._write_socks5_address(dst, writer)
-            writer.flush()
-
-            # Get the response
-            resp = _readall(reader, 3)
-            if resp[0:1] != b"\x05":
-                raise GeneralProxyError("SOCKS5 proxy server sent invalid data")
-
-            status = ord(resp[1:2])
-            if status != 0x00:
-                # Connection failed: server returned an error
-                error = SOCKS5_ERRORS.get(status, "Unknown error")
-                raise SOCKS5Error("{0:#04x}: {1}".format(status, error))
-
-            # Get the bound address/port
-            bnd = _read_socks5_address(reader)
-            return resolved, bnd
-        finally:
-            reader.close()
-            writer.close()
+        negotiator = ProxyNegotiator(SOCKS5, dst[0], dst[1], rdns, username, password, command=cmd)
+        negotiate(conn, negotiator)
+        return negotiator.proxy_peername, negotiator.proxy_sockname
 
     def _write_socks5_address(self, addr, filed):
         """
         Return the host and port packed for the SOCKS5 protocol,
         and the resolved address as a tuple object.
         """
-        host, port = addr
-        proxy_type, _, _, rdns, username, password = self.proxy
-
-        # If the given destination address is an IP address, we'll
-        # use the IPv4 address request even if remote resolving was specified.
-        try:
-            addr_bytes = socket.inet_aton(host)
-            filed.write(b"\x01" + addr_bytes)
-            host = socket.inet_ntoa(addr_bytes)
-        except socket.error:
-            # Well it's not an IP number, so it's probably a DNS name.
-            if rdns:
-                # Resolve remotely
-                host_bytes = host.encode('idna')
-                filed.write(b"\x03" + chr(len(host_bytes)).encode() + host_bytes)
-            else:
-                # Resolve locally
-                addr_bytes = socket.inet_aton(socket.gethostbyname(host))
-                filed.write(b"\x01" + addr_bytes)
-                host = socket.inet_ntoa(addr_bytes)
-
-        filed.write(struct.pack(">H", port))
-        return host, port
-
-    def _negotiate_socks4(self, dest_addr, dest_port):
-        """
-        Negotiates a connection through a SOCKS4 server.
-        """
-        proxy_type, addr, port, rdns, username, password = self.proxy
-
-        writer = self.makefile("wb")
-        reader = self.makefile("rb", 0)  # buffering=0 renamed in Python 3
-        try:
-            # Check if the destination address provided is an IP address
-            remote_resolve = False
-            try:
-                addr_bytes = socket.inet_aton(dest_addr)
-            except socket.error:
-                # It's a DNS name. Check where it should be resolved.
-                if rdns:
-                    addr_bytes = b"\x00\x00\x00\x01"
-                    remote_resolve = True
-                else:
-                    addr_bytes = socket.inet_aton(socket.gethostbyname(dest_addr))
-
-            # Construct the request packet
-            writer.write(struct.pack(">BBH", 0x04, 0x01, dest_port))
-            writer.write(addr_bytes)
-
-            # The username parameter is considered userid for SOCKS4
-            if username:
-                writer.write(username)
-            writer.write(b"\x00")
-
-            # DNS name if remote resolving is required
-            # NOTE: This is actually an extension to the SOCKS4 protocol
-            # called SOCKS4A and may not be supported in all cases.
-            if remote_resolve:
-                writer.write(dest_addr.encode('idna') + b"\x00")
-            writer.flush()
-
-            # Get the response from the server
-            resp = _readall(reader, 8)
-            if resp[0:1] != b"\x00":
-                # Bad data
-                raise GeneralProxyError("SOCKS4 proxy server sent invalid data")
-
-            status = ord(resp[1:2])
-            if status != 0x5A:
-                # Connection failed: server returned an error
-                error = SOCKS4_ERRORS.get(status, "Unknown error")
-                raise SOCKS4Error("{0:#04x}: {1}".format(status, error))
-
-            # Get the bound address/port
-            self.proxy_sockname = (socket.inet_ntoa(resp[4:]), struct.unpack(">H", resp[2:4])[0])
-            if remote_resolve:
-                self.proxy_peername = socket.inet_ntoa(addr_bytes), dest_port
-            else:
-                self.proxy_peername = dest_addr, dest_port
-        finally:
-            reader.close()
-            writer.close()
-
-    def _negotiate_http(self, dest_addr, dest_port):
-        """
-        Negotiates a connection through an HTTP server.
-        NOTE: This currently only supports HTTP CONNECT-style proxies.
-        """
-        proxy_type, addr, port, rdns, username, password = self.proxy
-
-        # If we need to resolve locally, we do this now
-        addr = dest_addr if rdns else socket.gethostbyname(dest_addr)
-
-        self.sendall(b"CONNECT " + addr.encode('idna') + b":" + str(dest_port).encode() +
-                     b" HTTP/1.1\r\n" + b"Host: " + dest_addr.encode('idna') + b"\r\n\r\n")
-
-        # We just need the first line to check if the connection was successful
-        fobj = self.makefile()
-        status_line = fobj.readline()
-        fobj.close()
-
-        if not status_line:
-            raise GeneralProxyError("Connection closed unexpectedly")
-
-        try:
-            proto, status_code, status_msg = status_line.split(" ", 2)
-        except ValueError:
-            raise GeneralProxyError("HTTP proxy server sent invalid response")
-
-        if not proto.startswith("HTTP/"):
-            raise GeneralProxyError("Proxy server does not appear to be an HTTP proxy")
-
-        try:
-            status_code = int(status_code)
-        except ValueError:
-            raise HTTPError("HTTP proxy server did not return a valid HTTP status")
-
-        if status_code != 200:
-            error = "{0}: {1}".format(status_code, status_msg)
-            if status_code in (400, 403, 405):
-                # It's likely that the HTTP proxy server does not support the CONNECT tunneling method
-                error += ("\n[*] Note: The HTTP proxy server may not be supported by PySocks"
-                          " (must be a CONNECT tunnel proxy)")
-            raise HTTPError(error)
-
-        self.proxy_sockname = (b"0.0.0.0", 0)
-        self.proxy_peername = addr, dest_port
-
-    _proxy_negotiators = {
-        SOCKS4: _negotiate_socks4,
-        SOCKS5: _negotiate_socks5,
-        HTTP: _negotiate_http
-    }
+        return _write_socks5_address(addr, filed, self.proxy[3])
 
     def connect(self, dest_pair):
         """
@@ -710,9 +842,12 @@ class SockSocket(_BaseSocket):
 
         proxy_addr = self._proxy_addr()
 
+        self.proxy_timings = {}
         try:
             # Initial connection to proxy server
+            started = time.time()
             _BaseSocket.connect(self, proxy_addr)
+            self.proxy_timings['connect'] = time.time() - started
 
         except socket.error as error:
             # Error while connecting to proxy
@@ -727,9 +862,7 @@ class SockSocket(_BaseSocket):
         else:
             # Connected to proxy server, now negotiate
             try:
-                # Calls negotiate_{SOCKS4, SOCKS5, HTTP}
-                negotiate = self._proxy_negotiators[proxy_type]
-                negotiate(self, dest_addr, dest_port)
+                self._negotiate(dest_addr, dest_port)
             except socket.error as error:
                 # Wrap socket errors
                 self.close()
@@ -748,3 +881,6 @@ class SockSocket(_BaseSocket):
         if not proxy_port:
             raise GeneralProxyError("Invalid proxy type")
         return proxy_addr, proxy_port
+
+
+socksocket = SockSocket
@@ -1,4 +1,7 @@
+import contextlib
 import logging
+import threading
+import time
 
 from pyamf import amf0, amf3
 import pyamf.util.pure
@@ -7,6 +10,61 @@ from . import header, rtmp_type
 
 log = logging.getLogger(__name__)
 
+# chunk streams used for the media messages of a stream.
+CHUNK_ID_AUDIO = 4
+CHUNK_ID_DATA = 5
+CHUNK_ID_VIDEO = 6
+
+
+class RateLimiter(object):
+    """ A token bucket limiting the amount of bytes sent per second. """
+
+    def __init__(self, rate, burst=None):
+        """
+        Initialize the limiter with a full bucket.
+
+        :param rate: The bytes per second.
+        :type rate: int
+        :param burst: The bytes that may be sent at once, defaults to rate.
+        :type burst: int
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def consume(self, amount):
+        """
+        Take amount bytes from the bucket.
+
+        The bucket may go into debt, the debt being paid off by the caller waiting.
+
+        :param amount: The amount of bytes about to be sent.
+        :type amount: int
+        :return: The seconds to wait before sending.
+        :rtype: float
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    def delay(self, amount):
+        """
+        The seconds until amount is in the bucket, without taking it.
+
+        :param amount: The amount about to be sent.
+        :type amount: int
+        :rtype: float
+        """
+        tokens = min(self.burst, self.tokens + (time.time() - self.last) * self.rate)
+        if tokens >= amount:
+            return 0
+        return (amount - tokens) / self.rate
+
 
 class RtmpWriter:
     """ This class writes RTMP messages into a stream. """
@@ -19,14 +77,131 @@ class RtmpWriter:
         self.stream = stream
 
         self.stream_id = 0
+        # encoded headers and chunk payloads waiting for the next flush.
+        self._buffer = []
+        self._batch_depth = 0
+        self._lock = threading.RLock()
+        # the last header sent and its absolute timestamp, by chunk stream.
+        self._headers = {}
+        # the local outbound pacing derived from the peer bandwidth messages of the server.
+        self.limiter = None
+        self.limit_type = None
+        self.bytes_sent = 0
+        # flushes write to the stream in the order they took their data from the buffer,
+        # a flush waiting on the limiter does not hold the writer lock.
+        self._write_order = threading.Condition(threading.Lock())
+        self._next_flush = 0
+        self._next_write = 0
 
     def flush(self):
-        """ Flush the underlying stream. """
-        self.stream.flush()
+        """
+        Write everything encoded since the last flush to the stream
+        with a single write, and flush the underlying stream.
+
+        Does nothing while inside a batch. When the data has to wait for the
+        limiter, the wait happens outside the writer lock, so other threads can
+        keep encoding messages meanwhile.
+        """
+        data = None
+        delay = 0
+        with self._lock:
+            if self._batch_depth > 0:
+                return
+            if self._buffer:
+                try:
+                    data = ''.join(self._buffer)
+                except TypeError:
+                    # media payloads may be buffers or memoryviews, which str.join refuses.
+                    data = bytearray()
+                    for part in self._buffer:
+                        data += part
+                self._buffer = []
+                if self.limiter is not None:
+                    delay = self.limiter.consume(len(data))
+            ticket = self._next_flush
+            self._next_flush += 1
+
+        if delay > 0:
+            time.sleep(delay)
+
+        with self._write_order:
+            # the headers of a flush may be encoded relative to the messages of an earlier flush.
+            while self._next_write != ticket:
+                self._write_order.wait()
+            try:
+                if data is not None:
+                    self.stream.write(data)
+                    self.bytes_sent += len(data)
+                self.stream.flush()
+            finally:
+                self._next_write += 1
+                self._write_order.notify_all()
+
+    def set_peer_bandwidth(self, window_size, limit_type):
+        """
+        Apply a peer bandwidth limit sent by the server.
+
+        In RTMP the window size is a acknowledgement window, the bytes that may be sent
+        before the peer acknowledges them. The writer does not track the acknowledgements,
+        instead it paces the outgoing bytes to window_size bytes per second, a local
+        assumption of what the peer can take rather than the meaning of the protocol.
+
+        A hard limit replaces the current limit, a soft limit only applies when it is
+        lower than the current limit. A dynamic limit is treated as hard if the
+        previous limit was hard, and is ignored otherwise.
+
+        :param window_size: The acknowledgement window size, used as the bytes per second to pace to.
+        :type window_size: int
+        :param limit_type: One of the rtmp_type.LIMIT_* values.
+        :type limit_type: int
+        """
+        with self._lock:
+            if limit_type == rtmp_type.LIMIT_DYNAMIC:
+                if self.limit_type != rtmp_type.LIMIT_HARD:
+                    return
+                limit_type = rtmp_type.LIMIT_HARD
+
+            if limit_type == rtmp_type.LIMIT_SOFT and self.limiter is not None \
+                    and self.limiter.rate <= window_size:
+                return
+
+            if window_size <= 0:
+                self.limiter = None
+            else:
+                self.limiter = RateLimiter(window_size)
+            self.limit_type = limit_type
+            log.debug('outbound bytes paced to %s bytes/s by the peer bandwidth window (limit type %s)' %
+                      (window_size, limit_type))
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Hold back flushes until the end of the with block, so several
+        messages are written to the stream in one go.
+
+        Usage:
+            with writer.batch():
+                writer.write(msg1)
+                writer.flush()
+                writer.write(msg2)
+                writer.flush()
+        """
+        with self._lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batch_depth -= 1
+            self.flush()
 
     def write(self, message):
-        log.debug('send %r', message)
         """ Encode and write the specified message into the stream. """
+        with self._lock:
+            self._write(message)
+
+    def _write(self, message):
+        log.debug('send %r', message)
         datatype = message['msg']
         body_stream = pyamf.util.BufferedByteStream()
         encoder = amf0.Encoder(body_stream)
@@ -36,33 +211,50 @@ class RtmpWriter:
             body_stream.write(message['event_data'])
             self.send_msg(datatype, body_stream.getvalue())
 
+        elif datatype == rtmp_type.DT_ACKNOWLEDGEMENT:
+            body_stream.write_ulong(message['sequence_number'])
+            self.send_msg(datatype, body_stream.getvalue())
+
         elif datatype == rtmp_type.DT_WINDOW_ACK_SIZE:
             body_stream.write_ulong(message['window_ack_size'])
             self.send_msg(datatype, body_stream.getvalue())
 
+        elif datatype == rtmp_type.DT_SET_CHUNK_SIZE:
+            body_stream.write_ulong(message['chunk_size'])
+            self.send_msg(datatype, body_stream.getvalue())
+            # every message written after this one is split by the new chunk size.
+            self.chunk_size = message['chunk_size']
+
         elif datatype == rtmp_type.DT_SET_PEER_BANDWIDTH:
             body_stream.write_ulong(message['window_ack_size'])
             body_stream.write_uchar(message['limit_type'])
             self.send_msg(datatype, body_stream.getvalue())
 
         elif datatype == rtmp_type.DT_COMMAND:
-            for command in message['command']:
-                encoder.writeElement(command)
+            if 'body' in message:
+                # pre-encoded by a command.CommandTemplate
+                name = message['name']
+                body = message['body']
+            else:
+                for command in message['command']:
+                    encoder.writeElement(command)
+                name = message['command'][0]
+                body = body_stream.getvalue()
 
-            if 'closeStream' in message['command']:
-                self.send_msg(datatype, body_stream.getvalue(), stream_id=self.stream_id)
+            if name == 'closeStream':
+                self.send_msg(datatype, body, stream_id=self.stream_id)
 
-            elif 'deleteStream' in message['command']:
-                self.send_msg(datatype, body_stream.getvalue(), stream_id=self.stream_id)
+            elif name == 'deleteStream':
+                self.send_msg(datatype, body, stream_id=self.stream_id)
 
-            elif 'publish' in message['command']:
-                self.send_msg(datatype, body_stream.getvalue(), stream_id=self.stream_id)
+            elif name == 'publish':
+                self.send_msg(datatype, body, stream_id=self.stream_id)
 
-            elif 'play' in message['command']:
-                self.send_msg(datatype, body_stream.getvalue(), chunk_id=8, stream_id=self.stream_id)
+            elif name == 'play':
+                self.send_msg(datatype, body, chunk_id=8, stream_id=self.stream_id)
 
             else:
-                self.send_msg(datatype, body_stream.getvalue())
+                self.send_msg(datatype, body)
 
         elif datatype == rtmp_type.DT_AMF3_COMMAND:
             encoder = amf3.Encoder(body_stream)
@@ -70,6 +262,29 @@ class RtmpWriter:
                 encoder.writeElement(command)
             self.send_msg(datatype, body_stream.getvalue())
 
+        elif datatype == rtmp_type.DT_AUDIO_MESSAGE or datatype == rtmp_type.DT_VIDEO_MESSAGE:
+            # the payload is sent as is, it is not copied into a intermediate stream.
+            if datatype == rtmp_type.DT_AUDIO_MESSAGE:
+                chunk_id = CHUNK_ID_AUDIO
+            else:
+                chunk_id = CHUNK_ID_VIDEO
+            self.send_msg(datatype, message['body'], chunk_id=chunk_id,
+                          stream_id=message.get('stream_id', self.stream_id),
+                          timestamp=message.get('timestamp', 0))
+
+        elif datatype == rtmp_type.DT_DATA_MESSAGE or datatype == rtmp_type.DT_AMF3_DATA_MESSAGE:
+            if 'body' in message:
+                body = message['body']
+            else:
+                if datatype == rtmp_type.DT_AMF3_DATA_MESSAGE:
+                    encoder = amf3.Encoder(body_stream)
+                for data in message['data']:
+                    encoder.writeElement(data)
+                body = body_stream.getvalue()
+            self.send_msg(datatype, body, chunk_id=CHUNK_ID_DATA,
+                          stream_id=message.get('stream_id', self.stream_id),
+                          timestamp=message.get('timestamp', 0))
+
         elif datatype == rtmp_type.DT_SHARED_OBJECT:
             encoder.serialiseString(message['obj_name'])
             body_stream.write_ulong(message['curr_version'])
@@ -87,7 +302,7 @@ class RtmpWriter:
         encoder = amf0.Encoder(inner_stream)
 
         event_type = event['type']
-        if event_type == rtmp_type.SO_USE:
+        if event_type in (rtmp_type.SO_USE, rtmp_type.SO_RELEASE):
             assert event['data'] == '', event['data']
 
         elif event_type == rtmp_type.SO_CHANGE:
@@ -111,9 +326,9 @@ class RtmpWriter:
 
     def send_msg(self, data_type, body, chunk_id=3, stream_id=0, timestamp=0):
         """
-        Helper method that send the specified message into the stream. Takes
-        care to prepend the necessary headers and split the message into
-        appropriately sized chunks.
+        Helper method that adds the specified message to the outgoing buffer.
+        Takes care to prepend the necessary headers and split the message into
+        appropriately sized chunks. The message is sent on the next flush.
         """
         # Values that just work. :-)
         if 1 <= data_type <= 7:
@@ -123,16 +338,38 @@ class RtmpWriter:
             _channel_id = chunk_id
             _stream_id = stream_id
 
+        # Use the smallest header form the last header sent on this chunk stream allows.
+        # Headers other than the full header (type 0) carry a timestamp delta.
+        previous, previous_timestamp = self._headers.get(_channel_id, (None, 0))
+        if previous is None or previous.stream_id != _stream_id or timestamp < previous_timestamp:
+            previous = None
+            wire_timestamp = timestamp
+        else:
+            wire_timestamp = timestamp - previous_timestamp
+
         _header = header.Header(
             channel_id=_channel_id,  # i am pretty sure this is the chunk stream ID. Rename in header?
             stream_id=_stream_id,
             data_type=data_type,
             body_length=len(body),
-            timestamp=timestamp)
-        header.encode(self.stream, _header)
-
-        for i in xrange(0, len(body), self.chunk_size):
-            chunk = body[i:i + self.chunk_size]
-            self.stream.write(chunk)
-            if i+self.chunk_size < len(body):
-                header.encode(self.stream, _header, _header)
+            timestamp=wire_timestamp)
+        self._headers[_channel_id] = (_header, timestamp)
+
+        parts = self._buffer
+        parts.append(header.pack(_header, previous))
+
+        if len(body) > self.chunk_size:
+            if isinstance(body, bytearray):
+                # slice the chunks out of a view rather than copying them.
+                body = memoryview(body)
+            # with a timestamp past 0xffffff, the type 3 continuation header carries the extended timestamp.
+            continuation = header.pack(_header, _header)
+            for i in xrange(0, len(body), self.chunk_size):
+                if i > 0:
+                    parts.append(continuation)
+                if isinstance(body, buffer):
+                    parts.append(buffer(body, i, self.chunk_size))
+                else:
+                    parts.append(body[i:i + self.chunk_size])
+        elif body:
+            parts.append(body)
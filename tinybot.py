@@ -3,6 +3,7 @@ import logging
 import re
 import threading
 import pinylib
+import util.file_handler
 import util.media_manager
 from page import privacy
 from apis import youtube, soundcloud, lastfm, other, locals_
@@ -14,7 +15,7 @@ log = logging.getLogger(__name__)
 class TinychatBot(pinylib.TinychatRTMPClient):
     privacy_settings = None
     media = util.media_manager.MediaManager()
-    media_timer_thread = None
+    media_timer = None
     search_list = []
     is_search_list_youtube_playlist = False
     is_broadcasting = False
@@ -28,10 +29,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
         _user = self.users.add(join_info)
         if _user is not None:
             if _user.account:
-                tc_info = pinylib.apis.tinychat.user_info(_user.account)
-                if tc_info is not None:
-                    _user.tinychat_id = tc_info
-                    _user.last_login = tc_info['last_active']
+                self.api_workers.submit(self.lookup_user_info, _user)
                 if _user.is_owner:
                     _user.user_level = 1
                     self.console_write(pinylib.COLOR['red'], 'Room Owner %s:%d:%s' %
@@ -72,7 +70,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             self.send_banlist_msg()
             self.load_list(nicks=True, accounts=True, strings=True)
         if self.is_client_owner and self.param.roomtype != 'default':
-            threading.Thread(target=self.get_privacy_settings).start()
+            self.api_workers.submit(self.get_privacy_settings)
 
     def on_avon(self, uid, name, greenroom=False):
         """ Application message received when a user starts broadcasting.
@@ -283,33 +281,33 @@ class TinychatBot(pinylib.TinychatRTMPClient):
 
                 # Tinychat API commands.
                 elif cmd == prefix + 'spy':
-                    threading.Thread(target=self.do_spy, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_spy, cmd_arg)
 
                 elif cmd == prefix + 'spyuser':
-                    threading.Thread(target=self.do_account_spy, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_account_spy, cmd_arg)
 
                 elif cmd == prefix + 'room':
-                    threading.Thread(target=self.do_room_info, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_room_info, cmd_arg)
 
                 # Other API commands.
                 elif cmd == prefix + 'urban':
-                    threading.Thread(target=self.do_search_urban_dictionary, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_search_urban_dictionary, cmd_arg)
 
                 elif cmd == prefix + 'ip':
-                    threading.Thread(target=self.do_whois_ip, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_whois_ip, cmd_arg)
 
                 elif cmd == prefix + 'time':
-                    threading.Thread(target=self.do_time, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_time, cmd_arg)
 
                 elif cmd == prefix + 'translate':
-                    threading.Thread(target=self.do_translate, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_translate, cmd_arg)
 
                 elif cmd == prefix + 'advice':
-                    threading.Thread(target=self.do_advice).start()
+                    self.api_workers.submit(self.do_advice)
 
                 # Just for fun.
                 elif cmd == prefix + 'chuck':
-                    threading.Thread(target=self.do_chuck_norris).start()
+                    self.api_workers.submit(self.do_chuck_norris)
 
                 elif cmd == prefix + '8ball':
                     self.do_8ball(cmd_arg)
@@ -323,10 +321,10 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             # Mod commands in public chat, Only level 3+ can play videos.
             if self.has_level(3):
                 if cmd == prefix + 'play':
-                    threading.Thread(target=self.do_play_youtube, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_play_youtube, cmd_arg)
 
                 elif cmd == prefix + 'playsc':
-                    threading.Thread(target=self.do_play_soundcloud, args=(cmd_arg,)).start()
+                    self.api_workers.submit(self.do_play_soundcloud, cmd_arg)
 
                 elif cmd == prefix + 'skip':
                     self.do_skip()
@@ -353,7 +351,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             self.console_write(pinylib.COLOR['green'], self.active_user.nick + ': ' + decoded_msg)
             # Only check chat msg for ban string if we are mod.
             if self.is_client_mod and self.active_user.user_level > 4:
-                threading.Thread(target=self.check_msg, args=(decoded_msg,)).start()
+                self.mod_workers.submit(self.check_msg, decoded_msg)
 
         self.active_user.last_msg = decoded_msg
 
@@ -442,6 +440,11 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                                   self.format_time(self.media.elapsed_track_time()), self.active_user.nick)
             self.send_private_msg('*Active Track:* ' + str(self.media.has_active_track()), self.active_user.nick)
             self.send_private_msg('*Active Threads:* ' + str(threading.active_count()), self.active_user.nick)
+            for workers in (self.api_workers, self.mod_workers):
+                stats = workers.stats()
+                self.send_private_msg('*%s Workers:* %s *Queued:* %s *Dropped:* %s' %
+                                      (stats['name'], stats['threads'], stats['queue_depth'], stats['dropped']),
+                                      self.active_user.nick)
 
     def do_op_user(self, user_name):
         """ Lets the room owner, a mod or a bot controller make another user a bot controller.
@@ -902,14 +905,12 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     user_name = user_name.replace('*', '')
                     _users = self.users.search_containing(user_name)
                     if len(_users) > 0:
+                        # the send queue paces the bans and forgives to the rate the server allows.
                         for i, user in enumerate(_users):
                             if user.nick != self.nickname and user.user_level > self.active_user.user_level:
                                 if i <= pinylib.CONFIG.B_MAX_MATCH_BANS - 1:
                                     self.send_ban_msg(user.nick, user.id)
-                                    a = pinylib.string_util.random.uniform(0.0, 1.0)
-                                    pinylib.time.sleep(a)
                                     self.send_forgive_msg(user.id)
-                                    pinylib.time.sleep(0.5)
                 else:
                     _user = self.users.search(user_name)
                     if _user is None:
@@ -936,12 +937,11 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     user_name = user_name.replace('*', '')
                     _users = self.users.search_containing(user_name)
                     if len(_users) > 0:
+                        # the send queue paces the bans to the rate the server allows.
                         for i, user in enumerate(_users):
                             if user.nick != self.nickname and user.user_level > self.active_user.user_level:
                                 if i <= pinylib.CONFIG.B_MAX_MATCH_BANS - 1:
                                     self.send_ban_msg(user.nick, user.id)
-                                    a = pinylib.string_util.random.uniform(0.0, 1.5)
-                                    pinylib.time.sleep(a)
                 else:
                     _user = self.users.search(user_name)
                     if _user is None:
@@ -963,8 +963,8 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             elif bad_nick in pinylib.CONFIG.B_NICK_BANS:
                 self.send_private_msg('*%s* is already in list.' % bad_nick, self.active_user.nick)
             else:
-                pinylib.file_handler.file_writer(self.config_path(),
-                                                 pinylib.CONFIG.B_NICK_BANS_FILE_NAME, bad_nick)
+                util.file_handler.file_writer(self.config_path(),
+                                              pinylib.CONFIG.B_NICK_BANS_FILE_NAME, bad_nick)
                 self.send_private_msg('*%s* was added to file.' % bad_nick, self.active_user.nick)
                 self.load_list(nicks=True)
 
@@ -979,8 +979,8 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                 self.send_private_msg('Missing username', self.active_user.nick)
             else:
                 if bad_nick in pinylib.CONFIG.B_NICK_BANS:
-                    rem = pinylib.file_handler.remove_from_file(self.config_path(),
-                                                                pinylib.CONFIG.B_NICK_BANS_FILE_NAME, bad_nick)
+                    rem = util.file_handler.remove_from_file(self.config_path(),
+                                                             pinylib.CONFIG.B_NICK_BANS_FILE_NAME, bad_nick)
                     if rem:
                         self.send_private_msg('*%s* was removed.' % bad_nick, self.active_user.nick)
                         self.load_list(nicks=True)
@@ -999,8 +999,8 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             elif bad_string in pinylib.CONFIG.B_STRING_BANS:
                 self.send_private_msg('*%s* is already in list.' % bad_string, self.active_user.nick)
             else:
-                pinylib.file_handler.file_writer(self.config_path(),
-                                                 pinylib.CONFIG.B_STRING_BANS_FILE_NAME, bad_string)
+                util.file_handler.file_writer(self.config_path(),
+                                              pinylib.CONFIG.B_STRING_BANS_FILE_NAME, bad_string)
                 self.send_private_msg('*%s* was added to file.' % bad_string, self.active_user.nick)
                 self.load_list(strings=True)
 
@@ -1015,8 +1015,8 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                 self.send_private_msg('Missing word string.', self.active_user.nick)
             else:
                 if bad_string in pinylib.CONFIG.B_STRING_BANS:
-                    rem = pinylib.file_handler.remove_from_file(self.config_path(),
-                                                                pinylib.CONFIG.B_STRING_BANS_FILE_NAME, bad_string)
+                    rem = util.file_handler.remove_from_file(self.config_path(),
+                                                             pinylib.CONFIG.B_STRING_BANS_FILE_NAME, bad_string)
                     if rem:
                         self.send_private_msg('*%s* was removed.' % bad_string, self.active_user.nick)
                         self.load_list(strings=True)
@@ -1035,8 +1035,8 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             elif bad_account_name in pinylib.CONFIG.B_ACCOUNT_BANS:
                 self.send_private_msg('%s is already in list.' % bad_account_name, self.active_user.nick)
             else:
-                pinylib.file_handler.file_writer(self.config_path(),
-                                                 pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME, bad_account_name)
+                util.file_handler.file_writer(self.config_path(),
+                                              pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME, bad_account_name)
                 self.send_private_msg('*%s* was added to file.' % bad_account_name, self.active_user.nick)
                 self.load_list(accounts=True)
 
@@ -1051,8 +1051,8 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                 self.send_private_msg('Missing account.', self.active_user.nick)
             else:
                 if bad_account in pinylib.CONFIG.B_ACCOUNT_BANS:
-                    rem = pinylib.file_handler.remove_from_file(self.config_path(),
-                                                                pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME, bad_account)
+                    rem = util.file_handler.remove_from_file(self.config_path(),
+                                                             pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME, bad_account)
                     if rem:
                         self.send_private_msg('*%s* was removed.' % bad_account, self.active_user.nick)
                         self.load_list(accounts=True)
@@ -1518,22 +1518,22 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                 if self.is_client_owner:
                     # Only possible if bot is using the room owner account.
                     if pm_cmd == 'mod':
-                        threading.Thread(target=self.do_make_mod, args=(pm_arg,)).start()
+                        self.api_workers.submit(self.do_make_mod, pm_arg)
 
                     elif pm_cmd == 'removemod':
-                        threading.Thread(target=self.do_remove_mod, args=(pm_arg,)).start()
+                        self.api_workers.submit(self.do_remove_mod, pm_arg)
 
                     elif pm_cmd == 'directory':
-                        threading.Thread(target=self.do_directory).start()
+                        self.api_workers.submit(self.do_directory)
 
                     elif pm_cmd == 'p2t':
-                        threading.Thread(target=self.do_push2talk).start()
+                        self.api_workers.submit(self.do_push2talk)
 
                     elif pm_cmd == 'green':
-                        threading.Thread(target=self.do_green_room).start()
+                        self.api_workers.submit(self.do_green_room)
 
                     elif pm_cmd == 'clearbans':
-                        threading.Thread(target=self.do_clear_room_bans).start()
+                        self.api_workers.submit(self.do_clear_room_bans)
 
                     elif pm_cmd == 'kill':
                         self.do_kill()
@@ -1558,10 +1558,10 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_public_cmds()
 
                 elif pm_cmd == 'roompassword':
-                    threading.Thread(target=self.do_set_room_pass, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_set_room_pass, pm_arg)
 
                 elif pm_cmd == 'campassword':
-                    threading.Thread(target=self.do_set_broadcast_pass, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_set_broadcast_pass, pm_arg)
             # Mod commands.
             if self.has_level(3):
                 # Misc
@@ -1575,7 +1575,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_greet()
 
                 elif pm_cmd == 'settings':
-                    self.do_room_settings()
+                    self.api_workers.submit(self.do_room_settings)
 
                 elif pm_cmd == 'clear':
                     self.do_clear()
@@ -1590,7 +1590,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_list_info(pm_arg)
 
                 elif pm_cmd == 'uinfo':
-                    self.do_user_info(pm_arg)
+                    self.api_workers.submit(self.do_user_info, pm_arg)
 
                 # Video/Audio
                 elif pm_cmd == 'up':
@@ -1606,23 +1606,23 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_close_broadcast(pm_arg)
 
                 elif pm_cmd == 'cam':
-                    threading.Thread(target=self.do_cam_approve).start()
+                    self.api_workers.submit(self.do_cam_approve)
 
                 # Media
                 elif pm_cmd == 'top':
-                    threading.Thread(target=self.do_lastfm_chart, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_lastfm_chart, pm_arg)
 
                 elif pm_cmd == 'random':
-                    threading.Thread(target=self.do_lastfm_random_tunes, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_lastfm_random_tunes, pm_arg)
 
                 elif pm_cmd == 'tag':
-                    threading.Thread(target=self.do_search_lastfm_by_tag, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_search_lastfm_by_tag, pm_arg)
 
                 elif pm_cmd == 'playlist':
-                    threading.Thread(target=self.do_youtube_playlist_search, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_youtube_playlist_search, pm_arg)
 
                 elif pm_cmd == 'playpl':
-                    threading.Thread(target=self.do_play_youtube_playlist, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_play_youtube_playlist, pm_arg)
 
                 elif pm_cmd == 'searchlist':
                     self.do_show_search_list()
@@ -1652,17 +1652,17 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_clear_playlist()
 
                 elif pm_cmd == 'play':
-                    threading.Thread(target=self.do_play_youtube, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_play_youtube, pm_arg)
 
                 elif pm_cmd == 'playsc':
-                    threading.Thread(target=self.do_play_soundcloud, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_play_soundcloud, pm_arg)
 
                 # Anti-spam
                 elif pm_cmd == 'kick':
-                    threading.Thread(target=self.do_kick, args=(pm_arg,)).start()
+                    self.mod_workers.submit(self.do_kick, pm_arg)
 
                 elif pm_cmd == 'ban':
-                    threading.Thread(target=self.do_ban, args=(pm_arg,)).start()
+                    self.mod_workers.submit(self.do_ban, pm_arg)
 
                 elif pm_cmd == 'badnick':
                     self.do_bad_nick(pm_arg)
@@ -1699,7 +1699,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_playlist_info()
 
                 elif pm_cmd == 'plays':
-                    threading.Thread(target=self.do_youtube_search, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_youtube_search, pm_arg)
 
                 elif pm_cmd == 'psearch':
                     self.do_play_youtube_search(pm_arg)
@@ -1719,10 +1719,10 @@ class TinychatBot(pinylib.TinychatRTMPClient):
                     self.do_pm_bridge(pm_parts)
 
                 elif pm_cmd == 'private':
-                    threading.Thread(target=self.do_play_private_youtube, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_play_private_youtube, pm_arg)
 
                 elif pm_cmd == 'privatesc':
-                    threading.Thread(target=self.do_play_private_soundcloud, args=(pm_arg,)).start()
+                    self.api_workers.submit(self.do_play_private_soundcloud, pm_arg)
 
         # Print to console.
         msg = str(private_msg).replace(pinylib.CONFIG.B_KEY, '***KEY***'). \
@@ -1739,13 +1739,12 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             if not password:
                 self.privacy_settings.set_room_password()
                 self.send_bot_msg('*The room password was removed.*')
-                pinylib.time.sleep(1)
-                self.send_private_msg('The room password was removed.', self.active_user.nick)
+                self.scheduler.call_later(1, self.send_private_msg, 'The room password was removed.',
+                                          self.active_user.nick)
             elif len(password) > 1:
                 self.privacy_settings.set_room_password(password)
                 self.send_private_msg('*The room password is now:* ' + password, self.active_user.nick)
-                pinylib.time.sleep(1)
-                self.send_bot_msg('*The room is now password protected.*')
+                self.scheduler.call_later(1, self.send_bot_msg, '*The room is now password protected.*')
 
     def do_set_broadcast_pass(self, password):
         """ Set a broadcast password for the room.
@@ -1757,13 +1756,13 @@ class TinychatBot(pinylib.TinychatRTMPClient):
             if not password:
                 self.privacy_settings.set_broadcast_password()
                 self.send_private_msg('*The broadcast password was removed.*', self.active_user.nick)
-                pinylib.time.sleep(1)
-                self.send_private_msg('The broadcast password was removed.', self.active_user.nick)
+                self.scheduler.call_later(1, self.send_private_msg, 'The broadcast password was removed.',
+                                          self.active_user.nick)
             elif len(password) > 1:
                 self.privacy_settings.set_broadcast_password(password)
                 self.send_private_msg('*The broadcast password is now:* ' + password, self.active_user.nick)
-                pinylib.time.sleep(1)
-                self.send_private_msg('*Broadcast password is enabled.*', self.active_user.nick)
+                self.scheduler.call_later(1, self.send_private_msg, '*Broadcast password is enabled.*',
+                                          self.active_user.nick)
 
     def do_key(self, new_key):
         """ Shows or sets a new secret key.
@@ -1787,17 +1786,17 @@ class TinychatBot(pinylib.TinychatRTMPClient):
     def do_clear_bad_nicks(self):
         """ Clears the bad nicks file. """
         pinylib.CONFIG.B_NICK_BANS[:] = []
-        pinylib.file_handler.delete_file_content(self.config_path(), pinylib.CONFIG.B_NICK_BANS_FILE_NAME)
+        util.file_handler.delete_file_content(self.config_path(), pinylib.CONFIG.B_NICK_BANS_FILE_NAME)
 
     def do_clear_bad_strings(self):
         """ Clears the bad strings file. """
         pinylib.CONFIG.B_STRING_BANS[:] = []
-        pinylib.file_handler.delete_file_content(self.config_path(), pinylib.CONFIG.B_STRING_BANS_FILE_NAME)
+        util.file_handler.delete_file_content(self.config_path(), pinylib.CONFIG.B_STRING_BANS_FILE_NAME)
 
     def do_clear_bad_accounts(self):
         """ Clears the bad accounts file. """
         pinylib.CONFIG.B_ACCOUNT_BANS[:] = []
-        pinylib.file_handler.delete_file_content(self.config_path(), pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME)
+        util.file_handler.delete_file_content(self.config_path(), pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME)
 
     # == Public PM Command Methods. ==
     def do_opme(self, key):
@@ -1868,8 +1867,7 @@ class TinychatBot(pinylib.TinychatRTMPClient):
         :type video_time: int
         """
         video_time_in_seconds = video_time / 1000
-        self.media_timer_thread = threading.Timer(video_time_in_seconds, self.media_event_handler)
-        self.media_timer_thread.start()
+        self.media_timer = self.scheduler.call_later(video_time_in_seconds, self.media_event_handler)
 
     # Helper Methods.
     def get_privacy_settings(self):
@@ -1891,14 +1889,14 @@ class TinychatBot(pinylib.TinychatRTMPClient):
         :param strings: bool, True load ban strings file.
         """
         if nicks:
-            pinylib.CONFIG.B_NICK_BANS = pinylib.file_handler.file_reader(self.config_path(),
-                                                                          pinylib.CONFIG.B_NICK_BANS_FILE_NAME)
+            pinylib.CONFIG.B_NICK_BANS = util.file_handler.file_reader(self.config_path(),
+                                                                       pinylib.CONFIG.B_NICK_BANS_FILE_NAME)
         if accounts:
-            pinylib.CONFIG.B_ACCOUNT_BANS = pinylib.file_handler.file_reader(self.config_path(),
-                                                                             pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME)
+            pinylib.CONFIG.B_ACCOUNT_BANS = util.file_handler.file_reader(self.config_path(),
+                                                                          pinylib.CONFIG.B_ACCOUNT_BANS_FILE_NAME)
         if strings:
-            pinylib.CONFIG.B_STRING_BANS = pinylib.file_handler.file_reader(self.config_path(),
-                                                                            pinylib.CONFIG.B_STRING_BANS_FILE_NAME)
+            pinylib.CONFIG.B_STRING_BANS = util.file_handler.file_reader(self.config_path(),
+                                                                         pinylib.CONFIG.B_STRING_BANS_FILE_NAME)
 
     def has_level(self, level):
         """ Checks the active user for correct user level.
@@ -1918,10 +1916,9 @@ class TinychatBot(pinylib.TinychatRTMPClient):
         :return: True if canceled, else False.
         :rtype: bool
         """
-        if self.media_timer_thread is not None:
-            if self.media_timer_thread.is_alive():
-                self.media_timer_thread.cancel()
-                self.media_timer_thread = None
+        if self.media_timer is not None:
+            if self.media_timer.cancel():
+                self.media_timer = None
                 return True
             return False
         return False
@@ -0,0 +1,151 @@
+""" Writes log lines to daily log files from a background thread. version 0.0.1
+
+Lines are kept in a memory buffer and written by one thread, every flush
+interval or sooner when the buffer fills up. Each folder gets a log file
+per day, named by date. The file of the previous day is closed when the
+date changes, and optionally gzip compressed.
+
+Usage:
+    writer = LogWriter(flush_interval=2, compress=True)
+    writer.write('rooms/room_name/logs/', '[12:00:00] hello')
+    writer.close()
+"""
+import collections
+import gzip
+import logging
+import os
+import shutil
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class LogWriter(object):
+    """ A buffered writer of daily log files. Thread safe. """
+
+    def __init__(self, name='log-writer', flush_interval=2.0, max_buffer=5000, compress=False):
+        """
+        Create a log writer. The thread is started with the first line.
+
+        :param name: The name of the writer thread.
+        :type name: str
+        :param flush_interval: The seconds between writes to disk.
+        :type flush_interval: int | float
+        :param max_buffer: The maximum amount of buffered lines, new lines are dropped when the buffer is full.
+        :type max_buffer: int
+        :param compress: Gzip compress the log file of a day when the date changes.
+        :type compress: bool
+        """
+        self.name = name
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.compress = compress
+        self.written = 0
+        self.dropped = 0
+
+        # (folder, time, line)
+        self._buffer = collections.deque()
+        # folder -> (date, open file)
+        self._files = {}
+        self._condition = threading.Condition(threading.Lock())
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def write(self, file_path, line):
+        """
+        Buffer a line for the log file of today in a folder.
+
+        :param file_path: The folder of the log files, ending with a slash.
+        :type file_path: str
+        :param line: The line, without the line break.
+        :type line: str
+        :return: True if the line was buffered, False if it was dropped.
+        :rtype: bool
+        """
+        with self._condition:
+            if self._closed or len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                return False
+            self._buffer.append((file_path, time.time(), line))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+            elif len(self._buffer) >= self.max_buffer // 2:
+                # write early, before lines are dropped.
+                self._condition.notify()
+        return True
+
+    def flush(self):
+        """ Write the buffered lines to disk, in the calling thread. """
+        with self._condition:
+            lines = self._buffer
+            self._buffer = collections.deque()
+        with self._write_lock:
+            self._write(lines)
+
+    def close(self):
+        """ Write the buffered lines, and close the log files. """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+        with self._write_lock:
+            for date, f in self._files.values():
+                f.close()
+            self._files = {}
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._closed:
+                    self._condition.wait(self.flush_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _write(self, lines):
+        for file_path, ts, line in lines:
+            date = time.strftime('%Y-%m-%d', time.localtime(ts))
+            try:
+                f = self._open(file_path, date)
+                f.write(line + '\n')
+                self.written += 1
+            except (IOError, OSError) as e:
+                log.error('failed to write log line to: %s error: %s' % (file_path, e))
+        for date, f in self._files.values():
+            f.flush()
+
+    def _open(self, file_path, date):
+        """ The log file of a folder for a date, rotating the file of a previous date. """
+        current = self._files.get(file_path)
+        if current is not None:
+            if current[0] == date:
+                return current[1]
+            del self._files[file_path]
+            current[1].close()
+            if self.compress:
+                self._compress(current[1].name)
+        if not os.path.exists(file_path):
+            os.makedirs(file_path)
+        f = open(file_path + date + '.log', mode='a')
+        self._files[file_path] = (date, f)
+        return f
+
+    def _compress(self, file_name):
+        """ Gzip compress a log file, replacing it with a .gz file. """
+        try:
+            with open(file_name, 'rb') as f_in:
+                gz = gzip.open(file_name + '.gz', 'ab')
+                try:
+                    shutil.copyfileobj(f_in, gz)
+                finally:
+                    gz.close()
+            os.remove(file_name)
+        except (IOError, OSError) as e:
+            log.error('failed to compress log file: %s error: %s' % (file_name, e))
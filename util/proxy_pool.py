@@ -0,0 +1,186 @@
+""" A pool of proxies scored by latency and failures. version 0.0.1
+
+The pool can be given where a proxy string in the format IP:PORT is accepted,
+the rtmplib RtmpClient and the http functions of util.web then pick the best
+proxy for every connection, and rotate to the next proxy when one fails.
+
+Usage:
+    proxies = ProxyPool(['1.2.3.4:8080', '5.6.7.8:3128'])
+    bot = tinybot.TinychatBot(roomname='room', proxy=proxies)
+"""
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ProxyStats(object):
+    """ The health of a single proxy. """
+
+    __slots__ = ('proxy', 'latency', 'successes', 'failures', 'consecutive_failures', 'retry_at')
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        # the smoothed seconds it takes to connect, None until the first success.
+        self.latency = None
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        # the time before which the proxy is not used, after a failure.
+        self.retry_at = 0
+
+    @property
+    def failure_rate(self):
+        total = self.successes + self.failures
+        if total == 0:
+            return 0.0
+        return float(self.failures) / total
+
+    def score(self, timeout):
+        """
+        The expected cost of using the proxy, lower is better.
+
+        A failure costs as much as waiting for the timeout. Untested proxies
+        score 0, so each proxy is tried before the pool settles on the fastest.
+
+        :param timeout: The seconds a failed connection costs.
+        :type timeout: int | float
+        :rtype: float
+        """
+        return (self.latency or 0.0) + self.failure_rate * timeout
+
+    def __repr__(self):
+        return '<ProxyStats %s latency=%s successes=%s failures=%s>' % \
+               (self.proxy, self.latency, self.successes, self.failures)
+
+
+class ProxyPool(object):
+    """ Picks the fastest healthy proxy of a list of proxies. Thread safe. """
+
+    def __init__(self, proxies=None, timeout=10, max_attempts=3, cooldown=30, max_cooldown=600, smoothing=0.3):
+        """
+        Create a proxy pool.
+
+        :param proxies: Proxies in the format IP:PORT
+        :type proxies: list | None
+        :param timeout: The seconds to wait for a connection through a proxy.
+        :type timeout: int | float
+        :param max_attempts: The amount of proxies tried for a single connection.
+        :type max_attempts: int
+        :param cooldown: The seconds a proxy is left alone after a failure,
+        doubling with every consecutive failure.
+        :type cooldown: int | float
+        :param max_cooldown: The maximum seconds a proxy is left alone.
+        :type max_cooldown: int | float
+        :param smoothing: The weight of a new latency measurement. (0-1)
+        :type smoothing: float
+        """
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.smoothing = smoothing
+        self._stats = {}
+        self._lock = threading.Lock()
+        for proxy in proxies or []:
+            self.add(proxy)
+
+    def __len__(self):
+        return len(self._stats)
+
+    def __contains__(self, proxy):
+        return proxy in self._stats
+
+    def __repr__(self):
+        return '<ProxyPool %s proxies>' % len(self._stats)
+
+    def add(self, proxy):
+        """
+        Add a proxy to the pool.
+
+        :param proxy: A proxy in the format IP:PORT
+        :type proxy: str
+        """
+        if len(proxy.split(':')) != 2:
+            raise ValueError('proxy must be in the format ip:port. proxy=%s' % proxy)
+        with self._lock:
+            if proxy not in self._stats:
+                self._stats[proxy] = ProxyStats(proxy)
+
+    def remove(self, proxy):
+        """ Remove a proxy from the pool. """
+        with self._lock:
+            self._stats.pop(proxy, None)
+
+    def stats(self):
+        """
+        The health of the proxies, best first.
+
+        :rtype: list
+        """
+        with self._lock:
+            return sorted(self._stats.values(), key=lambda s: s.score(self.timeout))
+
+    def select(self, exclude=()):
+        """
+        Pick the proxy with the lowest score that is not cooling down.
+
+        When all proxies are cooling down, the one that is closest to being
+        retried is picked, so a pool of failing proxies is still used.
+
+        :param exclude: Proxies not to pick, like the ones already tried for a connection.
+        :type exclude: list | tuple | set
+        :return: A proxy in the format IP:PORT, or None if there is no proxy to pick.
+        :rtype: str | None
+        """
+        now = time.time()
+        with self._lock:
+            candidates = [s for s in self._stats.itervalues() if s.proxy not in exclude]
+            if not candidates:
+                return None
+            healthy = [s for s in candidates if s.retry_at <= now]
+            if healthy:
+                best = min(healthy, key=lambda s: s.score(self.timeout))
+            else:
+                best = min(candidates, key=lambda s: s.retry_at)
+            return best.proxy
+
+    def report_success(self, proxy, latency):
+        """
+        Record a successful connection through a proxy.
+
+        :param proxy: The proxy.
+        :type proxy: str
+        :param latency: The seconds the connection took.
+        :type latency: float
+        """
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is None:
+                return
+            if stats.latency is None:
+                stats.latency = latency
+            else:
+                stats.latency += self.smoothing * (latency - stats.latency)
+            stats.successes += 1
+            stats.consecutive_failures = 0
+            stats.retry_at = 0
+
+    def report_failure(self, proxy):
+        """
+        Record a failed connection through a proxy, and let it cool down.
+
+        :param proxy: The proxy.
+        :type proxy: str
+        """
+        with self._lock:
+            stats = self._stats.get(proxy)
+            if stats is None:
+                return
+            stats.failures += 1
+            stats.consecutive_failures += 1
+            delay = min(self.cooldown * 2 ** (stats.consecutive_failures - 1), self.max_cooldown)
+            stats.retry_at = time.time() + delay
+        log.info('proxy %s failed %s time(s) in a row, retrying in %s seconds' %
+                 (proxy, stats.consecutive_failures, delay))
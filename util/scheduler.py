@@ -0,0 +1,203 @@
+""" Runs delayed and periodic calls on a single thread. version 0.0.1
+
+The pending calls are kept in a heap ordered by due time, and one thread
+sleeps until the next call is due. Calls run on the scheduler thread, so
+they should be quick; slow work should be handed to a worker pool.
+
+Usage:
+    scheduler = Scheduler()
+    timer = scheduler.call_later(5, send_msg, 'five seconds later')
+    timer.cancel()
+    job = scheduler.call_every(360, refresh_config)
+"""
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class Timer(object):
+    """ A call scheduled with a Scheduler. """
+
+    __slots__ = ('scheduler', 'due', 'interval', 'fn', 'args', 'kwargs', 'cancelled', '_seq')
+
+    def __init__(self, scheduler, due, interval, fn, args, kwargs):
+        self.scheduler = scheduler
+        # the time.time() the call is due.
+        self.due = due
+        # the seconds between calls of a periodic call, None for a single call.
+        self.interval = interval
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self._seq = None
+
+    def __repr__(self):
+        return '<Timer %s due=%s interval=%s cancelled=%s>' % \
+               (getattr(self.fn, '__name__', self.fn), self.due, self.interval, self.cancelled)
+
+    @property
+    def active(self):
+        """ True if the call is still pending. """
+        return self._seq is not None and not self.cancelled
+
+    @property
+    def remaining(self):
+        """ The seconds until the call is due, None if the call is not pending. """
+        if not self.active:
+            return None
+        return max(0.0, self.due - time.time())
+
+    def cancel(self):
+        """
+        Cancel the call.
+
+        :return: True if the call was pending.
+        :rtype: bool
+        """
+        return self.scheduler.cancel(self)
+
+    def reschedule(self, delay):
+        """
+        Move the call to delay seconds from now, or schedule it again if it already ran.
+
+        :param delay: The seconds from now.
+        :type delay: int | float
+        """
+        self.scheduler.reschedule(self, delay)
+
+
+class Scheduler(object):
+    """ A heap of timed calls, run by one thread. Thread safe. """
+
+    def __init__(self, name='scheduler'):
+        """
+        Create a scheduler. The thread is started with the first scheduled call.
+
+        :param name: The name of the scheduler thread.
+        :type name: str
+        """
+        self.name = name
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition(threading.Lock())
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        with self._condition:
+            return sum(1 for entry in self._heap if entry[2]._seq == entry[1])
+
+    def call_later(self, delay, fn, *args, **kwargs):
+        """
+        Call fn once, delay seconds from now.
+
+        :param delay: The seconds from now.
+        :type delay: int | float
+        :param fn: The callable.
+        :return: The timer of the call.
+        :rtype: Timer
+        """
+        timer = Timer(self, time.time() + delay, None, fn, args, kwargs)
+        self._push(timer)
+        return timer
+
+    def call_every(self, interval, fn, *args, **kwargs):
+        """
+        Call fn every interval seconds, the first call interval seconds from now.
+
+        :param interval: The seconds between calls.
+        :type interval: int | float
+        :param fn: The callable.
+        :return: The timer of the calls.
+        :rtype: Timer
+        """
+        timer = Timer(self, time.time() + interval, interval, fn, args, kwargs)
+        self._push(timer)
+        return timer
+
+    def cancel(self, timer):
+        """
+        Cancel a timer.
+
+        The entry stays in the heap and is skipped when it comes up.
+
+        :param timer: The timer.
+        :type timer: Timer
+        :return: True if the timer was pending.
+        :rtype: bool
+        """
+        with self._condition:
+            pending = timer.active
+            timer.cancelled = True
+            timer._seq = None
+            return pending
+
+    def reschedule(self, timer, delay):
+        """ Move a timer to delay seconds from now. """
+        with self._condition:
+            timer.cancelled = False
+            timer.due = time.time() + delay
+            self._push_locked(timer)
+
+    def shutdown(self):
+        """ Stop the scheduler thread, pending calls are dropped. """
+        with self._condition:
+            self._closed = True
+            self._heap = []
+            self._condition.notify()
+
+    def _push(self, timer):
+        with self._condition:
+            self._push_locked(timer)
+
+    def _push_locked(self, timer):
+        if self._closed:
+            raise RuntimeError('scheduler %s is shut down' % self.name)
+        # a new sequence number invalidates any older heap entry of the timer.
+        timer._seq = next(self._counter)
+        heapq.heappush(self._heap, (timer.due, timer._seq, timer))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        elif self._heap[0][2] is timer:
+            # the timer is due before the one the thread is waiting for.
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                timer = None
+                while timer is None:
+                    if self._closed:
+                        return
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    due, seq, candidate = self._heap[0]
+                    if candidate._seq != seq:
+                        # cancelled or rescheduled.
+                        heapq.heappop(self._heap)
+                        continue
+                    wait = due - time.time()
+                    if wait > 0:
+                        self._condition.wait(wait)
+                        continue
+                    heapq.heappop(self._heap)
+                    timer = candidate
+                    if timer.interval is None:
+                        timer._seq = None
+                    else:
+                        # the next call is due interval seconds after this one was due, without drift.
+                        timer.due = max(due + timer.interval, time.time())
+                        timer._seq = next(self._counter)
+                        heapq.heappush(self._heap, (timer.due, timer._seq, timer))
+            try:
+                timer.fn(*timer.args, **timer.kwargs)
+            except Exception as e:
+                log.error('%s call %r error: %s' % (self.name, timer, e), exc_info=True)
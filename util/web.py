@@ -1,8 +1,9 @@
-""" Contains functions to make http GET and http POST with. version 0.0.6 """
+""" Contains functions to make http GET and http POST with. version 0.0.7 """
 import time
 import logging
 import requests
 from requests.utils import quote, unquote
+from . import proxy_pool
 
 __all__ = ['quote', 'unquote']
 
@@ -63,6 +64,56 @@ def has_cookie(cookie_name):
     return False
 
 
+def __proxies(address):
+    """ The requests proxies of a proxy address, for http as well as https urls. """
+    return {'http': 'http://' + address, 'https': 'http://' + address}
+
+
+def __request(method, url, proxy, **kwargs):
+    """
+    Make a request with the session, through a proxy or a proxy pool.
+
+    With a proxy pool, the best proxy of the pool is used, and the next one
+    is tried when the connection through a proxy fails. Each attempt waits
+    at most the timeout of the pool.
+
+    :param method: The http method.
+    :type method: str
+    :param url: The url.
+    :type url: str
+    :param proxy: A proxy in the format IP:PORT, or a proxy pool.
+    :type proxy: str | proxy_pool.ProxyPool | None
+    :return: The response.
+    :rtype: requests.Response
+    """
+    if not isinstance(proxy, proxy_pool.ProxyPool):
+        if proxy:
+            kwargs['proxies'] = __proxies(proxy)
+        return __request_session.request(method=method, url=url, **kwargs)
+
+    timeout = kwargs.get('timeout')
+    kwargs['timeout'] = proxy.timeout if timeout is None else min(timeout, proxy.timeout)
+    tried = []
+    error = requests.ConnectionError('no proxy in %s' % proxy)
+    for _ in range(proxy.max_attempts):
+        address = proxy.select(exclude=tried)
+        if address is None:
+            break
+        tried.append(address)
+        kwargs['proxies'] = __proxies(address)
+        start = time.time()
+        try:
+            response = __request_session.request(method=method, url=url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            log.warning('request to %s through proxy %s failed: %s' % (url, address, e))
+            proxy.report_failure(address)
+            error = e
+            continue
+        proxy.report_success(address, time.time() - start)
+        return response
+    raise error
+
+
 def http_get(url, **kwargs):
     json = kwargs.get('json', False)
     proxy = kwargs.get('proxy', '')
@@ -84,14 +135,11 @@ def http_get(url, **kwargs):
     if header is not None and type(header) is dict:
         default_header.update(header)
 
-    if proxy:
-        proxy = {'http': 'http://' + proxy}
-
     gr = None
     json_response = None
 
     try:
-        gr = __request_session.request(method='GET', url=url, headers=default_header, proxies=proxy, timeout=timeout)
+        gr = __request('GET', url, proxy, headers=default_header, timeout=timeout)
         if json:
             json_response = gr.json()
     except ValueError as ve:
@@ -130,22 +178,19 @@ def http_post(post_url, post_data, **kwargs):
 
     if not post_url:
         raise ValueError('no post_url provided. post_url=%s' % post_url)
-    elif proxy and type(proxy) is not str:
-        raise TypeError('proxy must be of type str and in the format ip:port. proxy type=%s'
+    elif proxy and type(proxy) is not str and not isinstance(proxy, proxy_pool.ProxyPool):
+        raise TypeError('proxy must be of type str and in the format ip:port, or a ProxyPool. proxy type=%s'
                         % type(proxy))
     else:
         if header is not None and type(header) is dict:
             default_header.update(header)
 
-        if proxy:
-            proxy = {'http': 'http://' + proxy}
-
         pr = None
         json_response = None
 
         try:
-            pr = __request_session.request(method='POST', url=post_url, data=post_data, headers=default_header,
-                                          allow_redirects=redirect, proxies=proxy, timeout=timeout, stream=stream)
+            pr = __request('POST', post_url, proxy, data=post_data, headers=default_header,
+                           allow_redirects=redirect, timeout=timeout, stream=stream)
             if json:
                 json_response = pr.json()
         except ValueError as ve:
@@ -0,0 +1,220 @@
+""" A bounded pool of worker threads with a task queue. version 0.0.1
+
+Tasks are queued and run by a fixed amount of worker threads, instead of
+starting a new thread for every task. When the queue is full, the drop policy
+of the pool decides what happens to a new task.
+
+Usage:
+    api_workers = WorkerPool('api', workers=4, max_queue=50)
+    api_workers.submit(do_lookup, search_term)
+    api_workers.stats()
+"""
+import collections
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# drop the new task when the queue is full.
+DROP_NEW = 'drop_new'
+# drop the oldest queued task to make room for the new task.
+DROP_OLDEST = 'drop_oldest'
+# run the new task in the thread submitting it, so no task is ever dropped.
+CALLER_RUNS = 'caller_runs'
+
+
+class TaskStats(object):
+    """ The latency of the tasks running a function. """
+
+    __slots__ = ('count', 'failed', 'total_wait', 'total_run', 'max_wait', 'max_run')
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        # the seconds tasks were queued, and the seconds they ran.
+        self.total_wait = 0.0
+        self.total_run = 0.0
+        self.max_wait = 0.0
+        self.max_run = 0.0
+
+    def add(self, wait, run, failed):
+        self.count += 1
+        if failed:
+            self.failed += 1
+        self.total_wait += wait
+        self.total_run += run
+        self.max_wait = max(self.max_wait, wait)
+        self.max_run = max(self.max_run, run)
+
+    def as_dict(self):
+        count = self.count or 1
+        return {
+            'count': self.count,
+            'failed': self.failed,
+            'avg_wait': self.total_wait / count,
+            'avg_run': self.total_run / count,
+            'max_wait': self.max_wait,
+            'max_run': self.max_run
+        }
+
+
+class WorkerPool(object):
+    """ Runs tasks on a bounded amount of worker threads. Thread safe. """
+
+    def __init__(self, name, workers=4, max_queue=100, drop_policy=DROP_NEW):
+        """
+        Create a worker pool. The worker threads are started as tasks arrive.
+
+        :param name: The name of the pool, used for the thread names and logging.
+        :type name: str
+        :param workers: The maximum amount of worker threads.
+        :type workers: int
+        :param max_queue: The maximum amount of queued tasks.
+        :type max_queue: int
+        :param drop_policy: What to do with a new task when the queue is full,
+        DROP_NEW, DROP_OLDEST or CALLER_RUNS.
+        :type drop_policy: str
+        """
+        if drop_policy not in (DROP_NEW, DROP_OLDEST, CALLER_RUNS):
+            raise ValueError('unknown drop policy: %s' % drop_policy)
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.drop_policy = drop_policy
+
+        self.submitted = 0
+        self.dropped = 0
+        self.caller_ran = 0
+        # function name -> TaskStats
+        self.task_stats = {}
+
+        self._queue = collections.deque()
+        self._threads = []
+        self._idle = 0
+        self._closed = False
+        self._condition = threading.Condition(threading.Lock())
+
+    def __repr__(self):
+        return '<WorkerPool %s threads=%s queued=%s>' % (self.name, len(self._threads), len(self._queue))
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue a task.
+
+        :param fn: The callable to run.
+        :param args: The arguments for fn.
+        :param kwargs: The keyword arguments for fn.
+        :return: True if the task was queued or run, False if it was dropped.
+        :rtype: bool
+        """
+        task = (fn, args, kwargs, time.time())
+        with self._condition:
+            if self._closed:
+                log.warning('%s pool is closed, dropping %s' % (self.name, _task_name(fn)))
+                self.dropped += 1
+                return False
+            self.submitted += 1
+
+            if len(self._queue) >= self.max_queue:
+                if self.drop_policy == DROP_NEW:
+                    self.dropped += 1
+                    log.warning('%s queue is full (%s), dropping %s' % (self.name, self.max_queue, _task_name(fn)))
+                    return False
+                elif self.drop_policy == DROP_OLDEST:
+                    self.dropped += 1
+                    oldest = self._queue.popleft()
+                    log.warning('%s queue is full (%s), dropping %s' %
+                                (self.name, self.max_queue, _task_name(oldest[0])))
+                else:
+                    self.caller_ran += 1
+                    task = None
+
+            if task is not None:
+                self._queue.append(task)
+                if len(self._queue) > self._idle and len(self._threads) < self.workers:
+                    self._start_worker()
+                self._condition.notify()
+
+        if task is None:
+            # the queue is full, the caller runs the task. (CALLER_RUNS)
+            self._run(fn, args, kwargs, time.time())
+        return True
+
+    def shutdown(self, wait=False):
+        """
+        Stop the workers once the queued tasks are done.
+
+        :param wait: Wait for the workers to finish.
+        :type wait: bool
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+            threads = list(self._threads)
+        if wait:
+            for thread in threads:
+                if thread is not threading.current_thread():
+                    thread.join()
+
+    def stats(self):
+        """
+        The metrics of the pool.
+
+        :return: The queue depth, the thread and task counts, and the latency per task.
+        :rtype: dict
+        """
+        with self._condition:
+            return {
+                'name': self.name,
+                'threads': len(self._threads),
+                'idle': self._idle,
+                'queue_depth': len(self._queue),
+                'submitted': self.submitted,
+                'dropped': self.dropped,
+                'caller_ran': self.caller_ran,
+                'tasks': dict((name, stats.as_dict()) for name, stats in self.task_stats.iteritems())
+            }
+
+    def _start_worker(self):
+        thread = threading.Thread(target=self._work, name='%s-worker-%s' % (self.name, len(self._threads)))
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+    def _work(self):
+        while True:
+            with self._condition:
+                self._idle += 1
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                self._idle -= 1
+                if not self._queue:
+                    self._threads.remove(threading.current_thread())
+                    return
+                fn, args, kwargs, queued = self._queue.popleft()
+            self._run(fn, args, kwargs, queued)
+
+    def _run(self, fn, args, kwargs, queued):
+        start = time.time()
+        failed = False
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            failed = True
+            log.error('%s task %s error: %s' % (self.name, _task_name(fn), e), exc_info=True)
+        end = time.time()
+        name = _task_name(fn)
+        with self._condition:
+            stats = self.task_stats.get(name)
+            if stats is None:
+                stats = self.task_stats[name] = TaskStats()
+            stats.add(start - queued, end - start, failed)
+
+
+def _task_name(fn):
+    return getattr(fn, '__name__', repr(fn))